@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Compress or decompress many files at once.
+
+Takes files and directories (which are searched recursively), and writes the
+results under an output directory with the same layout: compressing adds .lz
+to each name and decompressing takes it off (or adds .bin). Files are handled
+in a process pool. A manifest in the output directory records a hash of each
+input and the settings it was done with, so files that haven't changed since
+the last run are skipped. It also records a hash of each output, and an output
+that's already there without having been written by an earlier run isn't
+replaced unless --force is given.
+"""
+
+from sys import stderr, exit
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from lzss3 import decompress_bytes, decompress_overlay
+from compress import compress_bytes, DEFAULT_LEVEL, LEVELS
+
+__all__ = ('find_files', 'output_path', 'process_file', 'main')
+
+MANIFEST = '.nlzss-manifest.json'
+FORMATS = ('lz10', 'lz11', 'overlay')
+
+def find_files(paths):
+    """Yields (path, path relative to the directory it was found in) for
+    every file in paths, searching directories recursively. Manifests are
+    left out, so an output directory can be used as the input of another
+    run."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name == MANIFEST:
+                        continue
+                    full = os.path.join(root, name)
+                    yield full, os.path.relpath(full, path)
+        else:
+            yield path, os.path.basename(path)
+
+def output_path(outdir, relpath, mode):
+    if mode == 'compress':
+        return os.path.join(outdir, relpath + '.lz')
+    if relpath.endswith('.lz'):
+        return os.path.join(outdir, relpath[:-3])
+    return os.path.join(outdir, relpath + '.bin')
+
+def process_file(src, dst, mode, format, level):
+    """Compress or decompress one file. Returns (uncompressed size,
+    compressed size, seconds taken)."""
+    with open(src, 'rb') as f:
+        data = f.read()
+
+    start = time.perf_counter()
+    if mode == 'compress':
+        if format == 'lz10':
+            result = compress_bytes(data, 0x10, level=level)
+        elif format == 'lz11':
+            result = compress_bytes(data, 0x11, level=level)
+        else:
+            raise ValueError("overlays can't be compressed")
+        sizes = (len(data), len(result))
+    else:
+        if format == 'overlay':
+            out = BytesIO()
+            decompress_overlay(BytesIO(data), out)
+            result = out.getvalue()
+        else:
+            # LZ10 or LZ11, from the header
+            result = decompress_bytes(data)
+        sizes = (len(result), len(data))
+    seconds = time.perf_counter() - start
+
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    with open(dst, 'wb') as f:
+        f.write(result)
+    return sizes + (seconds,)
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(0x10000), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def format_report(path, uncompressed, compressed, seconds):
+    return "{}: {} -> {} bytes ({:.1%}), {:.2f} MB/s".format(
+        path, uncompressed, compressed, compressed / max(uncompressed, 1),
+        uncompressed / max(seconds, 1e-9) / 1e6)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('-c', '--compress', dest='mode', action='store_const',
+                      const='compress')
+    mode.add_argument('-d', '--decompress', dest='mode', action='store_const',
+                      const='decompress')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='files or directories to process')
+    parser.add_argument('-o', '--outdir', required=True,
+                        help='where to write the results')
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help='the format to compress to (default: lz10), or '
+                             'to decompress from (default: from the header)')
+    parser.add_argument('-l', '--level', type=int, default=DEFAULT_LEVEL,
+                        choices=sorted(LEVELS),
+                        help='compression level (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='how many processes to use (default: one per cpu)')
+    parser.add_argument('--force', action='store_true',
+                        help="process files even if they haven't changed, and "
+                             "replace outputs that earlier runs didn't write")
+    args = parser.parse_args(args)
+
+    format = args.format
+    if format is None and args.mode == 'compress':
+        format = 'lz10'
+    if format == 'overlay' and args.mode == 'compress':
+        parser.error("overlays can't be compressed")
+    settings = [args.mode, format, args.level if args.mode == 'compress' else None]
+
+    manifest_path = os.path.join(args.outdir, MANIFEST)
+    manifest = load_manifest(manifest_path)
+
+    jobs = []
+    skipped = 0
+    kept = 0
+    for src, relpath in find_files(args.paths):
+        dst = output_path(args.outdir, relpath, args.mode)
+        digest = file_hash(src)
+        entry = manifest.get(relpath)
+        if not args.force and os.path.exists(dst):
+            # manifests from before outputs were hashed can't say, so their
+            # outputs are taken to be ours
+            output = file_hash(dst)
+            if entry is None or entry.get('output', output) != output:
+                print("{}: {} is already there and wasn't written by an "
+                      "earlier run, use --force to replace it".format(
+                          relpath, dst), file=stderr)
+                kept += 1
+                continue
+            if entry['sha1'] == digest and entry['settings'] == settings:
+                skipped += 1
+                continue
+        jobs.append((src, dst, relpath, digest))
+
+    failed = 0
+    totals = [0, 0, 0.0]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+        futures = [(pool.submit(process_file, src, dst, args.mode, format,
+                                args.level), dst, relpath, digest)
+                   for src, dst, relpath, digest in jobs]
+        for future, dst, relpath, digest in futures:
+            try:
+                uncompressed, compressed, seconds = future.result()
+            except (IOError, ValueError) as e:
+                # DecompressionError is a ValueError
+                print("{}: {}".format(relpath, e), file=stderr)
+                manifest.pop(relpath, None)
+                failed += 1
+                continue
+            print(format_report(relpath, uncompressed, compressed, seconds))
+            manifest[relpath] = {'sha1': digest, 'settings': settings,
+                                 'output': file_hash(dst)}
+            totals[0] += uncompressed
+            totals[1] += compressed
+            totals[2] += seconds
+
+    os.makedirs(args.outdir, exist_ok=True)
+    save_manifest(manifest_path, manifest)
+    print("{} files done, {} unchanged, {} not replaced, {} failed in {:.2f}s"
+          .format(len(jobs) - failed, skipped, kept, failed,
+                  time.perf_counter() - start))
+    if len(jobs) > failed:
+        print(format_report('total', *totals))
+
+    return 1 if failed or kept else 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Benchmark compression and decompression.
+
+Compresses and decompresses a generated corpus (random bytes, repetitive
+data, 4bpp tiles and text) at several sizes, and prints the speed in MB/s of
+uncompressed data, along with the compressed size as a share of the
+original. The results can be saved as a JSON baseline, and later runs
+compared against it: a benchmark that got slower by more than the threshold
+makes the run fail.
+"""
+
+import sys
+from sys import stderr, exit
+import argparse
+import json
+import platform
+import random
+import timeit
+from io import BytesIO
+from struct import pack
+
+from lzss3 import decompress_raw_lzss10, decompress_raw_lzss11, decompress_overlay
+from compress import (compress, compress_nlz11, chunkit, _level_tokens,
+                      NOverlayChainWindow, DEFAULT_LEVEL, LEVELS)
+
+__all__ = ('make_corpus', 'make_overlay', 'run', 'compare', 'main')
+
+CORPORA = ('random', 'repetitive', 'tiles', 'text')
+BENCHMARKS = ('compress', 'compress_nlz11', 'decompress_raw_lzss10',
+              'decompress_raw_lzss11', 'decompress_overlay')
+SIZES = (0x400, 0x10000, 0x100000, 0x400000)
+THRESHOLD = 0.15
+
+WORDS = (b'the', b'of', b'and', b'to', b'a', b'in', b'is', b'you', b'that',
+         b'it', b'POKeMON', b'used', b'was', b'for', b'on', b'are', b'with',
+         b'trainer', b'wild', b'appeared', b'fainted', b'item', b'route',
+         b'center', b'healed', b'attack', b'defense', b'speed', b'grew',
+         b'level', b'learned', b'move', b'PC', b'box', b'berry', b'gym')
+
+def make_corpus(kind, size, seed=0):
+    """Generates size bytes of a kind of data. The same arguments always
+    give the same data."""
+    rand = random.Random(seed)
+    if kind == 'random':
+        return rand.getrandbits(size * 8).to_bytes(size, 'little')
+
+    out = bytearray()
+    if kind == 'repetitive':
+        # a short pattern, with a byte changed now and then
+        pattern = bytes(rand.getrandbits(8) for _ in range(16))
+        while len(out) < size:
+            out += pattern * 64
+            out[rand.randrange(len(out))] = rand.getrandbits(8)
+    elif kind == 'tiles':
+        # 8x8 tiles at 4 bits per pixel, made from a small set of rows with
+        # few colours, and often repeated, as in a tileset
+        rows = [bytes(rand.choice((0x00, 0x11, 0x12, 0x21, 0x22, 0x33, 0x31))
+                      for _ in range(4)) for _ in range(48)]
+        tiles = [b''.join(rand.choice(rows) for _ in range(8)) for _ in range(96)]
+        while len(out) < size:
+            out += rand.choice(tiles[:rand.choice((8, 32, 96))])
+    elif kind == 'text':
+        # words picked with a skewed distribution, as in dialogue
+        weights = [1 / (i + 1) for i in range(len(WORDS))]
+        while len(out) < size:
+            line = rand.choices(WORDS, weights, k=rand.randrange(3, 12))
+            out += b' '.join(line) + b'.\n'
+    else:
+        raise ValueError("unknown corpus: {}".format(kind))
+    return bytes(out[:size])
+
+def make_overlay(data, level=DEFAULT_LEVEL):
+    """Compresses all of data into an overlay, or returns None if it wouldn't
+    get any smaller.
+
+    Nothing else here makes overlays, as they only need decompressing; this
+    is just so there's one to decompress."""
+    stream = bytearray()
+    for group in chunkit(_level_tokens(data[::-1], NOverlayChainWindow, level), 8):
+        flags = 0
+        body = bytearray()
+        for i, t in enumerate(group):
+            if type(t) == tuple:
+                count, disp = t
+                flags |= 0x80 >> i
+                body += pack(">H", ((count - 3) << 12) | (-disp - 3))
+            else:
+                body.append(t)
+        stream.append(flags)
+        stream += body
+    # overlays are read backwards
+    stream.reverse()
+
+    padding = 8 + (-len(stream) % 4)
+    end_delta = len(stream) + padding
+    if end_delta > len(data):
+        return None
+    stream += b'\xff' * (padding - 8)
+    stream += pack("<LL", end_delta | (padding << 24), len(data) - end_delta)
+    return bytes(stream)
+
+def _time(func, repeat, min_time):
+    """The fastest time of one call of func, from at least repeat runs that
+    each take at least min_time seconds."""
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed * 4 >= min_time else 10
+    times = [elapsed] + timer.repeat(repeat - 1, number)
+    return min(times) / number
+
+def _compressed(func, data, level):
+    out = BytesIO()
+    func(data, out, level=level)
+    return out.getvalue()
+
+def run(benchmarks=BENCHMARKS, corpora=CORPORA, sizes=SIZES, level=DEFAULT_LEVEL,
+        repeat=3, min_time=0.2, progress=None):
+    """Run the benchmarks on every kind of corpus at every size.
+
+    Returns a dict of results keyed by "benchmark/corpus/size", each holding
+    the speed in MB/s of uncompressed data and the compressed size as a
+    fraction of the original. progress, if given, is called with each key
+    and result as they're done."""
+    results = {}
+    for kind in corpora:
+        for size in sizes:
+            data = make_corpus(kind, size)
+            lz10 = lz11 = overlay = None
+            for benchmark in benchmarks:
+                if benchmark in ('compress', 'decompress_raw_lzss10'):
+                    if lz10 is None:
+                        lz10 = _compressed(compress, data, level)
+                    compressed = lz10
+                elif benchmark in ('compress_nlz11', 'decompress_raw_lzss11'):
+                    if lz11 is None:
+                        lz11 = _compressed(compress_nlz11, data, level)
+                    compressed = lz11
+                else:
+                    if overlay is None:
+                        overlay = make_overlay(data, level) or b''
+                    if not overlay:
+                        # incompressible data doesn't make an overlay
+                        continue
+                    compressed = overlay
+
+                if benchmark == 'compress':
+                    func = lambda: compress(data, BytesIO(), level=level)
+                elif benchmark == 'compress_nlz11':
+                    func = lambda: compress_nlz11(data, BytesIO(), level=level)
+                elif benchmark == 'decompress_raw_lzss10':
+                    func = lambda: decompress_raw_lzss10(memoryview(lz10)[4:], size)
+                elif benchmark == 'decompress_raw_lzss11':
+                    func = lambda: decompress_raw_lzss11(memoryview(lz11)[4:], size)
+                elif benchmark == 'decompress_overlay':
+                    func = lambda: decompress_overlay(BytesIO(overlay), BytesIO())
+                else:
+                    raise ValueError("unknown benchmark: {}".format(benchmark))
+
+                seconds = _time(func, repeat, min_time)
+                key = "{}/{}/{}".format(benchmark, kind, size)
+                results[key] = {'mb_per_s': size / seconds / 1e6,
+                                'ratio': len(compressed) / size}
+                if progress:
+                    progress(key, results[key])
+    return results
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Returns the keys of the results that are slower than in baseline by
+    more than threshold (a fraction). Results missing from either are
+    ignored."""
+    return [key for key, result in results.items()
+            if key in baseline and
+               result['mb_per_s'] < baseline[key]['mb_per_s'] * (1 - threshold)]
+
+def parse_size(s):
+    """Parses a size like 4096, 64K or 4M."""
+    s = s.strip().upper()
+    units = {'K': 1 << 10, 'M': 1 << 20}
+    if s and s[-1] in units:
+        return int(s[:-1]) * units[s[-1]]
+    return int(s, 0)
+
+def format_size(size):
+    for unit, n in (('M', 1 << 20), ('K', 1 << 10)):
+        if size >= n and size % n == 0:
+            return "{}{}".format(size // n, unit)
+    return str(size)
+
+def format_result(key, result, base=None):
+    benchmark, kind, size = key.split('/')
+    line = "{:<22} {:<10} {:>5} {:>6.1%} {:>9.2f} MB/s".format(
+        benchmark, kind, format_size(int(size)), result['ratio'],
+        result['mb_per_s'])
+    if base:
+        line += " ({:+.1%})".format(result['mb_per_s'] / base['mb_per_s'] - 1)
+    return line
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-b', '--benchmark', dest='benchmarks', action='append',
+                        choices=BENCHMARKS,
+                        help='a benchmark to run (default: all of them)')
+    parser.add_argument('-c', '--corpus', dest='corpora', action='append',
+                        choices=CORPORA,
+                        help='a kind of data to run them on (default: all)')
+    parser.add_argument('-s', '--sizes',
+                        type=lambda s: [parse_size(x) for x in s.split(',')],
+                        default=SIZES,
+                        help='comma-separated corpus sizes (default: {})'.format(
+                            ','.join(format_size(s) for s in SIZES)))
+    parser.add_argument('-l', '--level', type=int, default=DEFAULT_LEVEL,
+                        choices=sorted(LEVELS),
+                        help='compression level (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs of each benchmark to take the fastest of '
+                             '(default: %(default)s)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a saved baseline, and '
+                             'fail if any got slower by more than the threshold')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='how much slower counts as a regression, as a '
+                             'fraction (default: %(default)s)')
+    args = parser.parse_args(args)
+
+    baseline = {}
+    if args.compare:
+        try:
+            with open(args.compare) as f:
+                saved = json.load(f)
+            baseline, level = saved['results'], saved['level']
+        except (IOError, ValueError, KeyError) as e:
+            print("{}: {}".format(args.compare, e), file=stderr)
+            return 2
+        # different levels search differently hard, so their speeds can't
+        # be compared
+        if level != args.level:
+            print("{}: the baseline was run at level {}, not {}".format(
+                args.compare, level, args.level), file=stderr)
+            return 2
+
+    def progress(key, result):
+        print(format_result(key, result, baseline.get(key)))
+        sys.stdout.flush()
+
+    results = run(args.benchmarks or BENCHMARKS, args.corpora or CORPORA,
+                  args.sizes, args.level, max(args.repeat, 1), progress=progress)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'level': args.level,
+                       'results': results}, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        regressed = compare(results, baseline, args.threshold)
+        for key in regressed:
+            print("regressed: {}".format(key), file=stderr)
+        if regressed:
+            print("{} of {} benchmarks got more than {:.0%} slower".format(
+                len(regressed), len(results), args.threshold), file=stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -106,22 +106,138 @@ class NLZ10Window(SlidingWindow):
     match_min = 3
     match_max = 3 + 0xf
 
+    # The size in bits of a match, as (longest count, bits) for each encoding
+    # in order.
+    match_bits = ((3 + 0xf, 16),)
+
 class NLZ11Window(SlidingWindow):
     size = 4096
 
     match_min = 3
     match_max = 0x111 + 0xFFFF
 
+    match_bits = ((1 + 0xF, 16), (0x11 + 0xFF, 24), (0x111 + 0xFFFF, 32))
+
 class NOverlayWindow(NLZ10Window):
     disp_min = 3
 
-def _compress(input, windowclass=NLZ10Window):
+def match_length(data, a, b, limit):
+    """The length of the common prefix of data[a:] and data[b:], up to limit.
+
+    Compares slices that double in size while they match, and halve when they
+    don't."""
+    n = 0
+    step = 16
+    while n < limit:
+        k = min(step, limit - n)
+        if data[a + n:a + n + k] == data[b + n:b + n + k]:
+            n += k
+            step <<= 1
+        elif k <= 4:
+            # the mismatch is within these k bytes
+            while data[a + n] == data[b + n]:
+                n += 1
+            return n
+        else:
+            step = k >> 1
+    return n
+
+class HashChainWindow(SlidingWindow):
+    """A sliding window that finds matches through hash chains.
+
+    Every position is hashed on its first three bytes. head holds the latest
+    position for each hash, and prev, a ring buffer the size of the window,
+    links each position to the previous one with the same hash. search() walks
+    the chain from the nearest position back, trying at most chain_depth
+    candidates, and stops early at a match of match_max."""
+
+    # How many candidates search() tries. By default that's the whole window,
+    # which finds matches as long as SlidingWindow's exhaustive search does.
+    chain_depth = 4096
+
+    hash_bits = 15
+
+    def __init__(self, buf, chain_depth=None):
+        self.data = bytes(buf)
+        self.index = 0
+        if chain_depth is not None:
+            self.chain_depth = chain_depth
+
+        assert self.size & (self.size - 1) == 0
+        assert self.match_min >= 3
+        assert self.match_max is not None
+
+        self.head = [-1] * (1 << self.hash_bits)
+        self.prev = [-1] * self.size
+
+    def hash(self, i):
+        data = self.data
+        return ((data[i] << 10) ^ (data[i + 1] << 5) ^ data[i + 2]) & \
+            ((1 << self.hash_bits) - 1)
+
+    def next(self):
+        i = self.index
+        if i + 2 < len(self.data):
+            h = self.hash(i)
+            self.prev[i & (self.size - 1)] = self.head[h]
+            self.head[h] = i
+        self.index = i + 1
+
+    def search(self):
+        data = self.data
+        index = self.index
+        limit = min(self.match_max, len(data) - index)
+        if limit < self.match_min:
+            return None
+
+        prev = self.prev
+        mask = self.size - 1
+        oldest = index - self.size
+        disp_min = self.disp_min
+
+        best = 0
+        best_disp = 0
+        candidate = self.head[self.hash(index)]
+        depth = self.chain_depth
+        while candidate >= oldest and candidate >= 0 and depth:
+            disp = index - candidate
+            # a candidate can only do better if it matches at the byte where
+            # the best match so far ends
+            if disp >= disp_min and \
+               data[candidate + best] == data[index + best]:
+                length = match_length(data, candidate, index, limit)
+                if length > best:
+                    best = length
+                    best_disp = disp
+                    if length >= limit:
+                        break
+            candidate = prev[candidate & mask]
+            depth -= 1
+
+        if best < self.match_min:
+            return None
+        return (best, -best_disp)
+
+class NLZ10ChainWindow(HashChainWindow, NLZ10Window):
+    pass
+
+class NLZ11ChainWindow(HashChainWindow, NLZ11Window):
+    pass
+
+class NOverlayChainWindow(HashChainWindow, NOverlayWindow):
+    pass
+
+def _compress(input, windowclass=NLZ10Window, start=0, **window_args):
     """Generates a stream of tokens. Either a byte (int) or a tuple of (count,
-    displacement)."""
+    displacement).
+
+    The tokens start at input[start]; anything before that is only there for
+    matches to refer back to."""
 
-    window = windowclass(input)
+    window = windowclass(input, **window_args)
+    window.advance(start)
 
-    i = 0
+    i = start
     while True:
         if len(input) <= i:
             break
@@ -137,16 +253,189 @@ def _compress(input, windowclass=NLZ10Window):
             window.next()
             i += 1
 
-def packflags(flags):
-    n = 0
-    for i in range(8):
-        n <<= 1
-        try:
-            if flags[i]:
-                n |= 1
-        except IndexError:
-            pass
-    return n
+def _compress_lazy(input, windowclass=NLZ10ChainWindow, start=0,
+                   **window_args):
+    """Generates the same stream of tokens as _compress, but with lazy
+    matching: before taking a match, checks whether the next position has a
+    longer one, and if so writes a literal and takes that instead."""
+    window = windowclass(input, **window_args)
+    window.advance(start)
+
+    i = start
+    match = window.search()
+    while i < len(input):
+        if match:
+            window.next()
+            following = window.search()
+            if following and following[0] > match[0]:
+                yield input[i]
+                i += 1
+                match = following
+                continue
+            yield match
+            window.advance(match[0] - 1)
+            i += match[0]
+        else:
+            yield input[i]
+            window.next()
+            i += 1
+        match = window.search()
+
+# Positions inside a match at least this long take the rest of it as their
+# match rather than searching again, which keeps long runs from being quadratic.
+LONG_MATCH = 0x100
+
+def _compress_optimal(input, windowclass=NLZ10ChainWindow, start=0,
+                      **window_args):
+    """Generates the same stream of tokens as _compress, but chosen to make the
+    compressed data as small as possible rather than greedily.
+
+    The longest match is found at every position. Then, working back from the
+    end, the cheapest way to encode the rest of the input from each position
+    is worked out: a literal (9 bits counting its flag bit), or a match of any
+    length up to the longest, costed by its encoding."""
+    window = windowclass(input, **window_args)
+    window.advance(start)
+    n = len(input)
+
+    matches = [None] * n
+    match = None
+    for i in range(start, n):
+        if match is not None and match[0] > LONG_MATCH:
+            match = (match[0] - 1, match[1])
+        else:
+            match = window.search()
+        matches[i] = match
+        window.next()
+
+    # cost[i] is the fewest bits to encode input[i:], and length[i] is the
+    # match length to get it (0 for a literal).
+    cost = [0] * (n + 1)
+    length = [0] * (n + 1)
+
+    # A min segment tree over cost, for choosing among the hundreds of lengths
+    # a long LZ11 match could be cut to. Entries are packed so that ties go to
+    # the longer match.
+    long_matches = len(windowclass.match_bits) > 1
+    leaves = 1
+    while leaves < n + 1:
+        leaves <<= 1
+    tree = [float('inf')] * (2 * leaves) if long_matches else None
+
+    def cheapest(lo, hi):
+        """The position in lo..hi (inclusive) with the lowest cost."""
+        if hi - lo < 16:
+            return min(range(lo, hi + 1), key=lambda j: (cost[j], -j))
+        lo += leaves
+        hi += leaves + 1
+        best = float('inf')
+        while lo < hi:
+            if lo & 1:
+                best = min(best, tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                best = min(best, tree[hi])
+            lo >>= 1
+            hi >>= 1
+        return n - best % (n + 1)
+
+    def update(i):
+        # each leaf is only set once, so its ancestors only need updating
+        # while it's smaller than them
+        if tree is not None:
+            j = i + leaves
+            value = cost[i] * (n + 1) + (n - i)
+            tree[j] = value
+            while j > 1:
+                j >>= 1
+                if tree[j] <= value:
+                    break
+                tree[j] = value
+
+    update(n)
+    for i in range(n - 1, start - 1, -1):
+        best = cost[i + 1] + 9
+        best_length = 0
+        match = matches[i]
+        if match is not None:
+            lo = windowclass.match_min
+            for (longest, bits) in windowclass.match_bits:
+                hi = min(longest, match[0])
+                if hi < lo:
+                    break
+                j = cheapest(i + lo, i + hi)
+                if cost[j] + bits + 1 <= best:
+                    best = cost[j] + bits + 1
+                    best_length = j - i
+                lo = longest + 1
+        cost[i] = best
+        length[i] = best_length
+        update(i)
+
+    i = start
+    while i < n:
+        if length[i]:
+            yield (length[i], matches[i][1])
+            i += length[i]
+        else:
+            yield input[i]
+            i += 1
+
+# Compression levels, as the parse and the chain depth to search with. Level 1
+# is the fastest and MAX_LEVEL gives the smallest output; see the README for
+# how they compare. DEFAULT_LEVEL is a greedy parse with a full search.
+LEVELS = {
+    1: (_compress, 4),
+    2: (_compress, 32),
+    3: (_compress, 4096),
+    4: (_compress_lazy, 256),
+    5: (_compress_lazy, 4096),
+    6: (_compress_optimal, 4096),
+}
+DEFAULT_LEVEL = 3
+MAX_LEVEL = max(LEVELS)
+
+# With more than one job, inputs longer than this are split into segments of
+# this size to be compressed in parallel.
+SEGMENT_SIZE = 0x40000
+
+def _level_tokens(input, windowclass, level, optimal=False, jobs=1):
+    """The tokens for input at a compression level. optimal is the same as
+    MAX_LEVEL."""
+    if optimal:
+        level = MAX_LEVEL
+    if level not in LEVELS:
+        raise ValueError("level must be between {} and {}".format(
+            min(LEVELS), MAX_LEVEL))
+    if jobs > 1 and len(input) > SEGMENT_SIZE:
+        return _parallel_tokens(input, windowclass, level, jobs)
+    parse, chain_depth = LEVELS[level]
+    return parse(input, windowclass, chain_depth=chain_depth)
+
+def _segment_tokens(data, start, windowclass, level):
+    """The tokens for data[start:], as a list."""
+    parse, chain_depth = LEVELS[level]
+    return list(parse(data, windowclass, start, chain_depth=chain_depth))
+
+def _parallel_tokens(input, windowclass, level, jobs, segment_size=SEGMENT_SIZE):
+    """Generates the tokens for input, parsing segments of it in parallel.
+
+    Matches only ever refer back into the input, so each segment can be parsed
+    on its own as long as it can see the window before it. Each worker gets
+    its segment along with the window's worth of input before it, and matches
+    can't run past the end of the segment. The tokens come out in order, as
+    one stream."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(jobs) as pool:
+        segments = []
+        for start in range(0, len(input), segment_size):
+            lo = max(0, start - windowclass.size)
+            segments.append(pool.submit(_segment_tokens,
+                input[lo:start + segment_size], start - lo, windowclass, level))
+        for segment in segments:
+            yield from segment.result()
 
 def chunkit(it, n):
     buf = []
@@ -158,82 +447,125 @@ def chunkit(it, n):
     if buf:
         yield buf
 
-def compress(input, out):
-    # header
-    out.write(pack("<L", (len(input) << 8) + 0x10))
-
-    # body
-    length = 0
-    for tokens in chunkit(_compress(input), 8):
-        flags = [type(t) == tuple for t in tokens]
-        out.write(pack(">B", packflags(flags)))
-
-        for t in tokens:
-            if type(t) == tuple:
-                count, disp = t
-                count -= 3
-                disp = (-disp) - 1
-                assert 0 <= disp < 4096
-                sh = (count << 12) | disp
-                out.write(pack(">H", sh))
-            else:
-                out.write(pack(">B", t))
-
-        length += 1
-        length += sum(2 if f else 1 for f in flags)
+# Output is built up in a bytearray and written in blocks of about this size.
+WRITE_SIZE = 0x10000
+
+def _encode_lz10(tokens, buf, out=None):
+    """Appends tokens to buf as LZ10 data, followed by the padding.
+
+    Each flag byte is reserved in buf when its group of 8 tokens starts, and
+    filled in as they're added. Returns buf; or with out, buf is written to
+    it whenever it grows past WRITE_SIZE, and at the end."""
+    written = 0
+    flagpos = 0
+    mask = 0
+    for t in tokens:
+        if not mask:
+            if out is not None and len(buf) >= WRITE_SIZE:
+                out.write(buf)
+                written += len(buf)
+                buf = bytearray()
+            flagpos = len(buf)
+            buf.append(0)
+            mask = 0x80
+
+        if type(t) == tuple:
+            count, disp = t
+            count -= 3
+            disp = (-disp) - 1
+            assert 0 <= disp < 4096
+            sh = (count << 12) | disp
+            buf[flagpos] |= mask
+            buf += pack(">H", sh)
+        else:
+            buf.append(t)
+        mask >>= 1
 
     # padding
-    padding = 4 - (length % 4 or 4)
-    if padding:
-        out.write(b'\xff' * padding)
-
-def compress_nlz11(input, out):
-    # header
-    out.write(pack("<L", (len(input) << 8) + 0x11))
-
-    # body
-    length = 0
-    for tokens in chunkit(_compress(input, windowclass=NLZ11Window), 8):
-        flags = [type(t) == tuple for t in tokens]
-        out.write(pack(">B", packflags(flags)))
-        length += 1
-
-        for t in tokens:
-            if type(t) == tuple:
-                count, disp = t
-                disp = (-disp) - 1
-                #if disp == 282:
-                #    raise Exception
-                assert 0 <= disp <= 0xFFF
-                if count <= 1 + 0xF:
-                    count -= 1
-                    assert 2 <= count <= 0xF
-                    sh = (count << 12) | disp
-                    out.write(pack(">H", sh))
-                    length += 2
-                elif count <= 0x11 + 0xFF:
-                    count -= 0x11
-                    assert 0 <= count <= 0xFF
-                    b = count >> 4
-                    sh = ((count & 0xF) << 12) | disp
-                    out.write(pack(">BH", b, sh))
-                    length += 3
-                elif count <= 0x111 + 0xFFFF:
-                    count -= 0x111
-                    assert 0 <= count <= 0xFFFF
-                    l = (1 << 28) | (count << 12) | disp
-                    out.write(pack(">L", l))
-                    length += 4
-                else:
-                    raise ValueError(count)
+    buf += b'\xff' * (-(written + len(buf)) % 4)
+    if out is None:
+        return buf
+    out.write(buf)
+
+def _encode_lz11(tokens, buf, out=None):
+    """Appends tokens to buf as LZ11 data, followed by the padding. out is as
+    for _encode_lz10."""
+    written = 0
+    flagpos = 0
+    mask = 0
+    for t in tokens:
+        if not mask:
+            if out is not None and len(buf) >= WRITE_SIZE:
+                out.write(buf)
+                written += len(buf)
+                buf = bytearray()
+            flagpos = len(buf)
+            buf.append(0)
+            mask = 0x80
+
+        if type(t) == tuple:
+            count, disp = t
+            disp = (-disp) - 1
+            assert 0 <= disp <= 0xFFF
+            buf[flagpos] |= mask
+            if count <= 1 + 0xF:
+                count -= 1
+                assert 2 <= count <= 0xF
+                sh = (count << 12) | disp
+                buf += pack(">H", sh)
+            elif count <= 0x11 + 0xFF:
+                count -= 0x11
+                assert 0 <= count <= 0xFF
+                b = count >> 4
+                sh = ((count & 0xF) << 12) | disp
+                buf += pack(">BH", b, sh)
+            elif count <= 0x111 + 0xFFFF:
+                count -= 0x111
+                assert 0 <= count <= 0xFFFF
+                l = (1 << 28) | (count << 12) | disp
+                buf += pack(">L", l)
             else:
-                out.write(pack(">B", t))
-                length += 1
+                raise ValueError(count)
+        else:
+            buf.append(t)
+        mask >>= 1
 
     # padding
-    padding = 4 - (length % 4 or 4)
-    if padding:
-        out.write(b'\xff' * padding)
+    buf += b'\xff' * (-(written + len(buf)) % 4)
+    if out is None:
+        return buf
+    out.write(buf)
+
+def compress(input, out, optimal=False, level=DEFAULT_LEVEL, jobs=1):
+    """LZ10-compress bytes to a file-like object.
+
+    level trades speed for size, from 1 (fastest) to MAX_LEVEL (smallest).
+    optimal is the same as MAX_LEVEL, where the tokens are chosen by
+    _compress_optimal. With jobs above 1, inputs over SEGMENT_SIZE are
+    compressed in that many processes; see _parallel_tokens. The output is
+    written in blocks of about WRITE_SIZE bytes."""
+    header = bytearray(pack("<L", (len(input) << 8) + 0x10))
+    parsed = _level_tokens(input, NLZ10ChainWindow, level, optimal, jobs)
+    _encode_lz10(parsed, header, out)
+
+def compress_nlz11(input, out, optimal=False, level=DEFAULT_LEVEL, jobs=1):
+    """LZ11-compress bytes to a file-like object. optimal, level and jobs are
+    as for compress."""
+    header = bytearray(pack("<L", (len(input) << 8) + 0x11))
+    parsed = _level_tokens(input, NLZ11ChainWindow, level, optimal, jobs)
+    _encode_lz11(parsed, header, out)
+
+def compress_bytes(input, format=0x10, optimal=False, level=DEFAULT_LEVEL, jobs=1):
+    """LZ10 or LZ11-compress bytes, as format 0x10 or 0x11. optimal, level
+    and jobs are as for compress. Returns a bytearray."""
+    if format == 0x10:
+        windowclass, encode = NLZ10ChainWindow, _encode_lz10
+    elif format == 0x11:
+        windowclass, encode = NLZ11ChainWindow, _encode_lz11
+    else:
+        raise ValueError("format must be 0x10 or 0x11")
+    header = bytearray(pack("<L", (len(input) << 8) + format))
+    return encode(_level_tokens(input, windowclass, level, optimal, jobs), header)
 
 def dump_compress_nlz11(input, out):
     # body
@@ -245,11 +577,45 @@ def dump_compress_nlz11(input, out):
     from pprint import pprint
     pprint(list(dump()))
 
+def optimal_savings(input, compress_func=compress):
+    """Compress input both ways with compress_func. Returns the greedy and the
+    optimal compressed sizes."""
+    from io import BytesIO
+    greedy = BytesIO()
+    compress_func(input, greedy)
+    optimal = BytesIO()
+    compress_func(input, optimal, optimal=True)
+    return len(greedy.getvalue()), len(optimal.getvalue())
+
 if __name__ == '__main__':
     from sys import stdout, argv
-    data = open(argv[1], "rb").read()
-    stdout = stdout.detach()
-    #compress(data, stdout)
-    compress_nlz11(data, stdout)
+    args = argv[1:]
+    optimal = '--optimal' in args
+    if optimal:
+        # report how much smaller the optimal parse is
+        args.remove('--optimal')
+    level = DEFAULT_LEVEL
+    if '--level' in args:
+        i = args.index('--level')
+        level = int(args[i + 1])
+        del args[i:i + 2]
+    jobs = 1
+    if '--jobs' in args:
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    data = open(args[0], "rb").read()
+    #compress(data, stdout.buffer)
+    compressed = compress_bytes(data, 0x11, optimal=optimal, level=level, jobs=jobs)
+    stdout.buffer.write(compressed)
+    stdout.flush()
+    if optimal:
+        # the optimal parse was just written, so only the greedy one is left
+        optimal_size = len(compressed)
+        greedy_size = len(compress_bytes(data, 0x11, level=level, jobs=jobs))
+        print("optimal parse: {} bytes, greedy: {} bytes, saved {} bytes ({:.1%})"
+              .format(optimal_size, greedy_size, greedy_size - optimal_size,
+                      (greedy_size - optimal_size) / max(greedy_size, 1)),
+              file=stderr)
 
     #dump_compress_nlz11(data, stdout)
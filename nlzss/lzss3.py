@@ -4,169 +4,550 @@ import sys
 from sys import stdin, stdout, stderr, exit
 from os import SEEK_SET, SEEK_CUR, SEEK_END
 from errno import EPIPE
-from struct import pack, unpack
+from struct import pack, unpack, Struct
+from bisect import bisect_right
+import mmap
 
-__all__ = ('decompress', 'decompress_file', 'decompress_bytes',
-           'decompress_overlay', 'DecompressionError')
+__all__ = ('decompress', 'decompress_file', 'decompress_bytes', 'decompress_into',
+           'decompress_overlay', 'decompress_overlay_into',
+           'decompress_overlay_in_place', 'decompress_stream', 'decompress_range',
+           'build_checkpoints', 'pack_checkpoints', 'unpack_checkpoints',
+           'Decompressor', 'DecompressionError')
 
 class DecompressionError(ValueError):
     pass
 
-def bits(byte):
-    return ((byte >> 7) & 1,
-            (byte >> 6) & 1,
-            (byte >> 5) & 1,
-            (byte >> 4) & 1,
-            (byte >> 3) & 1,
-            (byte >> 2) & 1,
-            (byte >> 1) & 1,
-            (byte) & 1)
+def _copy_back(out, pos, disp, count):
+    """Copy `count` bytes starting `disp` bytes back, writing at `pos`."""
+    start = pos - disp
+    if disp >= count:
+        out[pos:pos + count] = out[start:start + count]
+    else:
+        # the copy overlaps its own output, so it repeats the last `disp` bytes
+        pattern = bytes(out[start:pos])
+        out[pos:pos + count] = (pattern * (count // disp + 1))[:count]
+
+def _decompress_lzss10_into(indata, out, decompressed_size, disp_extra=1):
+    """Decompress raw LZ10 data into the first decompressed_size bytes of out.
+
+    out is a bytearray or a writable memoryview of bytes. Returns the number of
+    input bytes used."""
+    end = len(indata)
+    inpos = 0
+    pos = 0
+    try:
+        while pos < decompressed_size:
+            flags = indata[inpos]
+            inpos += 1
+            if flags == 0 and pos + 8 <= decompressed_size and inpos + 8 <= end:
+                # eight literals in a row
+                out[pos:pos + 8] = indata[inpos:inpos + 8]
+                inpos += 8
+                pos += 8
+                continue
+            for mask in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if flags & mask:
+                    sh = (indata[inpos] << 8) | indata[inpos + 1]
+                    inpos += 2
+                    count = (sh >> 0xc) + 3
+                    disp = (sh & 0xfff) + disp_extra
+                    if disp > pos:
+                        raise DecompressionError(
+                            "back-reference before the start of the data")
+                    if pos + count > decompressed_size:
+                        raise DecompressionError(
+                            "decompressed size does not match the expected size")
+                    _copy_back(out, pos, disp, count)
+                    pos += count
+                else:
+                    out[pos] = indata[inpos]
+                    inpos += 1
+                    pos += 1
 
-def decompress_raw_lzss10(indata, decompressed_size, _overlay=False):
-    """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    data = bytearray()
+                if decompressed_size <= pos:
+                    break
+    except IndexError:
+        raise DecompressionError("compressed data is truncated")
 
-    it = iter(indata)
+    return inpos
 
-    if _overlay:
-        disp_extra = 3
-    else:
-        disp_extra = 1
-
-    def writebyte(b):
-        data.append(b)
-    def readbyte():
-        return next(it)
-    def readshort():
-        # big-endian
-        a = next(it)
-        b = next(it)
-        return (a << 8) | b
-    def copybyte():
-        data.append(next(it))
-
-    while len(data) < decompressed_size:
-        b = readbyte()
-        flags = bits(b)
-        for flag in flags:
-            if flag == 0:
-                copybyte()
-            elif flag == 1:
-                sh = readshort()
-                count = (sh >> 0xc) + 3
-                disp = (sh & 0xfff) + disp_extra
+def _decompress_lzss11_into(indata, out, decompressed_size):
+    """Decompress raw LZ11 data into the first decompressed_size bytes of out.
 
-                for _ in range(count):
-                    writebyte(data[-disp])
-            else:
-                raise ValueError(flag)
+    out is a bytearray or a writable memoryview of bytes. Returns the number of
+    input bytes used."""
+    end = len(indata)
+    inpos = 0
+    pos = 0
+    try:
+        while pos < decompressed_size:
+            flags = indata[inpos]
+            inpos += 1
+            if flags == 0 and pos + 8 <= decompressed_size and inpos + 8 <= end:
+                # eight literals in a row
+                out[pos:pos + 8] = indata[inpos:inpos + 8]
+                inpos += 8
+                pos += 8
+                continue
+            for mask in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if flags & mask:
+                    b = indata[inpos]
+                    indicator = b >> 4
+
+                    if indicator == 0:
+                        # 8 bit count, 12 bit disp
+                        count = (b << 4) + (indata[inpos + 1] >> 4) + 0x11
+                        b = indata[inpos + 1]
+                        inpos += 2
+                    elif indicator == 1:
+                        # 16 bit count, 12 bit disp
+                        count = (((b & 0xf) << 12) + (indata[inpos + 1] << 4) +
+                                 (indata[inpos + 2] >> 4) + 0x111)
+                        b = indata[inpos + 2]
+                        inpos += 3
+                    else:
+                        # indicator is count (4 bits), 12 bit disp
+                        count = indicator + 1
+                        inpos += 1
+
+                    disp = ((b & 0xf) << 8) + indata[inpos] + 1
+                    inpos += 1
+                    if disp > pos:
+                        raise DecompressionError(
+                            "back-reference before the start of the data")
+                    if pos + count > decompressed_size:
+                        raise DecompressionError(
+                            "decompressed size does not match the expected size")
+                    _copy_back(out, pos, disp, count)
+                    pos += count
+                else:
+                    out[pos] = indata[inpos]
+                    inpos += 1
+                    pos += 1
 
-            if decompressed_size <= len(data):
-                break
+                if decompressed_size <= pos:
+                    break
+    except IndexError:
+        raise DecompressionError("compressed data is truncated")
 
-    if len(data) != decompressed_size:
-        raise DecompressionError("decompressed size does not match the expected size")
+    return inpos
 
+def decompress_raw_lzss10(indata, decompressed_size, _overlay=False):
+    """Decompress LZSS-compressed bytes. Returns a bytearray."""
+    data = bytearray(decompressed_size)
+    _decompress_lzss10_into(indata, data, decompressed_size,
+                            3 if _overlay else 1)
     return data
 
 def decompress_raw_lzss11(indata, decompressed_size):
     """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    data = bytearray()
-
-    it = iter(indata)
-
-    def writebyte(b):
-        data.append(b)
-    def readbyte():
-        return next(it)
-    def copybyte():
-        data.append(next(it))
-
-    while len(data) < decompressed_size:
-        b = readbyte()
-        flags = bits(b)
-        for flag in flags:
-            if flag == 0:
-                copybyte()
-            elif flag == 1:
-                b = readbyte()
-                indicator = b >> 4
-
-                if indicator == 0:
-                    # 8 bit count, 12 bit disp
-                    # indicator is 0, don't need to mask b
-                    count = (b << 4)
-                    b = readbyte()
-                    count += b >> 4
-                    count += 0x11
-                elif indicator == 1:
-                    # 16 bit count, 12 bit disp
-                    count = ((b & 0xf) << 12) + (readbyte() << 4)
-                    b = readbyte()
-                    count += b >> 4
-                    count += 0x111
+    data = bytearray(decompressed_size)
+    _decompress_lzss11_into(indata, data, decompressed_size)
+    return data
+
+class Decompressor:
+    """Incremental LZ10/LZ11 decompressor.
+
+    Compressed data (header included) is passed to feed() in chunks of any
+    size, and each call returns whatever output they completed. Only the last
+    4 KB of output, which is as far back as references can reach, and the
+    bytes of an unfinished token are kept between calls.
+
+    Once all of the output has been produced, eof is true and any further
+    input is collected in unused_data."""
+
+    window_size = 0x1000
+    # Input that has been used is only cut off the front of the buffer once
+    # there's at least this much of it, and no less than what's left, so
+    # feeding a large input in one go and reading it out in small pieces
+    # doesn't copy the rest of it every time.
+    compact_size = 0x10000
+
+    def __init__(self):
+        self.format = None
+        self.decompressed_size = None
+        self.produced = 0
+        self.consumed = 0
+        self.eof = False
+        self.unused_data = b''
+        # the flag byte being worked through and the bit for the next token
+        self.flags = 0
+        self.mask = 0
+        self.window = bytearray()
+        self.pending = bytearray()
+        # where the unused input in pending starts
+        self.offset = 0
+
+    @classmethod
+    def resume(cls, format, decompressed_size, checkpoint):
+        """Make a decompressor that carries on from a checkpoint().
+
+        Feed it the input from the checkpoint's input offset onwards."""
+        self = cls()
+        self.format = format
+        self.decompressed_size = decompressed_size
+        (self.produced, self.consumed, self.flags, self.mask,
+         window) = checkpoint
+        self.window = bytearray(window)
+        self.eof = self.produced == decompressed_size
+        return self
+
+    def checkpoint(self):
+        """The state needed to resume from here with resume().
+
+        A tuple of (output offset, input offset, flag byte, next flag bit,
+        window). Input after the input offset that has already been fed isn't
+        part of it."""
+        return (self.produced, self.consumed, self.flags, self.mask,
+                bytes(self.window))
+
+    def feed(self, data, max_length=0):
+        """Decompress some more input. Returns the bytes it completed.
+
+        If max_length isn't 0, stops at the first token boundary after
+        producing that many bytes. The rest of the input is kept, and a later
+        call (which may feed b'') carries on with it."""
+        if self.eof:
+            self.unused_data += bytes(data)
+            return b''
+
+        pending = self.pending
+        pending += data
+        if self.format is None:
+            header = bytes(pending[self.offset:self.offset + 4])
+            if len(header) < 4:
+                return b''
+            if header[0] not in (0x10, 0x11):
+                raise DecompressionError("not as lzss-compressed file")
+            self.format = header[0]
+            self.decompressed_size, = unpack("<L", header[1:4] + b'\x00')
+            self.offset += 4
+            self.consumed = 4
+
+        out = self.window
+        start = len(out)
+        # how far into the stream the end of out is
+        base = self.produced - start
+        remaining = self.decompressed_size - self.produced
+        limit = min(max_length or remaining, remaining)
+        end = len(pending)
+        lz11 = self.format == 0x11
+        flags = self.flags
+        mask = self.mask
+        inpos = self.offset
+
+        while len(out) - start < limit:
+            if not mask:
+                if inpos >= end:
+                    break
+                flags = pending[inpos]
+                inpos += 1
+                mask = 0x80
+            if flags & mask:
+                if inpos + 1 >= end:
+                    break
+                b = pending[inpos]
+                if not lz11:
+                    count = (b >> 4) + 3
+                    size = 2
+                elif b >> 4 == 0:
+                    size = 3
+                elif b >> 4 == 1:
+                    size = 4
                 else:
-                    # indicator is count (4 bits), 12 bit disp
-                    count = indicator
-                    count += 1
-
-                disp = ((b & 0xf) << 8) + readbyte()
-                disp += 1
-
-                try:
-                    for _ in range(count):
-                        writebyte(data[-disp])
-                except IndexError:
-                    raise Exception(count, disp, len(data), sum(1 for x in it) )
+                    count = (b >> 4) + 1
+                    size = 2
+                if inpos + size > end:
+                    break
+                if size == 3:
+                    count = (b << 4) + (pending[inpos + 1] >> 4) + 0x11
+                elif size == 4:
+                    count = (((b & 0xf) << 12) + (pending[inpos + 1] << 4) +
+                             (pending[inpos + 2] >> 4) + 0x111)
+                disp = ((pending[inpos + size - 2] & 0xf) << 8) + \
+                    pending[inpos + size - 1] + 1
+                inpos += size
+                pos = len(out)
+                if disp > base + pos:
+                    raise DecompressionError(
+                        "back-reference before the start of the data")
+                if pos - start + count > remaining:
+                    raise DecompressionError(
+                        "decompressed size does not match the expected size")
+                _copy_back(out, pos, disp, count)
             else:
-                raise ValueError(flag)
-
-            if decompressed_size <= len(data):
+                if inpos >= end:
+                    break
+                out.append(pending[inpos])
+                inpos += 1
+            mask >>= 1
+
+        self.flags = flags
+        self.mask = mask
+        self.consumed += inpos - self.offset
+        chunk = bytes(out[start:])
+        self.produced += len(chunk)
+        if len(out) > self.window_size:
+            del out[:len(out) - self.window_size]
+        if self.produced == self.decompressed_size:
+            self.eof = True
+            self.unused_data = bytes(pending[inpos:])
+            pending.clear()
+            inpos = 0
+        elif inpos >= self.compact_size and inpos >= end - inpos:
+            del pending[:inpos]
+            inpos = 0
+        self.offset = inpos
+        return chunk
+
+def decompress_stream(f, chunk_size=0x10000):
+    """Decompress an LZSS-compressed file a chunk at a time.
+
+    A generator yielding chunks of output as they are decoded, using constant
+    memory however large the file is."""
+    decompressor = Decompressor()
+    while not decompressor.eof:
+        data = f.read(chunk_size)
+        if not data:
+            raise DecompressionError("compressed data is truncated")
+        chunk = decompressor.feed(data)
+        if chunk:
+            yield chunk
+
+def build_checkpoints(data, interval=0x4000):
+    """Index LZSS-compressed bytes for decompress_range().
+
+    Decompresses the data once, taking a checkpoint at the first token
+    boundary at least `interval` bytes of output after the last one (or the
+    start). Checkpoints can't split a token, so they're `interval` apart plus
+    however far the token that reaches it runs over. Each checkpoint holds the
+    output offset, the input offset, the flag state and the 4 KB window before
+    it. Returns a dict, which pack_checkpoints() turns into bytes for caching."""
+    decompressor = Decompressor()
+    checkpoints = []
+    chunk = decompressor.feed(data, interval)
+    while not decompressor.eof:
+        if not chunk:
+            raise DecompressionError("compressed data is truncated")
+        checkpoints.append(decompressor.checkpoint())
+        chunk = decompressor.feed(b'', interval)
+
+    return {
+        'format': decompressor.format,
+        'decompressed_size': decompressor.decompressed_size,
+        'interval': interval,
+        'checkpoints': checkpoints,
+    }
+
+_CHECKPOINT_MAGIC = b'LZCP'
+_CHECKPOINT_HEADER = Struct('<4sBxxxIII')
+_CHECKPOINT = Struct('<IIBBH')
+
+def pack_checkpoints(index):
+    """Serialize an index from build_checkpoints() to bytes."""
+    out = bytearray(_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, index['format'],
+        index['decompressed_size'], index['interval'], len(index['checkpoints'])))
+    for (produced, consumed, flags, mask, window) in index['checkpoints']:
+        out += _CHECKPOINT.pack(produced, consumed, flags, mask, len(window))
+        out += window
+    return bytes(out)
+
+def unpack_checkpoints(data):
+    """Read an index serialized by pack_checkpoints()."""
+    magic, format, decompressed_size, interval, count = \
+        _CHECKPOINT_HEADER.unpack_from(data)
+    if magic != _CHECKPOINT_MAGIC:
+        raise ValueError("not a checkpoint index")
+    offset = _CHECKPOINT_HEADER.size
+    checkpoints = []
+    for _ in range(count):
+        produced, consumed, flags, mask, length = \
+            _CHECKPOINT.unpack_from(data, offset)
+        offset += _CHECKPOINT.size
+        window = bytes(data[offset:offset + length])
+        offset += length
+        checkpoints.append((produced, consumed, flags, mask, window))
+    return {
+        'format': format,
+        'decompressed_size': decompressed_size,
+        'interval': interval,
+        'checkpoints': checkpoints,
+    }
+
+def decompress_range(data, start, length, index=None):
+    """Decompress `length` bytes of output starting at `start`.
+
+    With an index from build_checkpoints() for the same data, decompression
+    resumes from the last checkpoint at or before `start` rather than from the
+    beginning, and stops as soon as the range is complete. Returns bytes."""
+    if index is None:
+        decompressor = Decompressor()
+        consumed = 0
+    else:
+        if start + length > index['decompressed_size']:
+            raise ValueError("range is past the end of the decompressed data")
+        checkpoints = index['checkpoints']
+        i = bisect_right([c[0] for c in checkpoints], start) - 1
+        if i < 0:
+            decompressor = Decompressor()
+            consumed = 0
+        else:
+            decompressor = Decompressor.resume(index['format'],
+                index['decompressed_size'], checkpoints[i])
+            consumed = checkpoints[i][1]
+
+    out = bytearray()
+    # where out starts in the output
+    offset = decompressor.produced
+    while offset + len(out) < start + length:
+        if decompressor.eof:
+            raise ValueError("range is past the end of the decompressed data")
+        chunk = data[consumed:consumed + 0x1000]
+        if not chunk:
+            raise DecompressionError("compressed data is truncated")
+        consumed += len(chunk)
+        out += decompressor.feed(chunk)
+        if offset + len(out) < start:
+            offset += len(out)
+            out.clear()
+    return bytes(out[start - offset:start - offset + length])
+
+
+def _decompress_overlay_into(indata, inpos, inend, out, pos, end, in_place=False):
+    """Decompress overlay data backwards, without reversing anything.
+
+    Overlays are LZ10 data that is read from the end towards the start, with
+    the output also written from the end, and displacements 3 bytes further
+    than LZ10. Compressed data is read from indata[inpos - 1] down to
+    indata[inend], and output is written from out[pos - 1] down to out[end].
+
+    With in_place, indata and out are the same buffer, as when the BIOS
+    decompresses an overlay where it was loaded. The output must then never
+    overwrite compressed data that hasn't been read yet."""
+    top = pos
+    while pos > end:
+        if inpos <= inend:
+            raise DecompressionError("compressed data is truncated")
+        inpos -= 1
+        flags = indata[inpos]
+        if flags == 0 and pos - 8 >= end and inpos - 8 >= inend:
+            # eight literals in a row, which are in the same order as the output
+            inpos -= 8
+            if in_place and pos - 8 < inpos:
+                raise DecompressionError("decompressed data overwrites compressed data")
+            out[pos - 8:pos] = indata[inpos:inpos + 8]
+            pos -= 8
+            continue
+        for mask in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if flags & mask:
+                if inpos - 2 < inend:
+                    raise DecompressionError("compressed data is truncated")
+                sh = (indata[inpos - 1] << 8) | indata[inpos - 2]
+                inpos -= 2
+                count = (sh >> 0xc) + 3
+                disp = (sh & 0xfff) + 3
+                if pos + disp > top:
+                    raise DecompressionError(
+                        "back-reference before the start of the data")
+                if pos - count < end:
+                    raise DecompressionError(
+                        "decompressed size does not match the expected size")
+                if in_place and pos - count < inpos:
+                    raise DecompressionError(
+                        "decompressed data overwrites compressed data")
+                start = pos - count
+                if disp >= count:
+                    out[start:pos] = out[start + disp:pos + disp]
+                else:
+                    # the copy overlaps its own output, so it repeats the
+                    # `disp` bytes above it
+                    pattern = bytes(out[pos:pos + disp])
+                    out[start:pos] = (pattern * (count // disp + 1))[-count:]
+                pos = start
+            else:
+                if inpos <= inend:
+                    raise DecompressionError("compressed data is truncated")
+                inpos -= 1
+                if in_place and pos - 1 < inpos:
+                    raise DecompressionError(
+                        "decompressed data overwrites compressed data")
+                pos -= 1
+                out[pos] = indata[inpos]
+
+            if pos <= end:
                 break
 
-    if len(data) != decompressed_size:
-        raise DecompressionError("decompressed size does not match the expected size")
-
-    return data
-
-
-def decompress_overlay(f, out):
-    # the compression header is at the end of the file
-    f.seek(-8, SEEK_END)
-    header = f.read(8)
-
-    # decompression goes backwards.
-    # end < here < start
+def _read_overlay_footer(footer, length):
+    """Reads the 8 bytes at the end of an overlay of `length` bytes.
 
+    Returns where the compressed data starts and ends, and how many bytes
+    longer the overlay is once decompressed."""
     # end_delta == here - decompression end address
     # start_delta == decompression start address - here
-    end_delta, start_delta = unpack("<LL", header)
-
-    filelen = f.tell()
-
+    if length < 8:
+        raise DecompressionError("overlay footer doesn't fit the file")
+    end_delta, start_delta = unpack("<LL", bytes(footer))
     padding = end_delta >> 0x18
     end_delta &= 0xFFFFFF
-    decompressed_size = start_delta + end_delta
-
-    f.seek(-end_delta, SEEK_END)
+    if end_delta > length or padding > end_delta:
+        raise DecompressionError("overlay footer doesn't fit the file")
+    return length - end_delta, length - padding, start_delta
+
+def decompress_overlay_in_place(buf, length):
+    """Decompress an overlay in place, the way the BIOS does.
+
+    buf is a writable buffer (a bytearray, mmap and so on) holding the
+    overlay in its first `length` bytes, with room after it for the
+    decompressed overlay. Returns the decompressed length."""
+    out = memoryview(buf).cast('B')
+    if out.readonly:
+        raise TypeError("buffer is read-only")
+    start, end, extra = _read_overlay_footer(out[length - 8:length], length)
+    if length + extra > out.nbytes:
+        raise ValueError("decompressed size {} is larger than the buffer "
+                         "({} bytes)".format(length + extra, out.nbytes))
+    _decompress_overlay_into(out, end, start, out, length + extra, start,
+                             in_place=True)
+    return length + extra
+
+def decompress_overlay_into(src, dst):
+    """Decompress an overlay into a separate writable buffer.
+
+    src is the whole overlay, as any bytes-like object, and is read where it
+    is, which makes an mmap of the file a good choice. The decompressed
+    overlay is written to the start of dst, which must be large enough.
+    Returns the decompressed length."""
+    with memoryview(src) as view, view.cast('B') as indata:
+        out = memoryview(dst).cast('B')
+        if out.readonly:
+            raise TypeError("destination is read-only")
+        length = indata.nbytes
+        start, end, extra = _read_overlay_footer(indata[length - 8:], length)
+        if length + extra > out.nbytes:
+            raise ValueError("decompressed size {} is larger than the destination "
+                             "({} bytes)".format(length + extra, out.nbytes))
+        # the part before the compressed data is left as it is
+        out[:start] = indata[:start]
+        _decompress_overlay_into(indata, end, start, out, length + extra, start)
+    return length + extra
 
-    data = bytearray()
-    data.extend(f.read(end_delta - padding))
-    data.reverse()
-
-    #stdout.write(data.tostring())
-
-    uncompressed_data = decompress_raw_lzss10(data, decompressed_size,
-                                              _overlay=True)
-    uncompressed_data.reverse()
+def decompress_overlay(f, out):
+    # map the file if possible, so the compressed data is read where it is
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError):
+        f.seek(0, SEEK_SET)
+        data = f.read()
 
-    # first we write up to the portion of the file which was "overwritten" by
-    # the decompressed data, then the decompressed data itself.
-    # i wonder if it's possible for decompression to overtake the compressed
-    # data, so that the decompression code is reading its own output...
-    f.seek(0, SEEK_SET)
-    out.write(f.read(filelen - end_delta))
-    out.write(uncompressed_data)
+    try:
+        # the compression header is at the end of the file
+        start, end, extra = _read_overlay_footer(data[-8:], len(data))
+        buf = bytearray(len(data) + extra)
+        decompress_overlay_into(data, buf)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    out.write(buf)
 
 def decompress(obj):
     """Decompress LZSS-compressed bytes or a file-like object.
@@ -180,36 +561,62 @@ def decompress(obj):
     else:
         return decompress_bytes(obj)
 
+def _read_header(data):
+    """Returns the format byte and decompressed size from an LZSS header."""
+    header = bytes(data[:4])
+    if len(header) < 4 or header[0] not in (0x10, 0x11):
+        raise DecompressionError("not as lzss-compressed file")
+    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+    return header[0], decompressed_size
+
 def decompress_bytes(data):
-    """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    header = data[:4]
-    if header[0] == 0x10:
+    """Decompress LZSS-compressed bytes. Returns a bytearray.
+
+    data can be any bytes-like object, including a memoryview into something
+    larger, such as a whole rom; it isn't copied."""
+    format, decompressed_size = _read_header(data)
+    if format == 0x10:
         decompress_raw = decompress_raw_lzss10
-    elif header[0] == 0x11:
-        decompress_raw = decompress_raw_lzss11
     else:
-        raise DecompressionError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+        decompress_raw = decompress_raw_lzss11
 
-    data = data[4:]
-    return decompress_raw(data, decompressed_size)
+    return decompress_raw(memoryview(data)[4:], decompressed_size)
+
+def decompress_into(src, dst):
+    """Decompress LZSS-compressed bytes into a writable buffer.
+
+    src is any bytes-like object, such as a memoryview of a rom starting at
+    the compressed data. dst is anything writable that supports the buffer
+    protocol: a bytearray, memoryview, contiguous NumPy array, shared memory
+    block, mmap and so on. The output is written to the start of dst, which
+    must be large enough for it. Returns the number of bytes written."""
+    format, decompressed_size = _read_header(src)
+    out = memoryview(dst).cast('B')
+    if out.readonly:
+        raise TypeError("destination is read-only")
+    if decompressed_size > out.nbytes:
+        raise ValueError("decompressed size {} is larger than the destination "
+                         "({} bytes)".format(decompressed_size, out.nbytes))
+
+    indata = memoryview(src).cast('B')[4:]
+    if format == 0x10:
+        _decompress_lzss10_into(indata, out, decompressed_size)
+    else:
+        _decompress_lzss11_into(indata, out, decompressed_size)
+    return decompressed_size
 
 def decompress_file(f):
     """Decompress an LZSS-compressed file. Returns a bytearray.
 
     This isn't any more efficient than decompress_bytes, as it reads
-    the entire file into memory. It is offered as a convenience.
+    the entire file into memory. It is offered as a convenience; use
+    decompress_stream to decompress large files in constant memory.
     """
-    header = f.read(4)
-    if header[0] == 0x10:
+    format, decompressed_size = _read_header(f.read(4))
+    if format == 0x10:
         decompress_raw = decompress_raw_lzss10
-    elif header[0] == 0x11:
-        decompress_raw = decompress_raw_lzss11
     else:
-        raise DecompressionError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+        decompress_raw = decompress_raw_lzss11
 
     data = f.read()
     return decompress_raw(data, decompressed_size)
@@ -249,7 +656,8 @@ def main(args=None):
         if overlay:
             decompress_overlay(f, stdout)
         else:
-            stdout.write(decompress_file(f))
+            for chunk in decompress_stream(f):
+                stdout.write(chunk)
     except IOError as e:
         if e.errno == EPIPE:
             # don't complain about a broken pipe
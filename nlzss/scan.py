@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Find LZ10/LZ11-compressed data in a rom.
+
+Every 4-byte aligned offset with an LZ10 or LZ11 header and a plausible
+decompressed size is a candidate. Candidates are then checked by reading
+through their tokens, without writing out any data, to make sure every
+reference points inside what has been decompressed so far and that the data
+ends at exactly the size in the header.
+"""
+
+import sys
+from sys import stderr, exit
+import argparse
+import json
+import mmap
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from verify import verify_buffer, VerificationError
+
+__all__ = ('find_candidates', 'check_candidate', 'scan', 'scan_file', 'main')
+
+MIN_SIZE = 0x20
+MAX_SIZE = 0x100000
+
+def find_candidates(data, min_size=MIN_SIZE, max_size=MAX_SIZE):
+    """Returns the aligned offsets in data that start with a plausible header.
+
+    The header bytes of every aligned offset are searched at once, as one
+    strided slice, and only the matches are looked at one by one. The first
+    token has to be a literal, as there's nothing for a reference to copy."""
+    candidates = []
+    for match in re.finditer(b'[\x10\x11]', data[0:len(data) - 4:4]):
+        offset = match.start() * 4
+        size = data[offset + 1] | (data[offset + 2] << 8) | (data[offset + 3] << 16)
+        if min_size <= size <= max_size and not data[offset + 4] & 0x80:
+            candidates.append(offset)
+    return candidates
+
+def check_candidate(data, offset):
+    """Check the compressed data at offset.
+
+    Returns the compressed size (header included) and the decompressed size,
+    or None if it isn't valid compressed data."""
+    try:
+        return verify_buffer(data, offset)
+    except VerificationError:
+        return None
+
+# Each worker process maps the rom itself rather than having it sent over.
+WORKER_DATA = None
+
+def _init_worker(path):
+    global WORKER_DATA
+    with open(path, 'rb') as f:
+        WORKER_DATA = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _check_batch(offsets):
+    return [(offset, check_candidate(WORKER_DATA, offset)) for offset in offsets]
+
+def _results(data, checked, overlapping):
+    """Turns (offset, check_candidate result) pairs into scan results."""
+    found = []
+    covered = 0
+    for offset, result in checked:
+        if result is None or (offset < covered and not overlapping):
+            continue
+        compressed_size, decompressed_size = result
+        found.append((offset, 'lz11' if data[offset] == 0x11 else 'lz10',
+                      compressed_size, decompressed_size))
+        covered = max(covered, offset + compressed_size)
+    return found
+
+def scan(data, min_size=MIN_SIZE, max_size=MAX_SIZE, overlapping=False):
+    """Find the compressed data in data.
+
+    Returns a list of (offset, format, compressed size, decompressed size),
+    with format 'lz10' or 'lz11'. Unless overlapping is true, anything that
+    starts inside something already found is left out: it's nearly always a
+    coincidence inside the compressed data."""
+    checked = ((offset, check_candidate(data, offset))
+               for offset in find_candidates(data, min_size, max_size))
+    return _results(data, checked, overlapping)
+
+def scan_file(path, min_size=MIN_SIZE, max_size=MAX_SIZE, overlapping=False,
+              jobs=1, batch_size=1000):
+    """The same as scan() for a file, checking candidates in jobs processes."""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        candidates = find_candidates(data, min_size, max_size)
+        if jobs <= 1:
+            checked = ((offset, check_candidate(data, offset))
+                       for offset in candidates)
+            return _results(data, checked, overlapping)
+
+        batches = [candidates[i:i + batch_size]
+                   for i in range(0, len(candidates), batch_size)]
+        with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                 initargs=(path,)) as pool:
+            checked = [c for batch in pool.map(_check_batch, batches)
+                       for c in batch]
+        return _results(data, checked, overlapping)
+    finally:
+        data.close()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('rom', help='the file to scan')
+    parser.add_argument('--min-size', type=lambda x: int(x, 0), default=MIN_SIZE,
+                        help='smallest decompressed size to look for '
+                             '(default: %(default)#x)')
+    parser.add_argument('--max-size', type=lambda x: int(x, 0), default=MAX_SIZE,
+                        help='largest decompressed size to look for '
+                             '(default: %(default)#x)')
+    parser.add_argument('--overlapping', action='store_true',
+                        help='include data found inside other compressed data')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='how many processes to check candidates with')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(args)
+
+    try:
+        found = scan_file(args.rom, args.min_size, args.max_size,
+                          args.overlapping, args.jobs)
+    except (IOError, ValueError) as e:
+        print(e, file=stderr)
+        return 2
+
+    if args.json:
+        json.dump([{'offset': offset, 'format': format,
+                    'compressed_size': compressed_size,
+                    'decompressed_size': decompressed_size}
+                   for offset, format, compressed_size, decompressed_size in found],
+                  sys.stdout, indent=1)
+        print()
+    else:
+        for offset, format, compressed_size, decompressed_size in found:
+            print("{:#08x} {} {:#x} -> {:#x}".format(
+                offset, format, compressed_size, decompressed_size))
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -1,10 +1,25 @@
 #!/usr/bin/env python3
 
 from lzss3 import (decompress_raw_lzss10, decompress_raw_lzss11,
-                   decompress_overlay, decompress)
-from compress import _compress, compress, compress_nlz11, NLZ11Window
+                   decompress_overlay, decompress_overlay_into,
+                   decompress_overlay_in_place, decompress, decompress_into,
+                   DecompressionError,
+                   Decompressor, decompress_stream, decompress_range,
+                   build_checkpoints, pack_checkpoints, unpack_checkpoints)
+from compress import (_compress, _compress_optimal, compress, compress_nlz11,
+                      compress_bytes,
+                      optimal_savings, NLZ11Window, NLZ10ChainWindow,
+                      NLZ11ChainWindow, LEVELS, _parallel_tokens)
 
-from io import BytesIO
+from io import BytesIO, StringIO
+from contextlib import redirect_stdout
+import os
+import random
+import tempfile
+import batch
+import scan
+import verify
+import bench_lzss3
 
 def test_lzss10():
     assert decompress_raw_lzss10(b'\x00', 0) == b''
@@ -18,12 +33,143 @@ def test_lzss11():
     assert decompress_raw_lzss11(b'\x08abcd\x01\x30\x03', 40) == b'abcd' * 10
     assert decompress_raw_lzss11(b'\x08abcd\x10\x07\xb0\x03', 400) == b'abcd' * 100
 
+def test_decompress_errors():
+    for decompress_raw in (decompress_raw_lzss10, decompress_raw_lzss11):
+        # truncated input
+        try:
+            decompress_raw(b'\x00abc', 8)
+            assert False
+        except DecompressionError:
+            pass
+        # back-reference before the start of the output
+        try:
+            decompress_raw(b'\x40a\x00\x05', 8)
+            assert False
+        except DecompressionError:
+            pass
+        # back-reference past the end of the output
+        try:
+            decompress_raw(b'\x40a\xf0\x00', 4)
+            assert False
+        except DecompressionError:
+            pass
+
+def test_decompressor():
+    for data in (b'\x10\x14\x00\x00\x08abcd\xd0\x03\xff',
+                 b'\x11\x90\x01\x00\x08abcd\x10\x07\xb0\x03\xff'):
+        decompressor = Decompressor()
+        out = b''.join(decompressor.feed(data[i:i + 1]) for i in range(len(data)))
+        assert out == decompress(data)
+        assert decompressor.eof
+        assert decompressor.unused_data == b'\xff'
+
+        assert b''.join(decompress_stream(BytesIO(data), 3)) == decompress(data)
+        try:
+            list(decompress_stream(BytesIO(data[:8])))
+            assert False
+        except DecompressionError:
+            pass
+
+def test_decompressor_compaction():
+    rand = random.Random(3)
+    indata = bytes(rand.choice(b'\x00\x11\x12\x21') for _ in range(0x2000))
+    data = compress_bytes(indata, 0x11) + b'\xff'
+    # all of the input at once, read out in small pieces, with the used input
+    # cut off the front of the buffer now and then
+    decompressor = Decompressor()
+    decompressor.compact_size = 0x40
+    chunks = [decompressor.feed(data, 0x30)]
+    consumed = [decompressor.consumed]
+    while not decompressor.eof:
+        chunks.append(decompressor.feed(b'', 0x30))
+        consumed.append(decompressor.consumed)
+        assert decompressor.offset < max(decompressor.compact_size,
+                                         len(decompressor.pending) // 2 + 1)
+    assert b''.join(chunks) == indata
+    assert decompressor.unused_data == data[consumed[-1]:]
+    assert consumed == sorted(consumed) and data.endswith(b'\xff')
+    # the checkpoints are the same as without compacting
+    assert [c[1] for c in build_checkpoints(data, 0x30)['checkpoints']] == \
+        consumed[:-1]
+
+def test_decompress_range():
+    rand = random.Random(0)
+    indata = bytes(rand.choice(b'\x00\x11\x12\x21') for _ in range(0x2000))
+    for compress_func in (compress, compress_nlz11):
+        out = BytesIO()
+        compress_func(indata, out)
+        data = out.getvalue()
+        index = build_checkpoints(data, 0x400)
+        assert len(index['checkpoints']) > 1
+        assert unpack_checkpoints(pack_checkpoints(index)) == index
+        for (start, length) in ((0, 10), (3000, 3000), (0x1ff0, 0x10)):
+            expected = indata[start:start + length]
+            assert decompress_range(data, start, length) == expected
+            assert decompress_range(data, start, length, index) == expected
+
+def test_checkpoint_spacing():
+    # long runs, so references often run past where a checkpoint is due
+    rand = random.Random(2)
+    indata = b''.join(bytes([rand.getrandbits(8)]) * rand.randrange(1, 200)
+                      for _ in range(200))
+    for compress_func, tokens in ((compress, verify.lz10_tokens),
+                                  (compress_nlz11, verify.lz11_tokens)):
+        out = BytesIO()
+        compress_func(indata, out)
+        data = out.getvalue()
+        boundaries = []
+        length = 0
+        for t, pos, flagpos in tokens(data[4:]):
+            length += t[0] if type(t) == tuple else 1
+            boundaries.append(length)
+            if length == len(indata):
+                break
+
+        for interval in (0x100, 0x400, 0x1000):
+            # the first token boundary at least interval past the last
+            # checkpoint, short of the end
+            expected = []
+            for boundary in boundaries[:-1]:
+                if boundary >= (expected[-1] if expected else 0) + interval:
+                    expected.append(boundary)
+            produced = [c[0] for c in build_checkpoints(data, interval)['checkpoints']]
+            assert produced == expected
+            assert any(p % interval for p in produced)
+
+def test_decompress_into():
+    data = b'\xff\x11\x90\x01\x00\x08abcd\x10\x07\xb0\x03'
+    out = bytearray(410)
+    assert decompress_into(memoryview(data)[1:], memoryview(out)[5:]) == 400
+    assert out == b'\x00' * 5 + b'abcd' * 100 + b'\x00' * 5
+    try:
+        decompress_into(data[1:], bytearray(399))
+        assert False
+    except ValueError:
+        pass
+
 def test_overlay():
     in_ = BytesIO(b'\x01\xd0abcd\x08\xff\x10\x00\x00\x09\x04\x00\x00\x00')
     out = BytesIO()
     decompress_overlay(in_, out)
     assert out.getvalue() == b'abcd' * 5
 
+    # into another buffer, with a prefix that isn't compressed, and in place
+    data = b'xyz\x01\xd0abcd\x08\xff\x10\x00\x00\x09\x04\x00\x00\x00'
+    dst = bytearray(30)
+    assert decompress_overlay_into(memoryview(data), dst) == 23
+    assert dst[:23] == b'xyz' + b'abcd' * 5
+    buf = bytearray(data) + bytearray(4)
+    assert decompress_overlay_in_place(buf, len(data)) == 23
+    assert buf == b'xyz' + b'abcd' * 5
+
+    # a reference past the end of the output
+    try:
+        decompress_overlay_into(b'\x11\xd0abcd' + data[9:], bytearray(30))
+    except DecompressionError:
+        pass
+    else:
+        assert False
+
 def test_compress():
     assert list(_compress(b'abcdabcd')) == [97, 98, 99, 100, (4, -4)]
     assert list(_compress(b'xaaabaaaaa')) == [120, 97, 97, 97, 98, (3, -4), 97, 97]
@@ -41,6 +187,255 @@ def test_compress():
     out = BytesIO()
     compress_nlz11(b'abcdefg' * 10, out)
     assert out.getvalue()[12:15] == b'\x02\xe0\x06'
+    assert compress_bytes(b'abcdefg' * 10, 0x11) == out.getvalue()
+
+    # output is written in blocks, with the flag bytes filled in before each
+    class Writes(list):
+        write = list.append
+    indata = random.Random(2).getrandbits(0x18000 * 8).to_bytes(0x18000, 'little')
+    for compress_func, format in ((compress, 0x10), (compress_nlz11, 0x11)):
+        writes = Writes()
+        compress_func(indata, writes, level=1)
+        assert 1 < len(writes) < 4
+        assert b''.join(writes) == compress_bytes(indata, format, level=1)
+        assert decompress(b''.join(writes)) == indata
+
+def test_hash_chain():
+    assert list(_compress(b'abcdabcd', NLZ10ChainWindow)) == [97, 98, 99, 100, (4, -4)]
+    assert list(_compress(b'a' + b'b' * 4095 + b'abb', NLZ10ChainWindow))[-1] == (3, -4096)
+    assert list(_compress(b'a' + b'b' * 4096 + b'abb', NLZ10ChainWindow))[-1] == 98
+    # disp 1 isn't allowed in LZ10
+    assert list(_compress(b'aaaaa', NLZ10ChainWindow)) == [97, 97, (3, -2)]
+    assert list(_compress(b'abcdefg' * 10, NLZ11ChainWindow)) == \
+        [97, 98, 99, 100, 101, 102, 103, (63, -7)]
+
+    # the same sizes as the exhaustive search, on data with long chains
+    rand = random.Random(0)
+    indata = bytes(rand.choice(b'\x00\x01') for _ in range(0x1000))
+    tokens = list(_compress(indata, NLZ11ChainWindow))
+    assert sum(t[0] if type(t) == tuple else 1 for t in tokens) == len(indata)
+    assert len(tokens) == len(list(_compress(indata, NLZ11Window)))
+
+def test_optimal():
+    # the longest match at 3 leaves two literals; a shorter one doesn't
+    assert list(_compress(b'aabaababa', NLZ10ChainWindow)) == \
+        [97, 97, 98, (4, -3), 98, 97]
+    assert list(_compress_optimal(b'aabaababa', NLZ10ChainWindow)) == \
+        [97, 97, 98, (3, -3), (3, -2)]
+
+    with open("lzss3.py", "rb") as f:
+        indata = f.read()
+    for compress_func in (compress, compress_nlz11):
+        out = BytesIO()
+        compress_func(indata, out, optimal=True)
+        assert decompress(out.getvalue()) == indata
+        greedy_size, optimal_size = optimal_savings(indata, compress_func)
+        assert optimal_size == len(out.getvalue())
+        assert optimal_size < greedy_size
+
+def test_levels():
+    with open("lzss3.py", "rb") as f:
+        indata = f.read()
+    for compress_func in (compress, compress_nlz11):
+        sizes = []
+        for level in sorted(LEVELS):
+            out = BytesIO()
+            compress_func(indata, out, level=level)
+            assert decompress(out.getvalue()) == indata
+            sizes.append(len(out.getvalue()))
+        assert sizes == sorted(sizes, reverse=True)
+        try:
+            compress_func(indata, BytesIO(), level=0)
+            assert False
+        except ValueError:
+            pass
+
+def test_parallel():
+    with open("lzss3.py", "rb") as f:
+        indata = f.read()
+    for windowclass in (NLZ10ChainWindow, NLZ11ChainWindow):
+        out = bytearray()
+        for t in _parallel_tokens(indata, windowclass, 3, 2, 0x1000):
+            if type(t) == tuple:
+                count, disp = t
+                assert -disp <= 0x1000
+                for _ in range(count):
+                    out.append(out[disp])
+            else:
+                out.append(t)
+        assert out == indata
+
+def test_batch():
+    with tempfile.TemporaryDirectory() as tmp:
+        compressed = os.path.join(tmp, 'compressed')
+        decompressed = os.path.join(tmp, 'decompressed')
+        with redirect_stdout(StringIO()) as out:
+            assert batch.main(['-c', 'lzss3.py', 'README.md', '-f', 'lz11',
+                               '-o', compressed, '-j', '1']) == 0
+            assert batch.main(['-c', 'lzss3.py', 'README.md', '-f', 'lz11',
+                               '-o', compressed, '-j', '1']) == 0
+            assert batch.main(['-d', compressed, '-o', decompressed,
+                               '-j', '1']) == 0
+        assert '0 files done, 2 unchanged' in out.getvalue()
+        for name in ('lzss3.py', 'README.md'):
+            with open(name, 'rb') as f, \
+                 open(os.path.join(decompressed, name), 'rb') as g:
+                assert f.read() == g.read()
+
+        # outputs that earlier runs didn't write are only replaced with
+        # --force, whichever way the files go
+        for (mode, src, dst, name) in (
+                ('-c', 'lzss3.py', compressed, 'lzss3.py.lz'),
+                ('-d', compressed, decompressed, 'lzss3.py')):
+            with open(os.path.join(dst, name), 'wb') as f:
+                f.write(b'not ours')
+            with redirect_stdout(StringIO()) as out:
+                assert batch.main([mode, src, '-o', dst, '-j', '1']) == 1
+            assert '1 not replaced' in out.getvalue()
+            with open(os.path.join(dst, name), 'rb') as f:
+                assert f.read() == b'not ours'
+            with redirect_stdout(StringIO()):
+                assert batch.main([mode, src, '-o', dst, '-j', '1',
+                                   '--force']) == 0
+            with open(os.path.join(dst, name), 'rb') as f:
+                assert f.read() != b'not ours'
+        with open(os.path.join(decompressed, 'lzss3.py'), 'rb') as f, \
+             open('lzss3.py', 'rb') as g:
+            assert f.read() == g.read()
+
+def test_scan():
+    rand = random.Random(0)
+    rom = bytearray(rand.getrandbits(8) for _ in range(0x4000))
+    indata = bytes(rand.choice(b'\x00\x11\x12\x21') for _ in range(0x200))
+    expected = []
+    for (offset, compress_func, format) in ((0x400, compress, 'lz10'),
+                                            (0x2000, compress_nlz11, 'lz11')):
+        out = BytesIO()
+        compress_func(indata, out)
+        rom[offset:offset + len(out.getvalue())] = out.getvalue()
+        expected.append((offset, format, len(out.getvalue()), len(indata)))
+    found = scan.scan(bytes(rom))
+    assert len(found) == len(expected)
+    for (offset, format, compressed_size, decompressed_size), e in zip(found, expected):
+        assert (offset, format, decompressed_size) == (e[0], e[1], e[3])
+        # the padding compress adds isn't part of the stream
+        assert 0 <= e[2] - compressed_size < 4
+
+    # truncated, a reference before the start, and the wrong size
+    assert scan.check_candidate(b'\x10\x08\x00\x00\x00abc', 0) is None
+    assert scan.check_candidate(b'\x10\x08\x00\x00\x40a\x00\x05', 0) is None
+    assert scan.check_candidate(b'\x10\x04\x00\x00\x40a\xf0\x00', 0) is None
+    assert scan.check_candidate(b'\x10\x14\x00\x00\x08abcd\xd0\x03', 0) == (11, 20)
+
+def test_verify():
+    rand = random.Random(1)
+    indata = bytes(rand.choice(b'ab\x00') for _ in range(0x400))
+    for compress_func, tokens in ((compress, verify.lz10_tokens),
+                                  (compress_nlz11, verify.lz11_tokens)):
+        out = BytesIO()
+        compress_func(indata, out)
+        data = out.getvalue()
+        consumed, size = verify.verify_bytes(data)
+        assert size == len(indata)
+        assert 0 <= len(data) - consumed < 4
+        assert verify.verify_buffer(b'junk' + data, 4) == (consumed, size)
+        verify.verify_tokens(tokens(data[4:]), size)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            assert verify.verify_file(f) == (consumed, size)
+
+        for bad in (data[:consumed - 1], data[:4] + b'\x80\x00\x00' + data[7:]):
+            try:
+                verify.verify_bytes(bad)
+            except verify.VerificationError:
+                pass
+            else:
+                assert False
+
+def lz11_run(count, disp=1, size=None):
+    """An LZ11 stream of a literal followed by one reference of count bytes,
+    using the shortest form of reference that holds count."""
+    d = disp - 1
+    if count <= 0x10:
+        ref = bytes([((count - 1) << 4) | (d >> 8), d & 0xff])
+    elif count <= 0x110:
+        c = count - 0x11
+        ref = bytes([c >> 4, ((c & 0xf) << 4) | (d >> 8), d & 0xff])
+    else:
+        c = count - 0x111
+        ref = bytes([0x10 | (c >> 12), (c >> 4) & 0xff,
+                     ((c & 0xf) << 4) | (d >> 8), d & 0xff])
+    if size is None:
+        size = 1 + count
+    return bytes([0x11]) + size.to_bytes(3, 'little') + b'\x40x' + ref
+
+def test_verify_lz11_forms():
+    # a count in 4 bits, 8 bits with the 0 indicator, and 16 bits with the 1
+    for count in (3, 0x10, 0x11, 0x110, 0x111, 0x10110):
+        data = lz11_run(count)
+        assert verify.verify_bytes(data) == (len(data), 1 + count)
+        verify.verify_tokens(verify.lz11_tokens(data[4:]), 1 + count)
+        assert decompress_raw_lzss11(data[4:], 1 + count) == b'x' * (1 + count)
+
+        # every cut through the reference is truncated
+        for end in range(6, len(data)):
+            try:
+                verify.verify_bytes(data[:end])
+            except verify.VerificationError as e:
+                assert 'truncated' in str(e)
+            else:
+                assert False
+
+        # a header that doesn't match what the tokens produce
+        for size in (count, 2 + count):
+            try:
+                verify.verify_bytes(lz11_run(count, size=size))
+            except verify.VerificationError as e:
+                assert ('truncated' if size > 1 + count else 'size') in str(e)
+            else:
+                assert False
+
+        # a reference from before the start of the data
+        try:
+            verify.verify_bytes(lz11_run(count, disp=2))
+        except verify.VerificationError as e:
+            assert 'disp' in str(e)
+        else:
+            assert False
+
+def test_bench():
+    for kind in bench_lzss3.CORPORA:
+        data = bench_lzss3.make_corpus(kind, 0x1000)
+        assert len(data) == 0x1000
+        assert data == bench_lzss3.make_corpus(kind, 0x1000)
+        overlay = bench_lzss3.make_overlay(data)
+        if kind == 'random':
+            assert overlay is None
+        else:
+            out = BytesIO()
+            decompress_overlay(BytesIO(overlay), out)
+            assert out.getvalue() == data
+
+    results = bench_lzss3.run(corpora=('text',), sizes=(0x400,), repeat=1,
+                              min_time=0)
+    assert sorted(results) == sorted('{}/text/1024'.format(b)
+                                     for b in bench_lzss3.BENCHMARKS)
+    assert 0 < results['compress/text/1024']['ratio'] < 1
+    faster = {key: {'mb_per_s': result['mb_per_s'] * 2, 'ratio': result['ratio']}
+              for key, result in results.items()}
+    assert bench_lzss3.compare(results, results) == []
+    assert sorted(bench_lzss3.compare(results, faster)) == sorted(results)
+    assert bench_lzss3.compare(results, faster, threshold=0.6) == []
+
+    args = ['-b', 'compress', '-c', 'text', '-s', '1K', '-r', '1']
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'baseline.json')
+        with redirect_stdout(StringIO()):
+            assert bench_lzss3.main(args + ['-l', '1', '--save', path]) == 0
+            assert bench_lzss3.main(args + ['-l', '3', '--compare', path]) == 2
+            assert bench_lzss3.main(args + ['-l', '1', '--compare', path,
+                                            '--threshold', '1']) == 0
 
 def test_roundtrip():
     #assert False
@@ -67,6 +462,21 @@ def test_roundtrip():
 if __name__ == '__main__':
     test_lzss10()
     test_lzss11()
+    test_decompress_errors()
+    test_decompressor()
+    test_decompressor_compaction()
+    test_decompress_range()
+    test_checkpoint_spacing()
+    test_decompress_into()
     test_overlay()
     test_compress()
+    test_hash_chain()
+    test_optimal()
+    test_levels()
+    test_parallel()
+    test_batch()
+    test_scan()
+    test_verify()
+    test_verify_lz11_forms()
+    test_bench()
     test_roundtrip()
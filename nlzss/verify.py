@@ -5,6 +5,7 @@ from sys import stdin, stdout, stderr, exit
 from os import SEEK_SET, SEEK_CUR, SEEK_END
 from errno import EPIPE
 from struct import pack, unpack
+import mmap
 
 class DecompressionError(ValueError):
     pass
@@ -74,14 +75,50 @@ def decompress_raw_lzss10(indata, decompressed_size, _overlay=False):
 
     return data
 
+def lz10_tokens(indata):
+    """Generates the tokens in raw LZ10 data, as (token, pos, flagpos).
+
+    A token is a byte (int) or a tuple of (count, displacement), as _compress
+    in compress.py makes them. pos and flagpos are where the token and its
+    flag byte are, counting the 4-byte header."""
+    it = iter(indata)
+    i = 4
+
+    def readbyte():
+        nonlocal i
+        i += 1
+        try:
+            return next(it)
+        except StopIteration:
+            raise VerificationError(
+                "compressed data is truncated. pos: {:#x}".format(i - 1))
+
+    while True:
+        flagpos = i
+        flags = bits(readbyte())
+        for flag in flags:
+            pos = i
+            if flag == 0:
+                yield readbyte(), pos, flagpos
+            else:
+                sh = (readbyte() << 8) | readbyte()
+                count = (sh >> 0xc) + 3
+                disp = (sh & 0xfff) + 1
+                yield (count, -disp), pos, flagpos
+
 def lz11_tokens(indata):
+    """Generates the tokens in raw LZ11 data, as lz10_tokens does."""
     it = iter(indata)
     i = 4
 
     def readbyte():
         nonlocal i
         i += 1
-        return next(it)
+        try:
+            return next(it)
+        except StopIteration:
+            raise VerificationError(
+                "compressed data is truncated. pos: {:#x}".format(i - 1))
 
     while True:
         flagpos = i
@@ -119,13 +156,80 @@ def lz11_tokens(indata):
             else:
                 raise ValueError(flag)
 
+def verify_buffer(data, offset=0):
+    """Verify the LZSS-compressed data starting at data[offset].
+
+    Reads through the tokens without decompressing anything, checking that
+    every displacement points inside what has been produced so far, and that
+    the data ends at exactly the decompressed size in the header without
+    running off the end of data. data can be anything indexable by byte,
+    like bytes, a memoryview or an mmap.
+
+    Returns the compressed length used (header included) and the decompressed
+    size. Raises VerificationError on error."""
+    if len(data) < offset + 4 or data[offset] not in (0x10, 0x11):
+        raise VerificationError("not as lzss-compressed file")
+    lz11 = data[offset] == 0x11
+    size = data[offset + 1] | (data[offset + 2] << 8) | (data[offset + 3] << 16)
+    end = len(data)
+    pos = offset + 4
+    length = 0
+    try:
+        while length < size:
+            flagpos = pos
+            flags = data[pos]
+            pos += 1
+            for mask in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if not flags & mask:
+                    pos += 1
+                    length += 1
+                else:
+                    tokenpos = pos
+                    b = data[pos]
+                    indicator = b >> 4
+                    if not lz11:
+                        count = indicator + 3
+                        pos += 2
+                    elif indicator == 0:
+                        count = (b << 4) + (data[pos + 1] >> 4) + 0x11
+                        b = data[pos + 1]
+                        pos += 3
+                    elif indicator == 1:
+                        count = (((b & 0xf) << 12) + (data[pos + 1] << 4) +
+                                 (data[pos + 2] >> 4) + 0x111)
+                        b = data[pos + 2]
+                        pos += 4
+                    else:
+                        count = indicator + 1
+                        pos += 2
+                    disp = ((b & 0xf) << 8) + data[pos - 1] + 1
+                    if disp > length:
+                        raise VerificationError(
+                            "disp too large. length: {:#x}, disp: {:#x}, pos: {:#x}, flagpos: {:#x}"
+                            .format(length, -disp, tokenpos - offset, flagpos - offset))
+                    length += count
+                if length >= size:
+                    break
+    except IndexError:
+        pos = end + 1
+    if pos > end:
+        raise VerificationError(
+            "compressed data is truncated. got: {:#x} bytes, expected: {:#x}".format(
+                length, size))
+    if length != size:
+        raise VerificationError(
+            "decompressed size does not match. got: {:#x}, expected: {:#x}".format(
+                length, size))
+    return pos - offset, size
+
 def verify(obj):
     """Verify LZSS-compressed bytes or a file-like object.
 
     Shells out to verify_file() or verify_bytes() depending on
     whether or not the passed-in object has a 'read' attribute or not.
 
-    Returns None on success. Raises an exception on error."""
+    Returns the compressed length used and the decompressed size. Raises an
+    exception on error."""
     if hasattr(obj, 'read'):
         return verify_file(obj)
     else:
@@ -134,45 +238,32 @@ def verify(obj):
 def verify_bytes(data):
     """Verify LZSS-compressed bytes.
 
-    Returns None on success. Raises an exception on error.
+    Returns the compressed length used and the decompressed size. Raises an
+    exception on error.
     """
-    header = data[:4]
-    if header[0] == 0x10:
-        tokenize = lz10_tokens
-    elif header[0] == 0x11:
-        tokenize = lz11_tokens
-    else:
-        raise VerificationError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
-
-    data = data[4:]
-    tokens = tokenize(data, decompressed_size)
-    return verify_tokens(tokens)
+    return verify_buffer(data)
 
 def verify_file(f):
     """Verify an LZSS-compressed file.
 
-    Returns None on success. Raises an exception on error.
+    Files on disk are mapped rather than read into memory. Returns the
+    compressed length used and the decompressed size. Raises an exception on
+    error.
     """
-    header = f.read(4)
-    if header[0] == 0x10:
-        tokenize = lz10_tokens
-    elif header[0] == 0x11:
-        tokenize = lz11_tokens
-    else:
-        raise VerificationError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
-
-    data = f.read()
-    tokens = tokenize(data)
-    return verify_tokens(tokens, decompressed_size)
+    try:
+        start = f.tell()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError):
+        # BytesIO, pipes, empty files and the like can't be mapped
+        return verify_buffer(f.read())
+    with data:
+        return verify_buffer(data, start)
 
 def verify_tokens(tokens, decompressed_length):
     length = 0
-    for t in tokens:
-        t, pos, flagpos = t
+    tokens = iter(tokens)
+    while length < decompressed_length:
+        t, pos, flagpos = next(tokens)
         if type(t) == tuple:
             count, disp = t
             assert disp < 0
@@ -185,9 +276,6 @@ def verify_tokens(tokens, decompressed_length):
         else:
             length += 1
 
-        if length >= decompressed_length:
-            break
-
     if length != decompressed_length:
         raise VerificationError(
             "decompressed size does not match. got: {:#x}, expected: {:#x}".format(
@@ -207,13 +295,22 @@ def dump_file(f):
     data = f.read()
     tokens = tokenize(data)
     def dump():
+        length = 0
         for t, pos, flagpos in tokens:
             if type(t) == tuple:
                 yield t
+                length += t[0]
+            else:
+                length += 1
+            if length >= decompressed_size:
+                break
     from pprint import pprint
     pprint(list(dump()))
 
 def main(args=None):
+    """Verify each file given (stdin if none) and print the result for each.
+
+    With --dump, prints the references in a file instead."""
     if args is None:
         args = sys.argv[1:]
 
@@ -223,33 +320,46 @@ def main(args=None):
     else:
         overlay = False
 
-    if len(args) < 1 or args[0] == '-':
-        if overlay:
-            print("Can't verify overlays from stdin", file=stderr)
-            return 2
-
-        if hasattr(stdin, 'detach'):
-            f = stdin.detach()
-        else:
-            f = stdin
+    if '--dump' in args:
+        args.remove('--dump')
+        dump = True
     else:
+        dump = False
+
+    if overlay:
+        print("Can't verify overlays", file=stderr)
+        return 2
+
+    if not args:
+        args = ['-']
+
+    failed = 0
+    for path in args:
         try:
-            f = open(args[0], "rb")
+            if path == '-':
+                f = stdin.buffer if hasattr(stdin, 'buffer') else stdin
+            else:
+                f = open(path, "rb")
         except IOError as e:
             print(e, file=stderr)
-            return 2
-
-    try:
-        if overlay:
-            print("Can't verify overlays", file=stderr)
-        else:
-            #verify_file(f)
-            dump_file(f)
-    except (VerificationError,) as e:
-        print(e, file=stderr)
-        return 1
+            failed += 1
+            continue
 
-    return 0
+        try:
+            if dump:
+                dump_file(f)
+            else:
+                compressed_length, decompressed_size = verify_file(f)
+                print("{}: ok, {:#x} bytes -> {:#x} bytes".format(
+                    path, compressed_length, decompressed_size))
+        except VerificationError as e:
+            print("{}: {}".format(path, e), file=stderr)
+            failed += 1
+        finally:
+            if f is not stdin and path != '-':
+                f.close()
+
+    return 1 if failed else 0
 
 
 
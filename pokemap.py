@@ -1,24 +1,38 @@
 #!/usr/bin/env python3.3
 
+import nlzss.compress
 import nlzss.lzss3
-import pygame
 import struct
 import sys
 import argparse
+import bisect
+import concurrent.futures
+import hashlib
+import io
+import json
+import mmap
 import os
+import queue
+import re
+import threading
+import time
 
 DEBUG_MODE = False
 def debug(*args, **kwargs):
   if DEBUG_MODE:
     print(*args, **kwargs)
 
+# pygame (and NumPy, for that renderer) are only imported by the code that
+# draws, so the commands that just read the rom start quickly.
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
 
-  parser = argparse.ArgumentParser(description="do a wee bit o' data rippin from a rom")
-  parser.add_argument("-v", "--verbose",
-                      help="Print information while running to help debug", action="store_true",
-                      dest="verbose")
-  parser.add_argument('rom_file', metavar='rom', type=str,
+  parser = argparse.ArgumentParser(description="do a wee bit o' data rippin from a rom",
+                                   epilog="Other commands: {}. Run `{} COMMAND --help` "
+                                          "for more.".format(', '.join(sorted(COMMANDS)),
+                                                             sys.argv[0]))
+  parser.add_argument('rom_file', metavar='rom', type=str, nargs='?',
                        help='a fire red rom')
   parser.add_argument("-o","--outfile",
                       help="Specify the output file name/extension",
@@ -27,25 +41,73 @@ def main():
   parser.add_argument("--headless",
                       help="Run the script in headless mode (no gui!)",
                       action="store_true")
+  add_rom_arguments(parser)
+  parser.add_argument("--layers",
+                      help="Also write the bottom, top and collision layers as "
+                           "separate images next to the output file",
+                      action="store_true")
+  parser.add_argument("-j", "--jobs", type=int, default=0,
+                      help="Decompress tilesets in this many worker processes "
+                           "while drawing (default: draw everything in order "
+                           "on one process)")
+  parser.add_argument("--backend",
+                      help="Which renderer to draw with (default: {}). The "
+                           "banded and disk strategies always draw with the "
+                           "{} renderer".format(REFERENCE_RENDERER,
+                                                BufferRenderer.name),
+                      choices=sorted(RENDERERS))
+  parser.add_argument("--verify-backend", metavar='BACKEND',
+                      help="Instead of saving an image, draw every map with the "
+                           "reference renderer and BACKEND and check that the "
+                           "pixels match",
+                      choices=sorted(RENDERERS))
+  parser.add_argument("--diff", nargs=2, metavar=('OLD', 'NEW'),
+                      help="Instead of drawing the world, draw the maps that "
+                           "differ between two roms side by side, with the "
+                           "changed pixels highlighted")
+  parser.add_argument("--world-index", metavar='BASENAME',
+                      help="Also write the world index (map placements, names and "
+                           "connections) to BASENAME.json and BASENAME.bin")
+  parser.add_argument("--max-memory", metavar='SIZE', type=parse_size,
+                      help="Keep under SIZE of memory (e.g. 512M or 2G) by "
+                           "drawing the world in bands, or on a canvas on disk, "
+                           "when it won't fit in memory. Reports the peak "
+                           "resident memory, which includes pygame's surfaces. "
+                           "With -v, Python's own allocations are traced and "
+                           "reported too, which slows drawing down")
+  parser.add_argument("--strategy", choices=STRATEGIES,
+                      help="Draw with this strategy instead of picking the one "
+                           "that fits --max-memory")
   args = parser.parse_args()
+  if (args.rom_file is None) == (args.diff is None):
+    parser.error('give either a rom or --diff OLD NEW')
+  if args.max_memory and args.verbose:
+    # Tracing every allocation is slow, so it's only done to debug.
+    import tracemalloc
+    tracemalloc.start()
 
   if args.headless:
-    import os
     os.environ["SDL_VIDEODRIVER"] = "dummy" #this works on my ubuntu machine, but untested on others.
 
   global DEBUG_MODE
   if args.verbose:
     DEBUG_MODE = True
 
+  import pygame
+  if args.diff:
+    pygame.init()
+    sys.exit(diff_roms(args))
+
   bytes = load_rom(args.rom_file)
-  strings = load_strings(bytes, '0x3eecfc')
-  debug('Found all these strings: {}'.format([x.encode('utf-8') for x in strings]))
-  banks = load_maps(bytes, '0x3526A8')
+  (strings, banks) = load_world(bytes, args)
   offsets = calculate_map_offsets(banks, 3, 0)
-  min_x = min([x for ((m, b), (x, y)) in offsets])
-  min_y = min([y for ((m, b), (x, y)) in offsets])
-  max_x = max([x + banks[m][b]['width'] for ((m, b), (x, y)) in offsets])
-  max_y = max([y + banks[m][b]['height'] for ((m, b), (x, y)) in offsets])
+  (min_x, min_y, max_x, max_y) = calculate_bounds(banks, offsets)
+
+  if args.world_index:
+    index = build_world_index(banks, offsets, strings)
+    save_world_index(index, args.world_index)
+    debug('Wrote world index for {} maps to {}.json/.bin'.format(
+      len(index['maps']), args.world_index))
 
   width = (max_x - min_x) * 16
   height = (max_y - min_y) * 16
@@ -53,52 +115,151 @@ def main():
   y_orig = min_y * 16
 
   pygame.init()
+
+  if args.verify_backend:
+    sys.exit(verify_backend(bytes, banks, offsets, args.verify_backend))
+
+  backend = args.backend or REFERENCE_RENDERER
+  (strategy, band_height) = choose_strategy(args.max_memory, len(bytes), width,
+    height, backend, args.layers, args.strategy)
+  if args.max_memory or args.strategy:
+    estimate = estimate_memory(len(bytes), width, height, strategy, backend,
+      args.layers, band_height)
+    print('Drawing {}x{} with the {} strategy{}, expecting to use {}'.format(
+      width, height, strategy, ' ({} rows at a time)'.format(band_height)
+      if strategy != 'memory' else '', format_size(estimate)))
+    if args.max_memory and estimate > args.max_memory:
+      print('That is over the {} budget, which is too small for a world this '
+        'size'.format(format_size(args.max_memory)))
+  if strategy != 'memory':
+    if args.layers:
+      parser.error('--layers needs the whole world in memory')
+    if args.backend not in (None, BufferRenderer.name):
+      parser.error('the {} strategy always draws with the {} renderer'.format(
+        strategy, BufferRenderer.name))
+    if os.path.splitext(args.outfile)[1][1:] not in IMAGE_WRITER_FORMATS:
+      parser.error('the {} strategy can only write {}'.format(strategy,
+        ', '.join(IMAGE_WRITER_FORMATS)))
+    if args.headless:
+      print("Working!...")
+    dedup = draw_world_streaming(args.outfile, strategy, band_height, bytes,
+      args.rom_file, banks, offsets, (min_x, min_y), (width, height), args.jobs)
+    if dedup is not None:
+      print(dedup_summary(dedup))
+    report_peak_memory()
+    if args.headless:
+      print("done!")
+    pygame.quit()
+    return
+
   screen = pygame.display.set_mode((width, height))
-  screen.fill((255, 0, 255))
-  screen.set_colorkey((255, 0, 255))
+  screen.fill(BACKGROUND)
+  screen.set_colorkey(BACKGROUND)
+  renderer = RENDERERS[backend]()
+  canvas = renderer.new_canvas(width, height, screen)
+
+  layers = None
+  if args.layers:
+    # The merged image is drawn in the same pass as the layers, so maps that
+    # overlap cover each other exactly as they do without --layers.
+    layers = {None: canvas}
+    for layer in LAYERS:
+      layers[layer] = renderer.new_canvas(width, height)
 
   if args.headless:
     print("Working!...")
 
-  for ((m, b), (x, y)) in offsets:
-    draw_map(screen, bytes, banks[m][b]['map_data'], (x - min_x) * 16, (y - min_y) * 16)
-    pygame.display.flip()
+  tileset_cache = {}
+  dedup = new_dedup()
+  if args.jobs > 0:
+    drawn = draw_maps_pipelined(canvas, bytes, args.rom_file, banks, offsets,
+      (min_x, min_y), layers, tileset_cache, renderer, dedup, args.jobs)
+  else:
+    drawn = draw_maps(canvas, bytes, banks, offsets, (min_x, min_y), layers,
+      tileset_cache, renderer, dedup)
+  for map_id in drawn:
+    if canvas is screen:
+      pygame.display.flip()
+  print(dedup_summary(dedup))
+
+  if layers:
+    (base, ext) = os.path.splitext(args.outfile)
+    for layer in LAYERS:
+      pygame.image.save(renderer.to_surface(layers[layer]).convert_alpha(),
+        '{}_{}{}'.format(base, layer, ext))
+  if canvas is not screen:
+    screen.blit(renderer.to_surface(canvas), (0, 0))
+  pygame.display.flip()
 
   screen = screen.convert_alpha()
   pygame.image.save(screen, args.outfile)
+  if args.max_memory or args.strategy:
+    report_peak_memory()
   if args.headless:
     print("done!")
 
   pygame.quit()
 
+# The arguments every command takes for reading a rom.
+def add_rom_arguments(parser):
+  parser.add_argument("-v", "--verbose",
+                      help="Print information while running to help debug", action="store_true",
+                      dest="verbose")
+  parser.add_argument("--names-offset", metavar='HEX',
+                      help="Offset of the map name strings (found automatically "
+                           "if not given)")
+  parser.add_argument("--banks-offset", metavar='HEX',
+                      help="Offset of the map bank table (found automatically "
+                           "if not given)")
+  parser.add_argument("--bank-count", type=int,
+                      help="Number of map banks to read (found automatically "
+                           "if not given)")
+  parser.add_argument("--offset-cache", metavar='FILE',
+                      help="Where to cache the offsets found for each rom",
+                      default=os.path.join(os.path.expanduser('~'), '.cache',
+                        'pokemap', 'offsets.json'))
+
 def load_rom(rom_path):
   return open(rom_path, 'rb').read()
 
+# Returns the map names and map banks of a rom. `rom_offsets` are the offsets
+# find_offsets returns, which are looked up if not given.
+def load_world(bytes, args, rom_offsets=None):
+  if rom_offsets is None:
+    rom_offsets = find_offsets(bytes, args)
+  strings = []
+  if rom_offsets['names'] is not None:
+    strings = load_strings(bytes, rom_offsets['names'])
+  debug('Found all these strings: {}'.format([x.encode('utf-8') for x in strings]))
+  banks = load_maps(bytes, rom_offsets['banks'], rom_offsets['bank_count'])
+  return (strings, banks)
+
+TEXT_TABLE = {
+  0x00:' ',0x01:'À',0x02:'Á',0x03:'Â',0x04:'Ç',0x05:'È',0x06:'É',0x07:'Ê',
+  0x08:'Ë',0x09:'Ì',0x0B:'Î',0x0C:'Ï',0x0D:'Ò',0x0E:'Ó',0x0F:'Ô',0x10:'Œ',
+  0x11:'Ù',0x12:'Ú',0x13:'Û',0x14:'Ñ',0x15:'ß',0x16:'à',0x17:'á',0x19:'ç',
+  0x1A:'è',0x1B:'é',0x1C:'ê',0x1D:'ë',0x1E:'ì',0x20:'î',0x21:'ï',0x22:'ò',
+  0x23:'ó',0x24:'ô',0x25:'œ',0x26:'ù',0x27:'ú',0x28:'û',0x29:'ñ',0x2A:'º',
+  0x2B:'ª',0x2D:'&',0x2E:'+',0x34:'[Lv]',0x35:'=',0x36:';',0x51:'¿',0x52:'¡',
+  0x53:'[pk]',0x54:'[mn]',0x55:'[po]',0x56:'[ké]',0x57:'[bl]',0x58:'[oc]',
+  0x59:'[k]',0x5A:'Í',0x5B:'%',0x5C:'(',0x5D:')',0x68:'â',0x6F:'í',0x79:'[U]',
+  0x7A:'[D]',0x7B:'[L]',0x7C:'[R]',0x85:'<',0x86:'>',0xA1:'0',0xA2:'1',
+  0xA3:'2',0xA4:'3',0xA5:'4',0xA6:'5',0xA7:'6',0xA8:'7',0xA9:'8',0xAA:'9',
+  0xAB:'!',0xAC:'?',0xAD:'.',0xAE:'-',0xAF:'·',0xB0:'...',0xB1:'«',0xB2:'»',
+  0xB3:'\'',0xB4:'\'',0xB5:'|m|',0xB6:'|f|',0xB7:'$',0xB8:',',0xB9:'*',
+  0xBA:'/',0xBB:'A',0xBC:'B',0xBD:'C',0xBE:'D',0xBF:'E',0xC0:'F',0xC1:'G',
+  0xC2:'H',0xC3:'I',0xC4:'J',0xC5:'K',0xC6:'L',0xC7:'M',0xC8:'N',0xC9:'O',
+  0xCA:'P',0xCB:'Q',0xCC:'R',0xCD:'S',0xCE:'T',0xCF:'U',0xD0:'V',0xD1:'W',
+  0xD2:'X',0xD3:'Y',0xD4:'Z',0xD5:'a',0xD6:'b',0xD7:'c',0xD8:'d',0xD9:'e',
+  0xDA:'f',0xDB:'g',0xDC:'h',0xDD:'i',0xDE:'j',0xDF:'k',0xE0:'l',0xE1:'m',
+  0xE2:'n',0xE3:'o',0xE4:'p',0xE5:'q',0xE6:'r',0xE7:'s',0xE8:'t',0xE9:'u',
+  0xEA:'v',0xEB:'w',0xEC:'x',0xED:'y',0xEE:'z',0xEF:'|>|',0xF0:':',0xF1:'Ä',
+  0xF2:'Ö',0xF3:'Ü',0xF4:'ä',0xF5:'ö',0xF6:'ü',0xF7:'|A|',0xF8:'|V|',
+  0xF9:'|<|',0xFA:'|nb|',0xFB:'|nb2|',0xFC:'|FC|',0xFD:'|FD|',0xFE:'|br|',
+}
+
 def load_strings(bytes, hex_offset):
   offset = int(hex_offset, 16)
-  table = {
-    0x00:' ',0x01:'À',0x02:'Á',0x03:'Â',0x04:'Ç',0x05:'È',0x06:'É',0x07:'Ê',
-    0x08:'Ë',0x09:'Ì',0x0B:'Î',0x0C:'Ï',0x0D:'Ò',0x0E:'Ó',0x0F:'Ô',0x10:'Œ',
-    0x11:'Ù',0x12:'Ú',0x13:'Û',0x14:'Ñ',0x15:'ß',0x16:'à',0x17:'á',0x19:'ç',
-    0x1A:'è',0x1B:'é',0x1C:'ê',0x1D:'ë',0x1E:'ì',0x20:'î',0x21:'ï',0x22:'ò',
-    0x23:'ó',0x24:'ô',0x25:'œ',0x26:'ù',0x27:'ú',0x28:'û',0x29:'ñ',0x2A:'º',
-    0x2B:'ª',0x2D:'&',0x2E:'+',0x34:'[Lv]',0x35:'=',0x36:';',0x51:'¿',0x52:'¡',
-    0x53:'[pk]',0x54:'[mn]',0x55:'[po]',0x56:'[ké]',0x57:'[bl]',0x58:'[oc]',
-    0x59:'[k]',0x5A:'Í',0x5B:'%',0x5C:'(',0x5D:')',0x68:'â',0x6F:'í',0x79:'[U]',
-    0x7A:'[D]',0x7B:'[L]',0x7C:'[R]',0x85:'<',0x86:'>',0xA1:'0',0xA2:'1',
-    0xA3:'2',0xA4:'3',0xA5:'4',0xA6:'5',0xA7:'6',0xA8:'7',0xA9:'8',0xAA:'9',
-    0xAB:'!',0xAC:'?',0xAD:'.',0xAE:'-',0xAF:'·',0xB0:'...',0xB1:'«',0xB2:'»',
-    0xB3:'\'',0xB4:'\'',0xB5:'|m|',0xB6:'|f|',0xB7:'$',0xB8:',',0xB9:'*',
-    0xBA:'/',0xBB:'A',0xBC:'B',0xBD:'C',0xBE:'D',0xBF:'E',0xC0:'F',0xC1:'G',
-    0xC2:'H',0xC3:'I',0xC4:'J',0xC5:'K',0xC6:'L',0xC7:'M',0xC8:'N',0xC9:'O',
-    0xCA:'P',0xCB:'Q',0xCC:'R',0xCD:'S',0xCE:'T',0xCF:'U',0xD0:'V',0xD1:'W',
-    0xD2:'X',0xD3:'Y',0xD4:'Z',0xD5:'a',0xD6:'b',0xD7:'c',0xD8:'d',0xD9:'e',
-    0xDA:'f',0xDB:'g',0xDC:'h',0xDD:'i',0xDE:'j',0xDF:'k',0xE0:'l',0xE1:'m',
-    0xE2:'n',0xE3:'o',0xE4:'p',0xE5:'q',0xE6:'r',0xE7:'s',0xE8:'t',0xE9:'u',
-    0xEA:'v',0xEB:'w',0xEC:'x',0xED:'y',0xEE:'z',0xEF:'|>|',0xF0:':',0xF1:'Ä',
-    0xF2:'Ö',0xF3:'Ü',0xF4:'ä',0xF5:'ö',0xF6:'ü',0xF7:'|A|',0xF8:'|V|',
-    0xF9:'|<|',0xFA:'|nb|',0xFB:'|nb2|',0xFC:'|FC|',0xFD:'|FD|',0xFE:'|br|',
-  }
   strings = []
   string = ''
   while True:
@@ -108,12 +269,12 @@ def load_strings(bytes, hex_offset):
       strings.append(string)
       string = ''
       continue
-    elif char not in table:
+    elif char not in TEXT_TABLE:
       break
-    string += table[char]
+    string += TEXT_TABLE[char]
   return strings
 
-def load_maps(bytes, hex_offset):
+def load_maps(bytes, hex_offset, bank_count=42):
   offset = int(hex_offset, 16)
 
   bank_pointers = []
@@ -124,11 +285,16 @@ def load_maps(bytes, hex_offset):
 
   debug('Found these bank pointers: {}'.format(bank_pointers))
 
+  # A bank's list of maps ends where another bank's list, or the bank table,
+  # starts. That also stops the last bank from reading on into whatever
+  # pointers come after it.
+  ends = set(bank_pointers[:bank_count])
+  ends.add(int(hex_offset, 16))
+
   banks = []
   for i, bank_pointer in enumerate(bank_pointers):
     offset = bank_pointer
-    next_pointer = bank_pointers[i + 1] if (i + 1) < len(bank_pointers) else 0
-    if i == 42:
+    if i == bank_count:
       break
 
     maps = []
@@ -139,16 +305,21 @@ def load_maps(bytes, hex_offset):
       map_pointer = read_pointer(bytes, map_data)
       width = read_int(bytes, map_pointer)
       height = read_int(bytes, map_pointer + 4)
+      label = struct.unpack('<B', bytes[(map_data + 20):(map_data + 21)])[0]
 
       maps.append({
         'map_data': map_data,
         'connections': cs,
         'width': width,
         'height': height,
+        'label': label,
+        'layout': map_pointer,
+        'tilesets': (read_pointer(bytes, map_pointer + 16),
+                     read_pointer(bytes, map_pointer + 20)),
       })
 
       offset = offset + 4
-      if offset == next_pointer:
+      if offset in ends:
         break
 
     debug('Found {} map pointers: {}'.format(len(maps), maps))
@@ -156,6 +327,176 @@ def load_maps(bytes, hex_offset):
 
   return banks
 
+# Offsets for the rom revisions we know about, keyed by the game code and
+# version from the rom header.
+KNOWN_OFFSETS = {
+  ('BPRE', 0): {'names': '0x3eecfc', 'banks': '0x3526a8', 'bank_count': 42},
+}
+
+# The name of the first map section in FireRed and LeafGreen. The map names are
+# stored one after the other, starting with this one.
+FIRST_MAP_NAME = 'PALLET TOWN'
+
+def find_offsets(bytes, args):
+  if args.names_offset and args.banks_offset and args.bank_count:
+    rom_offsets = {}
+  else:
+    rom_offsets = detect_offsets(bytes, args.offset_cache)
+  if args.names_offset:
+    rom_offsets['names'] = args.names_offset
+  if args.banks_offset:
+    rom_offsets['banks'] = args.banks_offset
+    # The count found for another table doesn't say anything about this one.
+    if not args.bank_count:
+      rom_offsets['bank_count'] = count_map_banks(bytes,
+        int(args.banks_offset, 16))
+  if args.bank_count:
+    rom_offsets['bank_count'] = args.bank_count
+  if rom_offsets['banks'] is None:
+    raise SystemExit("couldn't find the map bank table, try --banks-offset")
+  debug('Using offsets: {}'.format(rom_offsets))
+  return rom_offsets
+
+def read_game_code(bytes):
+  code = bytes[0xac:0xb0].decode('ascii', 'replace')
+  version = bytes[0xbc]
+  return (code, version)
+
+# Works out the map name and map bank offsets of a rom. Roms we know about are
+# looked up by their header, and the offsets we know are checked before they're
+# used, since hacks keep the header but often move or extend the tables.
+# Anything that isn't known, or doesn't check out, is scanned for. Scan results
+# are cached by the rom's hash in `cache_path`, if given, since scanning a whole
+# rom takes a little while.
+def detect_offsets(bytes, cache_path=None):
+  rom_hash = hashlib.sha1(bytes).hexdigest()
+  cache = {}
+  if cache_path and os.path.exists(cache_path):
+    try:
+      with open(cache_path) as f:
+        cache = json.load(f)
+    except (OSError, ValueError):
+      debug('Ignoring the unreadable offset cache {}'.format(cache_path))
+    if not isinstance(cache, dict):
+      cache = {}
+  if rom_hash in cache:
+    debug('Using cached offsets for rom {}'.format(rom_hash))
+    return dict(cache[rom_hash])
+
+  game_code = read_game_code(bytes)
+  (banks, bank_count, names) = (None, 0, None)
+  known = KNOWN_OFFSETS.get(game_code)
+  if known is not None:
+    debug('Checking the known offsets for {} v{}'.format(*game_code))
+    if is_map_bank(bytes, int(known['banks'], 16)):
+      banks = int(known['banks'], 16)
+      bank_count = known['bank_count']
+    if is_map_names(bytes, int(known['names'], 16)):
+      names = int(known['names'], 16)
+  else:
+    debug('Unknown rom {} v{}, scanning for offsets'.format(*game_code))
+
+  scanned = banks is None or names is None
+  if banks is None:
+    debug("Scanning for the map bank table")
+    (banks, bank_count) = find_bank_table(bytes)
+  if names is None:
+    debug("Scanning for the map names")
+    names = find_map_names(bytes)
+  rom_offsets = {
+    'names': None if names is None else hex(names),
+    'banks': None if banks is None else hex(banks),
+    'bank_count': bank_count,
+  }
+
+  if cache_path and scanned and banks is not None:
+    cache[rom_hash] = rom_offsets
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    with open(cache_path, 'w') as f:
+      json.dump(cache, f, indent=1)
+  return dict(rom_offsets)
+
+# FIRST_MAP_NAME as the rom stores it, with the 0xff that ends it.
+def encode_first_map_name():
+  reverse_table = {v: k for (k, v) in TEXT_TABLE.items()}
+  return b''.join(struct.pack('<B', reverse_table[c]) for c in FIRST_MAP_NAME) + \
+    b'\xff'
+
+def is_map_names(bytes, offset):
+  name = encode_first_map_name()
+  return bytes[offset:(offset + len(name))] == name
+
+def find_map_names(bytes):
+  offset = bytes.find(encode_first_map_name())
+  if offset < 0:
+    return None
+  return offset
+
+# Yields (offset, length) for every run of at least `min_length` aligned words
+# that look like rom pointers. Rather than reading every word, this looks at
+# every fourth byte (the top byte of each word) in one go and searches that for
+# runs of 0x08 or 0x09.
+def find_pointer_runs(bytes, min_length):
+  top_bytes = bytes[3::4]
+  pattern = re.compile(b'[\x08\x09]{%d,}' % min_length)
+  for match in pattern.finditer(top_bytes):
+    yield (match.start() * 4, match.end() - match.start())
+
+def is_rom_pointer(bytes, offset):
+  pointer = read_pointer(bytes, offset)
+  return 0 <= pointer < len(bytes) - 24 and bytes[offset + 3] in (0x08, 0x09)
+
+def is_tileset_header(bytes, offset):
+  return bytes[offset] in (0, 1) and bytes[offset + 1] in (0, 1) and \
+    is_rom_pointer(bytes, offset + 4) and is_rom_pointer(bytes, offset + 8) and \
+    is_rom_pointer(bytes, offset + 12)
+
+def is_map_header(bytes, offset):
+  if not is_rom_pointer(bytes, offset):
+    return False
+  map_pointer = read_pointer(bytes, offset)
+  if not all(is_rom_pointer(bytes, map_pointer + i) for i in (8, 12, 16, 20)):
+    return False
+  width = read_int(bytes, map_pointer)
+  height = read_int(bytes, map_pointer + 4)
+  if not (0 < width <= 0x400 and 0 < height <= 0x400):
+    return False
+  return is_tileset_header(bytes, read_pointer(bytes, map_pointer + 16)) and \
+    is_tileset_header(bytes, read_pointer(bytes, map_pointer + 20))
+
+# A bank is a table of pointers to map headers, so check its first map.
+def is_map_bank(bytes, offset):
+  if not 0 <= offset <= len(bytes) - 4 or not is_rom_pointer(bytes, offset):
+    return False
+  table = read_pointer(bytes, offset)
+  return is_rom_pointer(bytes, table) and \
+    is_map_header(bytes, read_pointer(bytes, table))
+
+# The number of map banks in a row starting at `offset`.
+def count_map_banks(bytes, offset):
+  count = 0
+  while is_map_bank(bytes, offset + count * 4):
+    count += 1
+  return count
+
+# Looks for the map bank table: a run of pointers to tables of map header
+# pointers. Returns (offset, number of banks), or (None, 0) if nothing looked
+# like one. The longest run of consecutive valid banks wins.
+def find_bank_table(bytes, min_banks=8):
+  best = (None, 0)
+  for (offset, length) in find_pointer_runs(bytes, min_banks):
+    start = None
+    for i in range(length + 1):
+      valid = i < length and is_map_bank(bytes, offset + i * 4)
+      if valid and start is None:
+        start = i
+      elif not valid and start is not None:
+        if i - start > best[1]:
+          best = (offset + start * 4, i - start)
+        start = None
+  debug('Best map bank table candidate: {}'.format(best))
+  return best
+
 def read_connections(bytes, map_data):
   cs = []
   if not is_pointer(bytes, map_data + 12):
@@ -190,6 +531,7 @@ def read_map(bytes, header_pointer):
     border, tiles_pointer))
 
   tile_sprites = {}
+  tile_attributes = {}
 
   offset = tiles_pointer
   i = 0
@@ -202,31 +544,56 @@ def read_map(bytes, header_pointer):
       debug('tile at ({}, {}): {:#x}, attribute: {:#x}'.format(
         x, y, tile, attribute))
       tile_sprites[(x, y)] = tile
+      tile_attributes[(x, y)] = attribute
 
       i = i + 1
 
-  return (width, height, label, tile_sprites, tileset_pointer, local_pointer)
+  return (width, height, label, tile_sprites, tileset_pointer, local_pointer,
+    tile_attributes)
 
 def read_tileset(bytes, tileset_pointer):
   attribs = struct.unpack('<2B', bytes[tileset_pointer:(tileset_pointer + 2)])
   debug('Tileset compressed: {}, primary: {}'.format(attribs[0], attribs[1]))
   primary = attribs[1]
-  tileset_image_pointer = read_pointer(bytes, tileset_pointer + 4)
-  image = nlzss.lzss3.decompress_bytes(bytes[tileset_image_pointer:])
+  image = read_tileset_image(bytes, tileset_pointer)
 
   tiles = []
   for i in range(0, len(image), 32):
-    tile = []
-    for j in range(64):
-      px = image[int(i + (j / 2))]
-      if j % 2 == 0:
-        px = px & 0xf
-      else:
-        px = int(px / 0x10)
-      tile.append(px)
-    tiles.append(tile)
+    tiles.append(read_tile(image, i))
   debug('Total number of tiles read: {}'.format(len(tiles)))
 
+  palettes = read_palettes(bytes, tileset_pointer, primary)
+
+  offset = read_pointer(bytes, tileset_pointer + 12)
+  end = read_pointer(bytes, tileset_pointer + 20)
+  total_blocks = (end - offset) / 16
+  debug('trying to read {} blocks'.format(total_blocks))
+  blocks = []
+  for i in range(int(total_blocks)):
+    blocks.append(read_block(bytes, offset, i))
+
+  return (palettes, tiles, blocks)
+
+# The compressed image is read through a memoryview so the rest of the rom after
+# it isn't copied.
+def read_tileset_image(bytes, tileset_pointer):
+  tileset_image_pointer = read_pointer(bytes, tileset_pointer + 4)
+  return nlzss.lzss3.decompress_bytes(memoryview(bytes)[tileset_image_pointer:])
+
+# Expands the 4bpp tile starting at byte `i` of a tileset image into a list of
+# 64 palette indices.
+def read_tile(image, i):
+  tile = []
+  for j in range(64):
+    px = image[int(i + (j / 2))]
+    if j % 2 == 0:
+      px = px & 0xf
+    else:
+      px = int(px / 0x10)
+    tile.append(px)
+  return tile
+
+def read_palettes(bytes, tileset_pointer, primary):
   offset = read_pointer(bytes, tileset_pointer + 8)
   debug('Palette pointer: {:#x}'.format(offset))
   palette_range = range(7) if primary == 0 else range(7, 16)
@@ -242,15 +609,78 @@ def read_tileset(bytes, tileset_pointer):
       (r, g, b) = (r * 8, g * 8, b * 8)
       palette.append((r, g, b))
     palettes.append(palette)
+  return palettes
 
-  offset = read_pointer(bytes, tileset_pointer + 12)
+# Most maps only use a few of their tilesets' blocks, so rather than unpacking
+# whole tilesets with read_tileset, the demand-driven path below only unpacks
+# the blocks a map uses and the tiles those blocks use.
+#
+# `cache` maps tileset pointers to what has been unpacked of that tileset so
+# far, and is meant to be shared between maps: each tileset is decompressed
+# once, and its 'tiles' and 'blocks' are filled in as maps need them.
+def load_tileset(bytes, tileset_pointer, cache):
+  if tileset_pointer not in cache:
+    cache[tileset_pointer] = unpack_tileset(bytes, tileset_pointer)
+  return cache[tileset_pointer]
+
+def unpack_tileset(bytes, tileset_pointer):
+  attribs = struct.unpack('<2B', bytes[tileset_pointer:(tileset_pointer + 2)])
+  image = read_tileset_image(bytes, tileset_pointer)
+  block_offset = read_pointer(bytes, tileset_pointer + 12)
   end = read_pointer(bytes, tileset_pointer + 20)
-  total_blocks = (end - offset) / 16
-  debug('trying to read {} blocks'.format(total_blocks))
-  blocks = []
-  for i in range(int(total_blocks)):
-    blocks.append(read_block(bytes, offset, i))
+  tileset = {
+    'image': image,
+    'tile_count': int((len(image) + 31) / 32),
+    'palettes': read_palettes(bytes, tileset_pointer, attribs[1]),
+    'block_offset': block_offset,
+    'block_count': int((end - block_offset) / 16),
+    'tiles': {},
+    'blocks': {},
+  }
+  debug('Loaded tileset {:#x}: {} tiles, {} blocks'.format(
+    tileset_pointer, tileset['tile_count'], tileset['block_count']))
+  return tileset
+
+# Picks the tileset that holds item `i` of the primary tileset's items followed
+# by the secondary tileset's, and returns it with the index into it.
+def split_tileset_index(primary, secondary, i, count_key):
+  if i < primary[count_key]:
+    return (primary, i)
+  i -= primary[count_key]
+  if i >= secondary[count_key]:
+    raise IndexError('{} index out of range'.format(count_key))
+  return (secondary, i)
 
+# Returns (palettes, tiles, blocks) like read_tileset does for both tilesets
+# combined, except that tiles and blocks are dicts that only hold the blocks
+# unpacked so far, which includes those in `block_ids` and the tiles they use.
+# The same objects are returned for every map using this pair of tilesets, so
+# renderers can cache by them.
+def read_map_tilesets(bytes, global_pointer, local_pointer, block_ids, cache):
+  primary = load_tileset(bytes, global_pointer, cache)
+  secondary = load_tileset(bytes, local_pointer, cache)
+  pair = (global_pointer, local_pointer)
+  if pair not in cache:
+    cache[pair] = (primary['palettes'] + secondary['palettes'], {}, {})
+  (palettes, tiles, blocks) = cache[pair]
+
+  for block_num in block_ids:
+    if block_num in blocks:
+      continue
+    (tileset, i) = split_tileset_index(primary, secondary, block_num, 'block_count')
+    if i not in tileset['blocks']:
+      tileset['blocks'][i] = read_block(bytes, tileset['block_offset'], i)
+    blocks[block_num] = tileset['blocks'][i]
+
+    for (palette, tile, attributes) in blocks[block_num]:
+      if tile in tiles:
+        continue
+      (tileset, j) = split_tileset_index(primary, secondary, tile, 'tile_count')
+      if j not in tileset['tiles']:
+        tileset['tiles'][j] = read_tile(tileset['image'], j * 32)
+      tiles[tile] = tileset['tiles'][j]
+
+  debug('Unpacked {} blocks and {} tiles'.format(len(blocks), len(tiles)))
   return (palettes, tiles, blocks)
 
 def read_second_blocks(bytes, header_pointer):
@@ -274,12 +704,18 @@ def read_block(bytes, offset, i):
     block.append((palette, tile, attributes))
   return block
 
-def draw_block(screen, palettes, tiles, blocks, x, y, block_num):
+# The layers that can be drawn separately, see draw_map.
+LAYERS = ('bottom', 'top', 'collision')
+
+def draw_block(screen, palettes, tiles, blocks, x, y, block_num, layer=None):
   # The first four tiles are the bottom tiles and the last four are the top
   # ones. The top tiles also have a mask to them, so we have to draw them
   # differently.
+  # `layer` can be 'bottom' or 'top' to only draw that half of the block.
   block = blocks[block_num]
   for i, (palette, tile, attributes) in enumerate(block):
+    if (layer == 'bottom' and i >= 4) or (layer == 'top' and i < 4):
+      continue
     x_offset = (i % 2) * 8
     y_offset = int((i % 4) / 2) * 8
     draw_tile(screen, palettes[palette], tiles[tile],
@@ -302,7 +738,310 @@ def draw_tile(screen, palette, tile, x, y, attributes, mask_mode):
     colour = palette[px]
     screen.set_at((x + x_offset, y + y_offset), colour)
 
+# The attribute of a map cell holds its collision bits (the bottom two) and its
+# elevation (the rest). Blocked cells are drawn red and passable ones are shaded
+# from blue to green by elevation.
+def collision_colour(attribute):
+  collision = attribute & 0x3
+  elevation = attribute >> 2
+  if collision:
+    return (255, 0, 0)
+  return (0, elevation * 17, 255 - elevation * 17)
+
+# Works out the pixels draw_block would draw for a block, as a list of 256
+# colours in rows of 16. Pixels that wouldn't be drawn are None.
+def render_block(palettes, tiles, blocks, block_num, layer=None):
+  pixels = [None] * 256
+  block = blocks[block_num]
+  for i, (palette, tile, attributes) in enumerate(block):
+    if (layer == 'bottom' and i >= 4) or (layer == 'top' and i < 4):
+      continue
+    x_flip = attributes & 0x1
+    y_flip = attributes & 0x2
+    colours = palettes[palette]
+    x_base = (i % 2) * 8
+    y_base = int((i % 4) / 2) * 8
+    for j, px in enumerate(tiles[tile]):
+      if i >= 4 and px == 0:
+        continue
+      x_offset = 7 - (j % 8) if x_flip else j % 8
+      y_offset = 7 - int(j / 8) if y_flip else int(j / 8)
+      pixels[(y_base + y_offset) * 16 + x_base + x_offset] = colours[px]
+  return pixels
+
+# Canvases start out filled with this colour, which is treated as transparent
+# when saving.
+BACKGROUND = (255, 0, 255)
+
+# Renderers draw blocks onto canvases. Each one has its own kind of canvas, and
+# all of them have to produce exactly the same pixels as the reference
+# renderer; --verify-backend checks that.
+class Renderer:
+  name = None
+
+  def new_canvas(self, width, height, surface=None):
+    # `surface` is a pygame surface the renderer can draw straight onto if
+    # that's what its canvases are.
+    raise NotImplementedError
+
+  def draw_block(self, canvas, palettes, tiles, blocks, x, y, block_num,
+                 layer=None):
+    raise NotImplementedError
+
+  def fill(self, canvas, colour, rect):
+    raise NotImplementedError
+
+  def copy(self, canvas, rect, x, y):
+    # Copies the pixels in `rect` of the canvas to (x, y) on the same canvas.
+    # The two areas don't overlap.
+    raise NotImplementedError
+
+  def to_rgb(self, canvas):
+    # The canvas as bytes of RGB, row by row.
+    raise NotImplementedError
+
+  def to_surface(self, canvas):
+    raise NotImplementedError
+
+# The reference renderer, which draws pixel by pixel onto pygame surfaces.
+class PygameRenderer(Renderer):
+  name = 'pygame'
+
+  def new_canvas(self, width, height, surface=None):
+    import pygame
+    if surface is None:
+      surface = pygame.Surface((width, height))
+    surface.fill(BACKGROUND)
+    surface.set_colorkey(BACKGROUND)
+    return surface
+
+  def draw_block(self, canvas, palettes, tiles, blocks, x, y, block_num,
+                 layer=None):
+    draw_block(canvas, palettes, tiles, blocks, x, y, block_num, layer)
+
+  def fill(self, canvas, colour, rect):
+    canvas.fill(colour, rect)
+
+  def copy(self, canvas, rect, x, y):
+    canvas.blit(canvas.subsurface(rect).copy(), (x, y))
+
+  def to_rgb(self, canvas):
+    import pygame
+    return pygame.image.tostring(canvas, 'RGB')
+
+  def to_surface(self, canvas):
+    return canvas
+
+# Draws onto a flat bytearray of RGB pixels. Each block is rendered once per
+# tileset pair and layer, and then copied in a row at a time.
+class BufferRenderer(Renderer):
+  name = 'buffer'
+
+  def __init__(self):
+    self.block_cache = {}
+
+  def new_canvas(self, width, height, surface=None):
+    return {
+      'width': width,
+      'height': height,
+      'pixels': bytearray(struct.pack('<3B', *BACKGROUND) * (width * height)),
+    }
+
+  def block_runs(self, palettes, tiles, blocks, block_num, layer):
+    # Blocks are cached by the identity of their tileset's blocks, which
+    # read_map_tilesets keeps the same for each tileset pair. The blocks are
+    # kept alive by the cache so their id can't be reused.
+    entry = self.block_cache.get(id(blocks))
+    if entry is None:
+      entry = (blocks, {})
+      self.block_cache[id(blocks)] = entry
+    runs = entry[1].get((block_num, layer))
+    if runs is None:
+      pixels = render_block(palettes, tiles, blocks, block_num, layer)
+      # Each row becomes a list of (x, RGB bytes) runs of drawn pixels.
+      runs = []
+      for y in range(16):
+        row = []
+        start = None
+        for x in range(17):
+          px = pixels[y * 16 + x] if x < 16 else None
+          if px is not None and start is None:
+            start = x
+          elif px is None and start is not None:
+            row.append((start, b''.join(struct.pack('<3B', *c)
+              for c in pixels[(y * 16 + start):(y * 16 + x)])))
+            start = None
+        runs.append(row)
+      entry[1][(block_num, layer)] = runs
+    return runs
+
+  def draw_block(self, canvas, palettes, tiles, blocks, x, y, block_num,
+                 layer=None):
+    runs = self.block_runs(palettes, tiles, blocks, block_num, layer)
+    width = canvas['width']
+    pixels = canvas['pixels']
+    for (dy, row) in enumerate(runs):
+      if not 0 <= y + dy < canvas['height']:
+        continue
+      for (dx, run) in row:
+        start = x + dx
+        end = start + int(len(run) / 3)
+        if start < 0:
+          run = run[(-start * 3):]
+          start = 0
+        if end > width:
+          run = run[:(len(run) - (end - width) * 3)]
+          end = width
+        if start >= end:
+          continue
+        i = ((y + dy) * width + start) * 3
+        pixels[i:(i + len(run))] = run
+
+  def fill(self, canvas, colour, rect):
+    (x, y, w, h) = rect
+    (x0, x1) = (max(x, 0), min(x + w, canvas['width']))
+    if x0 >= x1:
+      return
+    run = struct.pack('<3B', *colour) * (x1 - x0)
+    for row in range(max(y, 0), min(y + h, canvas['height'])):
+      i = (row * canvas['width'] + x0) * 3
+      canvas['pixels'][i:(i + len(run))] = run
+
+  def copy(self, canvas, rect, x, y):
+    (src_x, src_y, w, h) = rect
+    width = canvas['width']
+    pixels = canvas['pixels']
+    for row in range(h):
+      i = ((src_y + row) * width + src_x) * 3
+      j = ((y + row) * width + x) * 3
+      pixels[j:(j + w * 3)] = pixels[i:(i + w * 3)]
+
+  def to_rgb(self, canvas):
+    return bytes(canvas['pixels'])
+
+  def to_surface(self, canvas):
+    import pygame
+    surface = pygame.image.fromstring(bytes(canvas['pixels']),
+      (canvas['width'], canvas['height']), 'RGB')
+    surface.set_colorkey(BACKGROUND)
+    return surface
+
+# Draws onto a height x width x 3 NumPy array, a whole block at a time.
+class NumpyRenderer(Renderer):
+  name = 'numpy'
+
+  def __init__(self):
+    import numpy
+    self.numpy = numpy
+    self.block_cache = {}
+
+  def new_canvas(self, width, height, surface=None):
+    canvas = self.numpy.empty((height, width, 3), dtype=self.numpy.uint8)
+    canvas[:, :] = BACKGROUND
+    return canvas
+
+  def block_pixels(self, palettes, tiles, blocks, block_num, layer):
+    # Cached the same way as BufferRenderer.block_runs.
+    entry = self.block_cache.get(id(blocks))
+    if entry is None:
+      entry = (blocks, {})
+      self.block_cache[id(blocks)] = entry
+    cached = entry[1].get((block_num, layer))
+    if cached is None:
+      pixels = render_block(palettes, tiles, blocks, block_num, layer)
+      colours = self.numpy.array([px or BACKGROUND for px in pixels],
+        dtype=self.numpy.uint8).reshape((16, 16, 3))
+      mask = self.numpy.array([px is not None for px in pixels]).reshape((16, 16))
+      cached = (colours, None if mask.all() else mask)
+      entry[1][(block_num, layer)] = cached
+    return cached
+
+  def draw_block(self, canvas, palettes, tiles, blocks, x, y, block_num,
+                 layer=None):
+    (colours, mask) = self.block_pixels(palettes, tiles, blocks, block_num, layer)
+    (height, width) = canvas.shape[:2]
+    (x0, y0) = (max(x, 0), max(y, 0))
+    (x1, y1) = (min(x + 16, width), min(y + 16, height))
+    if x0 >= x1 or y0 >= y1:
+      return
+    target = canvas[y0:y1, x0:x1]
+    colours = colours[(y0 - y):(y1 - y), (x0 - x):(x1 - x)]
+    if mask is None:
+      target[...] = colours
+    else:
+      mask = mask[(y0 - y):(y1 - y), (x0 - x):(x1 - x)]
+      self.numpy.copyto(target, colours, where=mask[..., None])
+
+  def fill(self, canvas, colour, rect):
+    (x, y, w, h) = rect
+    canvas[max(y, 0):max(y + h, 0), max(x, 0):max(x + w, 0)] = colour
+
+  def copy(self, canvas, rect, x, y):
+    (src_x, src_y, w, h) = rect
+    canvas[y:(y + h), x:(x + w)] = canvas[src_y:(src_y + h), src_x:(src_x + w)]
+
+  def to_rgb(self, canvas):
+    return canvas.tobytes()
+
+  def to_surface(self, canvas):
+    import pygame
+    (height, width) = canvas.shape[:2]
+    surface = pygame.image.fromstring(canvas.tobytes(), (width, height), 'RGB')
+    surface.set_colorkey(BACKGROUND)
+    return surface
+
+REFERENCE_RENDERER = 'pygame'
+RENDERERS = {r.name: r for r in (PygameRenderer, BufferRenderer, NumpyRenderer)}
+
+# Draws every map on its own with both the reference renderer and `name`, and
+# compares the pixels. Prints the first map and block that differ, along with
+# how long each renderer took. Returns an exit code.
+def verify_backend(bytes, maps, offsets, name):
+  renderers = (RENDERERS[REFERENCE_RENDERER](), RENDERERS[name]())
+  caches = ({}, {})
+  timings = [0.0, 0.0]
+  result = 0
+  for ((bank, map_), coord) in offsets:
+    m = maps[bank][map_]
+    (width, height) = (m['width'] * 16, m['height'] * 16)
+    images = []
+    for (i, renderer) in enumerate(renderers):
+      canvas = renderer.new_canvas(width, height)
+      start = time.perf_counter()
+      draw_map(canvas, bytes, m['map_data'], 0, 0, None, caches[i], renderer)
+      timings[i] += time.perf_counter() - start
+      images.append(renderer.to_rgb(canvas))
+
+    mismatch = first_mismatch(images[0], images[1], width)
+    if mismatch is not None:
+      (x, y) = mismatch
+      print('Map {}.{} differs at block ({}, {}), pixel ({}, {})'.format(
+        bank, map_, int(x / 16), int(y / 16), x, y))
+      result = 1
+      break
+  else:
+    print('All {} maps match'.format(len(offsets)))
+
+  for (renderer, timing) in zip(renderers, timings):
+    print('{}: {:.3f}s'.format(renderer.name, timing))
+  return result
+
+# Returns the (x, y) of the first pixel that differs between two RGB images, or
+# None if they're the same.
+def first_mismatch(a, b, width):
+  if a == b:
+    return None
+  stride = width * 3
+  for i in range(0, max(len(a), len(b)), stride):
+    (row_a, row_b) = (a[i:(i + stride)], b[i:(i + stride)])
+    if row_a != row_b:
+      for j in range(0, stride, 3):
+        if row_a[j:(j + 3)] != row_b[j:(j + 3)]:
+          return (int(j / 3), int(i / stride))
+  return (0, 0)
+
 def draw_and_save_map(screen, bytes, map_, strings):
+  import pygame
   screen.fill((255, 255, 255))
 
   label = draw_map(screen, bytes, map_, 0, 0)
@@ -312,19 +1051,584 @@ def draw_and_save_map(screen, bytes, map_, strings):
   name = strings[label - 88]
   pygame.image.save(screen, 'maps/{}.bmp'.format(name))
 
-def draw_map(screen, bytes, map_, xx, yy):
-  (width, height, label, tile_sprites, global_pointer, local_pointer) = read_map(bytes, map_)
-  (palettes, tiles, blocks) = read_tileset(bytes, global_pointer)
-  (extra_palettes, extra_tiles, extra_blocks) = read_tileset(bytes, local_pointer)
-  palettes.extend(extra_palettes)
-  tiles.extend(extra_tiles)
-  blocks.extend(extra_blocks)
+# Draws a map with its top-left corner at (xx, yy). If `layers` is given it
+# should map some of the names in LAYERS to canvases, and each of those layers
+# is drawn from the same decoded map instead of drawing to `screen`. None can
+# also be given a canvas, to draw the whole map onto as usual.
+#
+# `cache` is a tileset cache (see load_tileset) to share between calls, and
+# `renderer` is the Renderer to draw with, the reference one by default.
+def draw_map(screen, bytes, map_, xx, yy, layers=None, cache=None, renderer=None):
+  return draw_read_map(screen, bytes, read_map(bytes, map_), xx, yy, layers,
+    cache, renderer)
+
+# Like draw_map, but for a map that has already been through read_map.
+def draw_read_map(screen, bytes, map_info, xx, yy, layers=None, cache=None,
+                  renderer=None, rows=None):
+  (width, height, label, tile_sprites, global_pointer, local_pointer,
+    tile_attributes) = map_info
+  if cache is None:
+    cache = {}
+  (palettes, tiles, blocks) = read_map_tilesets(bytes, global_pointer,
+    local_pointer, set(tile_sprites.values()), cache)
+
+  if layers is None:
+    layers = {None: screen}
+  if renderer is None:
+    renderer = RENDERERS[REFERENCE_RENDERER]()
 
   for (x, y) in tile_sprites:
-    draw_block(screen, palettes, tiles, blocks, xx + x * 16, yy + y * 16, tile_sprites[(x, y)])
+    # Only the blocks between the `rows` of pixels are drawn, if given.
+    if rows is not None and not rows[0] - 16 < yy + y * 16 < rows[1]:
+      continue
+    for layer, canvas in layers.items():
+      if layer == 'collision':
+        renderer.fill(canvas, collision_colour(tile_attributes[(x, y)]),
+          (xx + x * 16, yy + y * 16, 16, 16))
+      else:
+        renderer.draw_block(canvas, palettes, tiles, blocks, xx + x * 16,
+          yy + y * 16, tile_sprites[(x, y)], layer)
 
   return label
 
+# Draws the maps placed by calculate_map_offsets, with `origin` (in blocks) at
+# the top-left of the canvas. Yields each map's id once it has been drawn.
+def draw_maps(canvas, bytes, maps, offsets, origin, layers, cache, renderer,
+              dedup):
+  (min_x, min_y) = origin
+  for ((m, b), (x, y)) in offsets:
+    map_data = maps[m][b]['map_data']
+    place_map(canvas, bytes, map_data, read_map(bytes, map_data),
+      (x - min_x) * 16, (y - min_y) * 16, layers, cache, renderer, dedup)
+    yield (m, b)
+
+# The same as draw_maps, except that the work is split into stages that run at
+# the same time: a thread reads map headers in layout order, `jobs` worker
+# processes decompress and unpack the tilesets those maps need, and the calling
+# thread draws each map as soon as its tilesets are ready. The queue between
+# the stages is bounded so the header stage can't run too far ahead.
+def draw_maps_pipelined(canvas, bytes, rom_path, maps, offsets, origin, layers,
+                        cache, renderer, dedup, jobs):
+  (min_x, min_y) = origin
+  read_maps = queue.Queue(maxsize=jobs * 2)
+  tilesets = {}
+  finished = object()
+
+  with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker,
+      initargs=(rom_path,)) as pool:
+    def read_headers():
+      try:
+        for ((m, b), (x, y)) in offsets:
+          map_info = read_map(bytes, maps[m][b]['map_data'])
+          for pointer in map_info[4:6]:
+            if pointer not in cache and pointer not in tilesets:
+              tilesets[pointer] = pool.submit(unpack_tileset_worker, pointer)
+          read_maps.put(((m, b), map_info, (x - min_x) * 16, (y - min_y) * 16))
+        read_maps.put(finished)
+      except Exception as e:
+        read_maps.put(e)
+
+    reader = threading.Thread(target=read_headers, daemon=True)
+    reader.start()
+    while True:
+      item = read_maps.get()
+      if item is finished:
+        break
+      if isinstance(item, Exception):
+        raise item
+      (map_id, map_info, xx, yy) = item
+      for pointer in map_info[4:6]:
+        if pointer not in cache:
+          cache[pointer] = tilesets[pointer].result()
+      place_map(canvas, bytes, maps[map_id[0]][map_id[1]]['map_data'], map_info,
+        xx, yy, layers, cache, renderer, dedup)
+      yield map_id
+    reader.join()
+
+# Many maps share their block grid and tilesets with others, e.g. every
+# Pokémon Center. Those all look the same, so place_map draws each one once and
+# copies its pixels for every other placement. `dedup` keeps track of that.
+def new_dedup():
+  return {'sources': {}, 'placed': [], 'drawn': 0, 'copied': 0}
+
+def dedup_summary(dedup):
+  total = dedup['drawn'] + dedup['copied']
+  return 'Drew {} unique maps for {} placements (dedup ratio {:.2f})'.format(
+    dedup['drawn'], total, total / max(dedup['drawn'], 1))
+
+# Maps that read the same block grid bytes with the same tilesets are drawn
+# identically.
+def map_key(bytes, map_data):
+  map_pointer = read_pointer(bytes, map_data)
+  width = read_int(bytes, map_pointer)
+  height = read_int(bytes, map_pointer + 4)
+  tiles_pointer = read_pointer(bytes, map_pointer + 12)
+  grid = bytes[tiles_pointer:(tiles_pointer + width * height * 2)]
+  return (hashlib.sha1(grid).digest(), width, height,
+    read_pointer(bytes, map_pointer + 16), read_pointer(bytes, map_pointer + 20))
+
+def rects_overlap(a, b):
+  return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and \
+    a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+# Draws a map that has been through read_map at (xx, yy), or copies it from
+# where an identical map was drawn. Copying is only exact if neither area has
+# had anything else drawn over it, so anything overlapping is drawn as usual.
+def place_map(canvas, bytes, map_data, map_info, xx, yy, layers, cache, renderer,
+              dedup):
+  rect = (xx, yy, map_info[0] * 16, map_info[1] * 16)
+  key = map_key(bytes, map_data)
+  source = dedup['sources'].get(key)
+  if source is not None and \
+     not any(rects_overlap(rect, r) for r in dedup['placed']):
+    for target in (layers or {None: canvas}).values():
+      renderer.copy(target, source, xx, yy)
+    dedup['copied'] += 1
+  else:
+    draw_read_map(canvas, bytes, map_info, xx, yy, layers, cache, renderer)
+    dedup['drawn'] += 1
+
+  for (k, r) in list(dedup['sources'].items()):
+    if rects_overlap(rect, r):
+      del dedup['sources'][k]
+  if key not in dedup['sources']:
+    dedup['sources'][key] = rect
+  dedup['placed'].append(rect)
+
+# --max-memory picks one of these to draw the world with:
+#  - 'memory' draws the whole world onto the display, as without a budget.
+#  - 'banded' draws the world a band of rows at a time, writing each band to
+#    the image before drawing the next. Only the blocks inside a band are
+#    drawn, but every map is looked at again for each band.
+#  - 'disk' draws onto a canvas kept in a temporary file and mapped into
+#    memory, then writes it out a band at a time. Everything draws as it does
+#    in memory, including -j and copying identical maps.
+STRATEGIES = ('memory', 'banded', 'disk')
+# What every strategy needs on top of its canvas: the interpreter, pygame, the
+# decompressed tilesets and the renderers' block caches.
+BASE_MEMORY = 96 * 1024 * 1024
+# Bytes per pixel of each renderer's canvas.
+CANVAS_BYTES = {'pygame': 4, 'buffer': 3, 'numpy': 3}
+# Bands shorter than this redraw the maps they cut through too many times, so
+# the canvas goes on disk instead.
+MIN_BAND_HEIGHT = 256
+# How many rows the disk strategy reads back at a time when the budget doesn't
+# say.
+DISK_BAND_HEIGHT = 1024
+
+# Parses a size like 512M, 2G or 1048576 into bytes.
+def parse_size(text):
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*$', text, re.I)
+  if match is None:
+    raise argparse.ArgumentTypeError('not a size: {!r}'.format(text))
+  scale = 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+  return int(float(match.group(1)) * scale)
+
+# The most memory (in bytes) drawing a width x height world with `strategy` is
+# expected to take. `band_height` is the number of rows the streaming
+# strategies keep at once.
+def estimate_memory(rom_size, width, height, strategy, backend=REFERENCE_RENDERER,
+                    layers=False, band_height=0):
+  pixels = width * height
+  total = BASE_MEMORY + rom_size
+  if strategy == 'memory':
+    # The display, and the copy convert_alpha makes of it to save it.
+    total += pixels * 8
+    if backend != 'pygame':
+      # The renderer's own canvas, and the bytes and surface to_surface makes
+      # from it.
+      total += pixels * (CANVAS_BYTES[backend] + 6)
+    if layers:
+      total += len(LAYERS) * pixels * (CANVAS_BYTES[backend] + 10)
+  else:
+    # A band of RGB rows, and the copy of it the image writer encodes.
+    total += width * band_height * 6
+  return total
+
+# Returns the strategy and band height to draw a width x height world with,
+# keeping under `budget` bytes if that's possible. Prefers drawing in memory,
+# then in bands, then on disk. `strategy` forces one instead.
+def choose_strategy(budget, rom_size, width, height, backend, layers,
+                    strategy=None):
+  if strategy is None and (budget is None or estimate_memory(rom_size, width,
+      height, 'memory', backend, layers) <= budget):
+    strategy = 'memory'
+  if strategy == 'memory':
+    return ('memory', height)
+
+  if budget is None:
+    band_height = DISK_BAND_HEIGHT
+  else:
+    spare = budget - estimate_memory(rom_size, width, height, 'banded')
+    band_height = int(spare / (width * 6) / 16) * 16
+  band_height = max(16, min(band_height, height))
+  if strategy is None:
+    strategy = 'banded' if band_height >= min(MIN_BAND_HEIGHT, height) else 'disk'
+  return (strategy, band_height)
+
+# The most memory this process has used so far, as (bytes allocated by Python
+# according to tracemalloc, peak resident set size). Either is None if it
+# can't be measured here.
+def peak_memory():
+  import tracemalloc
+  traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+  try:
+    import resource
+  except ImportError:
+    return (traced, None)
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes.
+  if sys.platform != 'darwin':
+    rss *= 1024
+  return (traced, rss)
+
+# Prints the peak resident memory, which is what --max-memory budgets for. What
+# Python allocated is only known, and printed, when tracemalloc was tracing.
+def report_peak_memory():
+  (traced, rss) = peak_memory()
+  print('Peak memory: {} resident'.format(format_size(rss)))
+  if traced is not None:
+    debug('Peak Python allocations: {}'.format(format_size(traced)))
+
+def format_size(size):
+  return 'unknown' if size is None else '{:.1f} MB'.format(size / (1024 * 1024))
+
+# Writes an image a band of rows at a time, so the whole image never has to be
+# in memory at once. Rows are given as RGB bytes. BACKGROUND pixels are
+# transparent in PNGs, as they are in the images pygame saves; BMPs and TGAs are
+# written without alpha, so they keep the BACKGROUND colour.
+IMAGE_WRITER_FORMATS = ('png', 'bmp', 'tga')
+
+class ImageWriter:
+  def __init__(self, path, width, height):
+    self.format = os.path.splitext(path)[1][1:].lower()
+    if self.format not in IMAGE_WRITER_FORMATS:
+      raise ValueError("can't stream {} images".format(self.format))
+    self.width = width
+    self.height = height
+    self.rows = 0
+    self.file = open(path, 'wb')
+    if self.format == 'png':
+      import zlib
+      self.compressor = zlib.compressobj(6)
+      self.file.write(b'\x89PNG\r\n\x1a\n')
+      self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+      self.write_chunk(b'tRNS', struct.pack('>3H', *BACKGROUND))
+    elif self.format == 'bmp':
+      stride = (width * 3 + 3) & ~3
+      self.file.write(struct.pack('<2sIHHI', b'BM', 54 + stride * height, 0, 0, 54))
+      # A negative height stores the rows top to bottom.
+      self.file.write(struct.pack('<IiiHHIIiiII', 40, width, -height, 1, 24, 0,
+        stride * height, 2835, 2835, 0, 0))
+    else:
+      # Bit 5 of the descriptor stores the rows top to bottom.
+      self.file.write(struct.pack('<BBBHHBHHHHBB', 0, 0, 2, 0, 0, 0, 0, 0,
+        width, height, 24, 0x20))
+
+  def write_chunk(self, kind, data):
+    import zlib
+    self.file.write(struct.pack('>I', len(data)) + kind + data)
+    self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+  def write(self, rgb):
+    stride = self.width * 3
+    count = int(len(rgb) / stride)
+    if self.format == 'png':
+      data = b''.join(b'\x00' + rgb[i:(i + stride)] for i in range(0, len(rgb), stride))
+      compressed = self.compressor.compress(data)
+      if compressed:
+        self.write_chunk(b'IDAT', compressed)
+    else:
+      bgr = bytearray(len(rgb))
+      bgr[0::3] = rgb[2::3]
+      bgr[1::3] = rgb[1::3]
+      bgr[2::3] = rgb[0::3]
+      padding = b'\x00' * (-stride % 4 if self.format == 'bmp' else 0)
+      if padding:
+        bgr = b''.join(bgr[i:(i + stride)] + padding for i in range(0, len(bgr), stride))
+      self.file.write(bgr)
+    self.rows += count
+
+  def close(self):
+    if self.rows != self.height:
+      raise ValueError('wrote {} rows of {}'.format(self.rows, self.height))
+    if self.format == 'png':
+      self.write_chunk(b'IDAT', self.compressor.flush())
+      self.write_chunk(b'IEND', b'')
+    self.file.close()
+
+# Draws the world with the 'banded' or 'disk' strategy straight to `outfile`,
+# without ever putting all of it in memory. It always draws with the
+# BufferRenderer, whose canvas is plain RGB rows the ImageWriter can take.
+def draw_world_streaming(outfile, strategy, band_height, bytes, rom_path, maps,
+                         offsets, origin, size, jobs):
+  (width, height) = size
+  (min_x, min_y) = origin
+  renderer = BufferRenderer()
+  tileset_cache = {}
+  writer = ImageWriter(outfile, width, height)
+  stride = width * 3
+
+  if strategy == 'banded':
+    placed = [(read_map(bytes, maps[m][b]['map_data']), (x - min_x) * 16,
+      (y - min_y) * 16) for ((m, b), (x, y)) in offsets]
+    for top in range(0, height, band_height):
+      band = renderer.new_canvas(width, min(band_height, height - top))
+      for (map_info, xx, yy) in placed:
+        if yy < top + band['height'] and top < yy + map_info[1] * 16:
+          draw_read_map(band, bytes, map_info, xx, yy - top, None, tileset_cache,
+            renderer, rows=(0, band['height']))
+      writer.write(band['pixels'])
+      debug('Wrote rows {} to {} of {}'.format(top, top + band['height'], height))
+    writer.close()
+    return None
+
+  import tempfile
+  with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(outfile))) as f:
+    f.truncate(width * height * 3)
+    pixels = mmap.mmap(f.fileno(), width * height * 3)
+    background = struct.pack('<3B', *BACKGROUND) * width
+    for row in range(height):
+      pixels[(row * stride):((row + 1) * stride)] = background
+    canvas = {'width': width, 'height': height, 'pixels': pixels}
+
+    dedup = new_dedup()
+    if jobs > 0:
+      drawn = draw_maps_pipelined(canvas, bytes, rom_path, maps, offsets, origin,
+        None, tileset_cache, renderer, dedup, jobs)
+    else:
+      drawn = draw_maps(canvas, bytes, maps, offsets, origin, None,
+        tileset_cache, renderer, dedup)
+    for map_id in drawn:
+      pass
+
+    for top in range(0, height, band_height):
+      writer.write(pixels[(top * stride):(min(top + band_height, height) * stride)])
+    writer.close()
+    pixels.close()
+  return dedup
+
+# Each worker process reads the rom itself rather than having it sent over.
+WORKER_ROM = None
+
+def init_worker(rom_path):
+  global WORKER_ROM
+  WORKER_ROM = load_rom(rom_path)
+
+def unpack_tileset_worker(tileset_pointer):
+  return unpack_tileset(WORKER_ROM, tileset_pointer)
+
+# Returns the byte ranges, as sorted (start, end) pairs, where two roms differ.
+# Whole chunks are compared first so only the chunks that changed are looked at
+# byte by byte.
+def changed_ranges(old, new, chunk_size=4096):
+  ranges = []
+  def add(start, end):
+    if ranges and ranges[-1][1] == start:
+      ranges[-1] = (ranges[-1][0], end)
+    else:
+      ranges.append((start, end))
+
+  length = min(len(old), len(new))
+  for chunk in range(0, length, chunk_size):
+    chunk_end = min(chunk + chunk_size, length)
+    if old[chunk:chunk_end] == new[chunk:chunk_end]:
+      continue
+    start = None
+    for i in range(chunk, chunk_end):
+      if old[i] != new[i]:
+        if start is None:
+          start = i
+      elif start is not None:
+        add(start, i)
+        start = None
+    if start is not None:
+      add(start, chunk_end)
+  if len(old) != len(new):
+    add(length, max(len(old), len(new)))
+  return ranges
+
+# An upper bound on the end of the LZ-compressed data at `offset`: every 8
+# bytes of output take at most 9 bytes of input, after the 4 byte header.
+def lz_end_bound(bytes, offset):
+  size = struct.unpack('<I', bytes[(offset + 1):(offset + 4)] + b'\x00')[0]
+  return offset + 4 + size + int((size + 7) / 8)
+
+# Returns the (start, end) byte ranges of everything drawing map (bank, map_)
+# reads: its entries in the bank tables, its header and connections, its
+# layout and block grid, and both tilesets' headers, images, palettes and
+# blocks.
+def map_ranges(bytes, maps, banks_offset, bank, map_):
+  map_data = maps[bank][map_]['map_data']
+  bank_pointer = read_pointer(bytes, banks_offset + bank * 4)
+  ranges = [
+    (banks_offset + bank * 4, banks_offset + bank * 4 + 4),
+    (bank_pointer + map_ * 4, bank_pointer + map_ * 4 + 4),
+    (map_data, map_data + 28),
+  ]
+  if is_pointer(bytes, map_data + 12):
+    connections = read_pointer(bytes, map_data + 12)
+    ranges.append((connections, connections + 8))
+    offset = read_pointer(bytes, connections + 4)
+    ranges.append((offset, offset + 12 * read_int(bytes, connections)))
+
+  map_pointer = read_pointer(bytes, map_data)
+  width = read_int(bytes, map_pointer)
+  height = read_int(bytes, map_pointer + 4)
+  tiles_pointer = read_pointer(bytes, map_pointer + 12)
+  ranges.append((map_pointer, map_pointer + 24))
+  ranges.append((tiles_pointer, tiles_pointer + width * height * 2))
+
+  for tileset_pointer in (read_pointer(bytes, map_pointer + 16),
+                          read_pointer(bytes, map_pointer + 20)):
+    ranges.append((tileset_pointer, tileset_pointer + 24))
+    image = read_pointer(bytes, tileset_pointer + 4)
+    ranges.append((image, lz_end_bound(bytes, image)))
+    palettes = read_pointer(bytes, tileset_pointer + 8)
+    if bytes[tileset_pointer + 1] == 0:
+      ranges.append((palettes, palettes + 7 * 32))
+    else:
+      ranges.append((palettes + 7 * 32, palettes + 16 * 32))
+    ranges.append((read_pointer(bytes, tileset_pointer + 12),
+                   read_pointer(bytes, tileset_pointer + 20)))
+  return ranges
+
+def touches_changes(changes, change_starts, start, end):
+  i = bisect.bisect_right(change_starts, end - 1) - 1
+  return i >= 0 and changes[i][1] > start
+
+# Returns the ids of the maps the changed byte ranges could affect, looking at
+# what each map reads in both roms. Each rom is given with its maps and the
+# offset of its map bank table. Maps that only exist in one rom count as
+# changed too.
+def changed_maps(old, old_maps, old_banks_offset, new, new_maps,
+                 new_banks_offset, changes):
+  change_starts = [start for (start, end) in changes]
+  present = []
+  touched = set()
+  for (bytes, maps, banks_offset) in ((old, old_maps, old_banks_offset),
+                                      (new, new_maps, new_banks_offset)):
+    ids = set()
+    for bank in range(len(maps)):
+      for map_ in range(len(maps[bank])):
+        ids.add((bank, map_))
+        if any(touches_changes(changes, change_starts, start, end)
+               for (start, end) in map_ranges(bytes, maps, banks_offset, bank, map_)):
+          touched.add((bank, map_))
+    present.append(ids)
+  return sorted(touched | (present[0] ^ present[1]))
+
+# The --diff mode. Only the maps whose data is touched by the bytes that
+# changed between the two roms are drawn, from both roms. Each row of the output
+# image is one map: the old version, the new version, and the new version
+# dimmed with its changed pixels in red. Returns an exit code.
+def diff_roms(args):
+  import pygame
+  (old_path, new_path) = args.diff
+  (old, new) = (load_rom(old_path), load_rom(new_path))
+  changes = changed_ranges(old, new)
+  debug('{} changed ranges: {}'.format(len(changes), changes[:20]))
+  if not changes:
+    print('The roms are the same')
+    return 0
+
+  (old_offsets, new_offsets) = (find_offsets(old, args), find_offsets(new, args))
+  (old_strings, old_maps) = load_world(old, args, old_offsets)
+  (new_strings, new_maps) = load_world(new, args, new_offsets)
+  candidates = changed_maps(old, old_maps, int(old_offsets['banks'], 16),
+    new, new_maps, int(new_offsets['banks'], 16), changes)
+  debug('{} maps read changed data'.format(len(candidates)))
+
+  renderer = BufferRenderer()
+  caches = ({}, {})
+  rows = []
+  for (bank, map_) in candidates:
+    images = []
+    for (i, (bytes, maps)) in enumerate(((old, old_maps), (new, new_maps))):
+      if bank < len(maps) and map_ < len(maps[bank]):
+        m = maps[bank][map_]
+        canvas = renderer.new_canvas(m['width'] * 16, m['height'] * 16)
+        draw_map(canvas, bytes, m['map_data'], 0, 0, None, caches[i], renderer)
+        images.append(canvas)
+      else:
+        images.append(None)
+
+    (old_image, new_image) = images
+    if old_image is None or new_image is None:
+      status = 'added' if old_image is None else 'removed'
+    else:
+      highlight = highlight_changes(old_image, new_image, renderer)
+      if highlight is None:
+        continue
+      (changed_pixels, diff_image) = highlight
+      status = '{} pixels changed'.format(changed_pixels)
+      images.append(diff_image)
+
+    strings = new_strings if new_image is not None else old_strings
+    maps = new_maps if new_image is not None else old_maps
+    print('{}.{} {}: {}'.format(bank, map_,
+      map_name(strings, maps[bank][map_]['label']), status))
+    rows.append(images)
+
+  if not rows:
+    print('No maps look different')
+    return 0
+
+  gap = 16
+  column = max(image['width'] for row in rows for image in row if image)
+  width = column * 3 + gap * 2
+  height = sum(max(image['height'] for image in row if image) + gap
+               for row in rows) - gap
+  canvas = renderer.new_canvas(width, height)
+  y = 0
+  for row in rows:
+    for (i, image) in enumerate(row):
+      if image is not None:
+        blit_canvas(canvas, image, i * (column + gap), y)
+    y += max(image['height'] for image in row if image) + gap
+
+  screen = pygame.display.set_mode((width, height))
+  screen.fill(BACKGROUND)
+  screen.set_colorkey(BACKGROUND)
+  screen.blit(renderer.to_surface(canvas), (0, 0))
+  pygame.image.save(screen.convert_alpha(), args.outfile)
+  print('{} of {} changed maps look different, see {}'.format(
+    len(rows), len(candidates), args.outfile))
+  return 0
+
+# Compares two BufferRenderer canvases of a map. Returns None if they're the
+# same, otherwise the number of changed pixels and a copy of `new` that is
+# dimmed everywhere except for the changed pixels, which are red.
+def highlight_changes(old, new, renderer):
+  if old['pixels'] == new['pixels']:
+    return None
+  width = new['width']
+  diff = renderer.new_canvas(width, new['height'])
+  dim = b''.join(struct.pack('<B', int(v / 3)) for v in range(256))
+  red = struct.pack('<3B', 255, 0, 0)
+  stride = width * 3
+  changed = 0
+  same_size = (old['width'], old['height']) == (new['width'], new['height'])
+  for i in range(0, len(new['pixels']), stride):
+    old_row = old['pixels'][i:(i + stride)] if same_size else None
+    new_row = new['pixels'][i:(i + stride)]
+    row = bytearray(new_row.translate(dim))
+    if old_row != new_row:
+      for j in range(0, stride, 3):
+        if old_row is None or old_row[j:(j + 3)] != new_row[j:(j + 3)]:
+          row[j:(j + 3)] = red
+          changed += 1
+    diff['pixels'][i:(i + stride)] = row
+  return (changed, diff)
+
+# Copies all of a BufferRenderer canvas onto another at (x, y).
+def blit_canvas(canvas, image, x, y):
+  stride = image['width'] * 3
+  for row in range(image['height']):
+    i = ((y + row) * canvas['width'] + x) * 3
+    j = row * stride
+    canvas['pixels'][i:(i + stride)] = image['pixels'][j:(j + stride)]
+
 # Returns a set of maps and (x, y) coordinates that the maps should be drawn at.
 # The (x, y) coordinates are specified in blocks, not pixels.
 # Coordinates originate from the top-left of a map.
@@ -371,6 +1675,539 @@ def calculate_map_offsets(maps, bank_num, map_num):
     (bank_num, map_num),
     (0, 0), 0xf, 0)
 
+# Returns the (min_x, min_y, max_x, max_y) bounds of the placed maps, in blocks.
+def calculate_bounds(maps, offsets):
+  min_x = min([x for ((m, b), (x, y)) in offsets])
+  min_y = min([y for ((m, b), (x, y)) in offsets])
+  max_x = max([x + maps[m][b]['width'] for ((m, b), (x, y)) in offsets])
+  max_y = max([y + maps[m][b]['height'] for ((m, b), (x, y)) in offsets])
+  return (min_x, min_y, max_x, max_y)
+
+def map_name(strings, label):
+  # Map names are indexed by the map's label, starting from 0x58.
+  i = label - 88
+  if 0 <= i < len(strings):
+    return strings[i]
+  return ''
+
+# The world index records where every placed map ended up, so that other tools
+# don't have to parse the whole rom again to find out. Coordinates are in
+# blocks, relative to the top-left of the rendered world image.
+def build_world_index(maps, offsets, strings):
+  (min_x, min_y, max_x, max_y) = calculate_bounds(maps, offsets)
+  entries = []
+  for ((bank, map_), (x, y)) in sorted(offsets):
+    m = maps[bank][map_]
+    entries.append({
+      'bank': bank,
+      'map': map_,
+      'x': x - min_x,
+      'y': y - min_y,
+      'width': m['width'],
+      'height': m['height'],
+      'label': m['label'],
+      'name': map_name(strings, m['label']),
+      'connections': [{
+        'direction': c['direction'],
+        'offset': c['offset'],
+        'map_bank': c['map_bank'],
+        'map_number': c['map_number'],
+      } for c in m['connections']],
+    })
+  return {
+    'width': max_x - min_x,
+    'height': max_y - min_y,
+    'maps': entries,
+  }
+
+# Binary world index layout (all little-endian):
+#   header:  magic, version, record size, record count, edges offset,
+#            names offset
+#   records: one per map, sorted by (bank, map) so they can be binary searched
+#            straight out of an mmap
+#   edges:   the connections of each record, record['edge_start'] onwards
+#   names:   utf-8 map names, referenced by offset and length
+WORLD_INDEX_MAGIC = b'PKWI'
+WORLD_INDEX_VERSION = 1
+WORLD_INDEX_HEADER = struct.Struct('<4sHHIIIHH')
+WORLD_INDEX_RECORD = struct.Struct('<BBHiiHHIIHBx')
+WORLD_INDEX_EDGE = struct.Struct('<BBBxi')
+
+def pack_world_index(index):
+  records = []
+  edges = []
+  names = bytearray()
+  for e in index['maps']:
+    name = e['name'].encode('utf-8')
+    records.append(WORLD_INDEX_RECORD.pack(
+      e['bank'], e['map'], len(name), e['x'], e['y'], e['width'], e['height'],
+      len(names), len(edges), len(e['connections']), e['label']))
+    names.extend(name)
+    for c in e['connections']:
+      edges.append(WORLD_INDEX_EDGE.pack(
+        c['direction'], c['map_bank'], c['map_number'], c['offset']))
+
+  edges_offset = WORLD_INDEX_HEADER.size + WORLD_INDEX_RECORD.size * len(records)
+  names_offset = edges_offset + WORLD_INDEX_EDGE.size * len(edges)
+  header = WORLD_INDEX_HEADER.pack(
+    WORLD_INDEX_MAGIC, WORLD_INDEX_VERSION, WORLD_INDEX_RECORD.size,
+    len(records), edges_offset, names_offset, index['width'], index['height'])
+  return header + b''.join(records) + b''.join(edges) + bytes(names)
+
+def save_world_index(index, basename):
+  with open(basename + '.json', 'w') as f:
+    json.dump(index, f, indent=1, ensure_ascii=False)
+  with open(basename + '.bin', 'wb') as f:
+    f.write(pack_world_index(index))
+
+# Looks up a single map in a binary world index. `buf` can be anything that
+# supports the buffer protocol, e.g. an mmap of the .bin file. Returns None if
+# the map isn't in the index.
+def find_world_index_entry(buf, bank, map_):
+  (magic, version, record_size, count, edges_offset, names_offset,
+   _, _) = WORLD_INDEX_HEADER.unpack_from(buf, 0)
+  if magic != WORLD_INDEX_MAGIC or version != WORLD_INDEX_VERSION:
+    raise ValueError('not a world index')
+
+  lo = 0
+  hi = count
+  while lo < hi:
+    mid = (lo + hi) // 2
+    offset = WORLD_INDEX_HEADER.size + mid * record_size
+    if (buf[offset], buf[offset + 1]) < (bank, map_):
+      lo = mid + 1
+    else:
+      hi = mid
+  if lo == count:
+    return None
+  offset = WORLD_INDEX_HEADER.size + lo * record_size
+  (b, m, name_len, x, y, width, height, name_offset, edge_start, edge_count,
+   label) = WORLD_INDEX_RECORD.unpack_from(buf, offset)
+  if (b, m) != (bank, map_):
+    return None
+
+  connections = []
+  for j in range(edge_start, edge_start + edge_count):
+    (direction, map_bank, map_number, c_offset) = \
+      WORLD_INDEX_EDGE.unpack_from(buf, edges_offset + j * WORLD_INDEX_EDGE.size)
+    connections.append({
+      'direction': direction,
+      'offset': c_offset,
+      'map_bank': map_bank,
+      'map_number': map_number,
+    })
+  name_start = names_offset + name_offset
+  return {
+    'bank': b,
+    'map': m,
+    'x': x,
+    'y': y,
+    'width': width,
+    'height': height,
+    'label': label,
+    'name': bytes(buf[name_start:(name_start + name_len)]).decode('utf-8'),
+    'connections': connections,
+  }
+
+def load_world_index_entry(path, bank, map_):
+  with open(path, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+      return find_world_index_entry(buf, bank, map_)
+
+# Commands that only read the rom. Each one takes the rest of the command line
+# and returns an exit code.
+
+def command_parser(name, description):
+  parser = argparse.ArgumentParser(prog='{} {}'.format(sys.argv[0], name),
+                                   description=description)
+  parser.add_argument('rom_file', metavar='rom', type=str, help='a fire red rom')
+  add_rom_arguments(parser)
+  parser.add_argument("--json", help="Print JSON instead of text",
+                      action="store_true")
+  return parser
+
+def load_command_rom(args):
+  global DEBUG_MODE
+  if args.verbose:
+    DEBUG_MODE = True
+  bytes = load_rom(args.rom_file)
+  (strings, banks) = load_world(bytes, args)
+  return (bytes, strings, banks)
+
+def print_json(value):
+  json.dump(value, sys.stdout, indent=1, ensure_ascii=False)
+  print()
+
+def list_maps_command(argv):
+  args = command_parser('list-maps', 'List every map in a rom').parse_args(argv)
+  (bytes, strings, banks) = load_command_rom(args)
+  entries = []
+  for (bank, maps) in enumerate(banks):
+    for (map_, m) in enumerate(maps):
+      entries.append({
+        'bank': bank,
+        'map': map_,
+        'name': map_name(strings, m['label']),
+        'width': m['width'],
+        'height': m['height'],
+        'primary_tileset': hex(m['tilesets'][0]),
+        'secondary_tileset': hex(m['tilesets'][1]),
+      })
+
+  if args.json:
+    print_json(entries)
+  else:
+    for e in entries:
+      print('{bank:>3}.{map:<3} {width:>4}x{height:<4} {primary_tileset:>9} '
+            '{secondary_tileset:>9}  {name}'.format(**e))
+  return 0
+
+def stats_command(argv):
+  args = command_parser('stats', 'Summarise the maps in a rom').parse_args(argv)
+  (bytes, strings, banks) = load_command_rom(args)
+  all_maps = [m for maps in banks for m in maps]
+  tileset_usage = {}
+  for m in all_maps:
+    for pointer in m['tilesets']:
+      tileset_usage[pointer] = tileset_usage.get(pointer, 0) + 1
+  offsets = calculate_map_offsets(banks, 3, 0)
+  (min_x, min_y, max_x, max_y) = calculate_bounds(banks, offsets)
+  largest = max(all_maps, key=lambda m: m['width'] * m['height'])
+
+  stats = {
+    'banks': len(banks),
+    'maps': len(all_maps),
+    'layouts': len(set(m['layout'] for m in all_maps)),
+    'primary_tilesets': len(set(m['tilesets'][0] for m in all_maps)),
+    'secondary_tilesets': len(set(m['tilesets'][1] for m in all_maps)),
+    'tileset_usage': {hex(p): n for (p, n) in sorted(tileset_usage.items())},
+    'largest_map': '{}x{} {}'.format(largest['width'], largest['height'],
+                                      map_name(strings, largest['label'])),
+    'world_maps': len(offsets),
+    'world_bounds': [min_x, min_y, max_x, max_y],
+    'world_size': [(max_x - min_x) * 16, (max_y - min_y) * 16],
+  }
+
+  if args.json:
+    print_json(stats)
+  else:
+    print('Banks: {banks}, maps: {maps}, distinct layouts: {layouts}'.format(**stats))
+    print('Tilesets: {primary_tilesets} primary, {secondary_tilesets} '
+          'secondary'.format(**stats))
+    for (pointer, n) in stats['tileset_usage'].items():
+      print('  {:>9}: {} maps'.format(pointer, n))
+    print('Largest map: {largest_map}'.format(**stats))
+    print('World: {} maps, blocks ({}, {}) to ({}, {}), {}x{} pixels'.format(
+      stats['world_maps'], *(stats['world_bounds'] + stats['world_size'])))
+  return 0
+
+def export_maps_command(argv):
+  parser = command_parser('export-maps', 'Draw every map of every bank to its '
+                                         'own image')
+  parser.add_argument('outdir', help='Directory to write the images to')
+  parser.add_argument("--format", choices=['png', 'bmp', 'tga'], default='png',
+                      help="Image format (default: %(default)s)")
+  parser.add_argument("--backend", choices=sorted(RENDERERS),
+                      default=REFERENCE_RENDERER,
+                      help="Which renderer to draw with (default: %(default)s)")
+  args = parser.parse_args(argv)
+  (bytes, strings, banks) = load_command_rom(args)
+  import pygame
+
+  os.makedirs(args.outdir, exist_ok=True)
+  renderer = RENDERERS[args.backend]()
+  cache = {}
+  surfaces = {}
+  exported = []
+  for (bank, maps) in enumerate(banks):
+    for (map_, m) in enumerate(maps):
+      # Identical maps are drawn once and the image saved for each of them.
+      key = map_key(bytes, m['map_data'])
+      if key not in surfaces:
+        canvas = renderer.new_canvas(m['width'] * 16, m['height'] * 16)
+        draw_map(canvas, bytes, m['map_data'], 0, 0, None, cache, renderer)
+        surfaces[key] = renderer.to_surface(canvas)
+      name = map_name(strings, m['label']).replace('/', '_')
+      path = os.path.join(args.outdir, '{}.{} {}.{}'.format(bank, map_, name,
+        args.format))
+      pygame.image.save(surfaces[key], path)
+      exported.append({'bank': bank, 'map': map_, 'name': name, 'file': path})
+
+  summary = 'Exported {} maps, drew {} unique ones (dedup ratio {:.2f})'.format(
+    len(exported), len(surfaces), len(exported) / max(len(surfaces), 1))
+  if args.json:
+    print_json({'maps': exported, 'unique': len(surfaces)})
+  else:
+    print(summary)
+  return 0
+
+def layout_command(argv):
+  args = command_parser('layout', 'Print where each map of the world is '
+                                  'placed').parse_args(argv)
+  (bytes, strings, banks) = load_command_rom(args)
+  offsets = calculate_map_offsets(banks, 3, 0)
+  index = build_world_index(banks, offsets, strings)
+
+  if args.json:
+    print_json(index)
+  else:
+    print('World: {}x{} blocks, {}x{} pixels'.format(index['width'],
+      index['height'], index['width'] * 16, index['height'] * 16))
+    for e in index['maps']:
+      print('{bank:>3}.{map:<3} at {x:>4},{y:<4} {width:>4}x{height:<4}  '
+            '{name}'.format(**e))
+  return 0
+
+def repack_command(argv):
+  parser = argparse.ArgumentParser(prog='{} repack'.format(sys.argv[0]),
+    description='Replace tileset images in a rom, recompressing them in '
+                'parallel and writing them to free space')
+  parser.add_argument('rom_file', metavar='rom', type=str, help='a fire red rom')
+  parser.add_argument('out_file', metavar='out', type=str,
+                      help='where to write the repacked rom')
+  parser.add_argument("-t", "--tileset", action='append', required=True,
+                      metavar='HEX=FILE',
+                      help="Replace the image of the tileset at HEX with FILE: "
+                           "raw 4bpp tile data (.bin), or an image of 8x8 tiles "
+                           "in rows using the tileset's colours. Can be repeated")
+  parser.add_argument("--palette", type=int,
+                      help="Which palette (0-15) image colours are matched "
+                           "against (default: the tileset's first palette)")
+  parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                      help="Number of processes to compress with "
+                           "(default: %(default)s)")
+  parser.add_argument("--cache", metavar='DIR',
+                      default=os.path.join(os.path.expanduser('~'), '.cache',
+                        'pokemap', 'lz'),
+                      help="Where to cache compressed tilesets by their contents")
+  parser.add_argument("--free-space", metavar='HEX',
+                      help="Look for free space (runs of 0xff bytes) from this "
+                           "offset on. By default new data goes in the padding "
+                           "after the end of the rom's data, and the rom grows "
+                           "when that runs out")
+  add_rom_arguments(parser)
+  args = parser.parse_args(argv)
+  global DEBUG_MODE
+  if args.verbose:
+    DEBUG_MODE = True
+
+  start = time.perf_counter()
+  try:
+    rom = bytearray(load_rom(args.rom_file))
+  except OSError as e:
+    parser.error('could not read {}: {}'.format(args.rom_file, e.strerror))
+  replacements = []
+  for spec in args.tileset:
+    (pointer, separator, path) = spec.partition('=')
+    try:
+      pointer = int(pointer, 16)
+    except ValueError:
+      separator = None
+    if not separator or not path:
+      parser.error('--tileset takes HEX=FILE, not {}'.format(spec))
+    if not 0 <= pointer <= len(rom) - 24:
+      parser.error('tileset {:#x} is outside the rom'.format(pointer))
+    try:
+      replacements.append((pointer, read_tileset_file(rom, pointer, path,
+        args.palette)))
+    except OSError as e:
+      parser.error('could not read {}: {}'.format(path, e.strerror or e))
+    except ValueError as e:
+      parser.error(str(e))
+
+  compressed = compress_tilesets([data for (pointer, data) in replacements],
+    args.cache, args.jobs)
+
+  # Free space can't overlap anything the maps read, including the tilesets
+  # being replaced.
+  original = bytes(rom)
+  rom_offsets = find_offsets(original, args)
+  (strings, banks) = load_world(original, args, rom_offsets)
+  used = used_ranges(original, banks, int(rom_offsets['banks'], 16))
+  headers = set(pointer for (pointer, data) in replacements)
+  used = sorted(used + [(pointer, pointer + 24) for pointer in headers])
+  if args.free_space is None:
+    free_start = end_of_data(rom)
+  else:
+    free_start = int(args.free_space, 16)
+  free = find_free_space(rom, free_start, used=used)
+  debug('Free space: {}'.format([(hex(a), hex(b)) for (a, b) in free]))
+
+  placed = {}
+  for ((pointer, data), lz) in zip(replacements, compressed):
+    # Tilesets with the same contents share one copy.
+    if lz not in placed:
+      placed[lz] = allocate(rom, free, len(lz))
+      rom[placed[lz]:(placed[lz] + len(lz))] = lz
+    rom[pointer] = 1
+    rom[(pointer + 4):(pointer + 8)] = struct.pack('<I', placed[lz] + 0x8000000)
+    if read_tileset_image(rom, pointer) != data:
+      raise SystemExit('tileset {:#x} did not survive repacking'.format(pointer))
+    print('Tileset {:#x}: {} bytes -> {} compressed at {:#x}'.format(
+      pointer, len(data), len(lz), placed[lz]))
+
+  # Apart from the headers of the replaced tilesets, nothing the maps read
+  # should have changed.
+  for (range_start, range_end) in used:
+    if range_start not in headers and \
+       rom[range_start:range_end] != original[range_start:range_end]:
+      raise SystemExit('repacking overwrote data at {:#x}-{:#x}'.format(
+        range_start, range_end))
+
+  with open(args.out_file, 'wb') as f:
+    f.write(rom)
+  print('Repacked {} tilesets in {:.2f}s'.format(len(replacements),
+    time.perf_counter() - start))
+  return 0
+
+# Reads the new image for the tileset at `pointer`. .bin files are taken as
+# raw 4bpp tile data. Anything else is loaded as an image whose 8x8 tiles are
+# laid out left to right, top to bottom, and whose colours all come from one of
+# the tileset's palettes. Raises ValueError if the file isn't whole tiles, or
+# has colours that aren't in `palette`, or the tileset doesn't have `palette`.
+def read_tileset_file(rom, pointer, path, palette=None):
+  if path.endswith('.bin'):
+    with open(path, 'rb') as f:
+      data = f.read()
+    if len(data) % 32:
+      raise ValueError('{} is {} bytes, which is not a whole number of 32 byte '
+        'tiles'.format(path, len(data)))
+    return data
+
+  import pygame
+  image = pygame.image.load(path)
+  (width, height) = image.get_size()
+  if width % 8 or height % 8:
+    raise ValueError('{} is not made of 8x8 tiles'.format(path))
+
+  primary = rom[pointer + 1]
+  first = 0 if primary == 0 else 7
+  palettes = read_palettes(rom, pointer, primary)
+  if palette is None:
+    palette = first
+  if not first <= palette < first + len(palettes):
+    raise ValueError('tileset {:#x} has palettes {}-{}, not {}'.format(
+      pointer, first, first + len(palettes) - 1, palette))
+  colours = palettes[palette - first]
+  indices = {}
+  for (i, colour) in enumerate(colours):
+    indices.setdefault(colour, i)
+
+  data = bytearray()
+  for tile_y in range(0, height, 8):
+    for tile_x in range(0, width, 8):
+      for y in range(8):
+        for x in range(0, 8, 2):
+          pair = []
+          for dx in range(2):
+            (r, g, b) = image.get_at((tile_x + x + dx, tile_y + y))[:3]
+            colour = (r & 0xf8, g & 0xf8, b & 0xf8)
+            if colour not in indices:
+              raise ValueError('{}: colour {} at ({}, {}) is not in palette '
+                '{}'.format(path, (r, g, b), tile_x + x + dx, tile_y + y, palette))
+            pair.append(indices[colour])
+          data.append(pair[0] | (pair[1] << 4))
+  return bytes(data)
+
+def compress_tileset_image(data):
+  out = io.BytesIO()
+  nlzss.compress.compress(data, out)
+  return out.getvalue()
+
+# LZ10-compresses each of `images`, in parallel. Results are cached in
+# `cache_dir` by the SHA-1 of the uncompressed data, so unchanged tilesets are
+# never compressed twice.
+def compress_tilesets(images, cache_dir, jobs):
+  os.makedirs(cache_dir, exist_ok=True)
+  results = [None] * len(images)
+  todo = {}
+  for (i, data) in enumerate(images):
+    path = os.path.join(cache_dir, hashlib.sha1(data).hexdigest() + '.lz')
+    if os.path.exists(path):
+      with open(path, 'rb') as f:
+        results[i] = f.read()
+      debug('Using cached compressed tileset {}'.format(path))
+    else:
+      todo.setdefault(path, (data, []))[1].append(i)
+
+  if todo:
+    with concurrent.futures.ProcessPoolExecutor(max(jobs, 1)) as pool:
+      paths = list(todo)
+      compressed = pool.map(compress_tileset_image,
+        [todo[path][0] for path in paths])
+      for (path, lz) in zip(paths, compressed):
+        with open(path, 'wb') as f:
+          f.write(lz)
+        for i in todo[path][1]:
+          results[i] = lz
+  return results
+
+# Free space is a run of at least this many 0xff bytes, the usual marker for
+# unused rom space. Shorter runs turn up inside live data: tiles of colour 15,
+# tables and palettes padded with 0xff.
+FREE_SPACE_MIN_LENGTH = 0x400
+# How many bytes of a run are left alone before each allocation, in case
+# whatever comes before the run ends with 0xff bytes of its own.
+FREE_SPACE_GUARD = 0x40
+# The rom is mapped into 32 MB of the address space, so it can't be any bigger.
+MAX_ROM_SIZE = 0x2000000
+
+# Returns the (start, end) byte ranges every map of the rom reads (see
+# map_ranges), sorted. Free space never overlaps any of them.
+def used_ranges(rom, maps, banks_offset):
+  ranges = []
+  for bank in range(len(maps)):
+    for map_ in range(len(maps[bank])):
+      ranges.extend(map_ranges(rom, maps, banks_offset, bank, map_))
+  return sorted(ranges)
+
+# Where the rom's data ends, leaving out any 0xff padding after it.
+def end_of_data(rom):
+  return len(rom.rstrip(b'\xff'))
+
+# Returns the runs of free space from `start` on, as a list of [start, end]
+# with 4-byte aligned starts. Anything in the `used` ranges is cut out of the
+# runs, and only what's still `min_length` long is kept.
+def find_free_space(rom, start, min_length=FREE_SPACE_MIN_LENGTH, used=()):
+  free = []
+  pattern = re.compile(b'\xff{%d,}' % min_length)
+  for match in pattern.finditer(rom, start):
+    pieces = [(match.start(), match.end())]
+    for (used_start, used_end) in used:
+      if used_end <= match.start() or used_start >= match.end():
+        continue
+      remaining = []
+      for (piece_start, piece_end) in pieces:
+        if used_end <= piece_start or used_start >= piece_end:
+          remaining.append((piece_start, piece_end))
+          continue
+        if piece_start < used_start:
+          remaining.append((piece_start, used_start))
+        if used_end < piece_end:
+          remaining.append((used_end, piece_end))
+      pieces = remaining
+    for (piece_start, piece_end) in pieces:
+      aligned = (piece_start + 3) & ~3
+      if piece_end - aligned >= min_length:
+        free.append([aligned, piece_end])
+  return free
+
+# Takes `length` bytes from the first run in `free` that fits, leaving `guard`
+# bytes of the run alone before them. The rom grows if no run fits.
+def allocate(rom, free, length, guard=FREE_SPACE_GUARD):
+  for run in free:
+    offset = (run[0] + guard + 3) & ~3
+    if offset + length <= run[1]:
+      run[0] = offset + length
+      return offset
+  offset = (len(rom) + 3) & ~3
+  if offset + length > MAX_ROM_SIZE:
+    raise ValueError("no free space for {:#x} bytes, and the rom can't grow "
+                     "past {:#x}".format(length, MAX_ROM_SIZE))
+  rom.extend(b'\xff' * (offset + length - len(rom)))
+  debug('No free space left, growing the rom to {:#x}'.format(len(rom)))
+  return offset
+
 def is_pointer(bytes, offset):
   return read_pointer(bytes, offset) > 0
 
@@ -396,5 +2233,13 @@ def CheckExt(choices):
 
   return Act
 
+COMMANDS = {
+  'export-maps': export_maps_command,
+  'layout': layout_command,
+  'list-maps': list_maps_command,
+  'repack': repack_command,
+  'stats': stats_command,
+}
+
 if __name__ == '__main__':
   main()
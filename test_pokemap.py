@@ -0,0 +1,835 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import random
+import struct
+import tempfile
+import zlib
+from contextlib import redirect_stdout
+
+from pokemap import (build_world_index, pack_world_index, save_world_index,
+                     find_world_index_entry, load_world_index_entry,
+                     WORLD_INDEX_HEADER, find_pointer_runs, find_bank_table,
+                     detect_offsets, encode_first_map_name, KNOWN_OFFSETS,
+                     changed_ranges, map_ranges, changed_maps,
+                     find_free_space, allocate, end_of_data, MAX_ROM_SIZE,
+                     ImageWriter, IMAGE_WRITER_FORMATS, parse_size,
+                     estimate_memory, choose_strategy, BASE_MEMORY,
+                     DISK_BAND_HEIGHT, LAYERS, find_offsets, load_maps,
+                     read_tileset_file, TEXT_TABLE, RENDERERS, BACKGROUND,
+                     draw_map, calculate_map_offsets, calculate_bounds,
+                     draw_maps, draw_read_map, read_map, new_dedup, map_key,
+                     collision_colour, read_map_tilesets, read_tileset,
+                     draw_maps_pipelined, list_maps_command, stats_command,
+                     layout_command)
+
+def connection(direction, offset, bank, map_):
+  return {'direction': direction, 'offset': offset, 'map_bank': bank,
+          'map_number': map_}
+
+def world_maps():
+  # maps[bank][map], as load_maps returns them, with a few maps placed
+  maps = [[] for _ in range(43)]
+  for bank in (1, 3, 42):
+    for map_ in range(6):
+      maps[bank].append({'width': 4 + map_, 'height': 3, 'label': 88 + map_,
+                         'connections': []})
+  maps[3][0]['connections'] = [connection(2, -2, 3, 5), connection(4, 0, 42, 1)]
+  maps[3][5]['connections'] = [connection(1, 2, 3, 0)]
+  maps[3][5]['label'] = 91
+  maps[42][1]['label'] = 120
+  offsets = [((3, 0), (0, 0)), ((3, 5), (-2, -3)), ((42, 1), (4, 0)),
+             ((1, 2), (10, 7))]
+  return (maps, offsets)
+
+def test_world_index():
+  (maps, offsets) = world_maps()
+  strings = ['PALLET TOWN', 'ROUTE 1', 'VIRIDIAN CITY', 'POKéMON CENTER']
+  index = build_world_index(maps, offsets, strings)
+  assert (index['width'], index['height']) == (18, 13)
+  assert [(e['bank'], e['map']) for e in index['maps']] == \
+    [(1, 2), (3, 0), (3, 5), (42, 1)]
+  assert [(e['x'], e['y']) for e in index['maps']] == \
+    [(12, 10), (2, 3), (0, 0), (6, 3)]
+  # labels past the end of the names get no name
+  assert [e['name'] for e in index['maps']] == \
+    ['VIRIDIAN CITY', 'PALLET TOWN', 'POKéMON CENTER', '']
+
+  buf = pack_world_index(index)
+  (magic, _, _, count, _, _, width, height) = WORLD_INDEX_HEADER.unpack_from(buf)
+  assert (magic, count, width, height) == (b'PKWI', 4, 18, 13)
+  # every entry comes back, including the first and last
+  for entry in index['maps']:
+    assert find_world_index_entry(buf, entry['bank'], entry['map']) == entry
+
+  # before the first entry, between entries and after the last one
+  for (bank, map_) in ((0, 0), (1, 1), (1, 3), (3, 1), (3, 6), (42, 0),
+                       (42, 2), (255, 255)):
+    assert find_world_index_entry(buf, bank, map_) is None
+
+def test_world_index_edge_cases():
+  empty = pack_world_index({'width': 0, 'height': 0, 'maps': []})
+  assert find_world_index_entry(empty, 0, 0) is None
+
+  (maps, offsets) = world_maps()
+  index = build_world_index(maps, offsets[:1], ['PALLET TOWN'])
+  buf = pack_world_index(index)
+  assert find_world_index_entry(buf, 3, 0) == index['maps'][0]
+  assert find_world_index_entry(buf, 2, 0) is None
+  assert find_world_index_entry(buf, 3, 1) is None
+  assert find_world_index_entry(memoryview(buf), 3, 0) == index['maps'][0]
+
+  try:
+    find_world_index_entry(b'XXXX' + buf[4:], 3, 0)
+  except ValueError:
+    pass
+  else:
+    assert False
+
+def test_save_world_index():
+  (maps, offsets) = world_maps()
+  index = build_world_index(maps, offsets, ['PALLET TOWN', 'ROUTE 1'])
+  with tempfile.TemporaryDirectory() as directory:
+    basename = os.path.join(directory, 'world')
+    save_world_index(index, basename)
+    assert os.path.exists(basename + '.json')
+    assert load_world_index_entry(basename + '.bin', 42, 1) == index['maps'][3]
+    assert load_world_index_entry(basename + '.bin', 42, 2) is None
+
+def put_pointer(rom, offset, target):
+  rom[offset:(offset + 4)] = struct.pack('<I', 0x08000000 + target)
+
+# Writes a table of `count` map banks at `offset`, each with one map, using the
+# space from `free` onwards for the banks, maps and tilesets.
+def put_bank_table(rom, offset, count, free):
+  tileset = free
+  rom[tileset:(tileset + 4)] = b'\x01\x00\x00\x00'
+  for i in (4, 8, 12):
+    put_pointer(rom, tileset + i, 0x100)
+  layout = free + 0x20
+  rom[layout:(layout + 8)] = struct.pack('<II', 4, 3)
+  for i in (8, 12, 16, 20):
+    put_pointer(rom, layout + i, tileset)
+  header = free + 0x40
+  put_pointer(rom, header, layout)
+  bank = free + 0x60
+  put_pointer(rom, bank, header)
+  for i in range(count):
+    put_pointer(rom, offset + i * 4, bank)
+
+def test_find_pointer_runs():
+  rom = bytearray(0x1000)
+  for i in range(10):
+    put_pointer(rom, 0x124 + i * 4, 0x400 + i)
+  # pointers that aren't aligned aren't a run
+  for i in range(10):
+    put_pointer(rom, 0x602 + i * 4, 0x400)
+  # a run can point into the second 16 MB of the rom too
+  for i in range(8):
+    rom[(0x800 + i * 4):(0x800 + i * 4 + 4)] = struct.pack('<I', 0x09000000)
+  assert list(find_pointer_runs(rom, 8)) == [(0x124, 10), (0x800, 8)]
+  assert list(find_pointer_runs(rom, 9)) == [(0x124, 10)]
+  assert list(find_pointer_runs(rom, 11)) == []
+
+def test_find_bank_table():
+  rom = bytearray(0x2000)
+  # two pointers that aren't banks start the run, then nine banks
+  put_pointer(rom, 0x1228, 0x1800)
+  put_pointer(rom, 0x122c, 0x1800)
+  put_bank_table(rom, 0x1230, 9, 0x400)
+  assert list(find_pointer_runs(rom, 8)) == [(0x1228, 11)]
+  assert find_bank_table(rom) == (0x1230, 9)
+  # min_banks is how long a run of pointers has to be to be looked at
+  assert find_bank_table(rom, min_banks=12) == (None, 0)
+
+def test_detect_offsets():
+  known = KNOWN_OFFSETS[('BPRE', 0)]
+  (banks, names) = (int(known['banks'], 16), int(known['names'], 16))
+  rom = bytearray(0x400000)
+  rom[0xac:0xb0] = b'BPRE'
+  # a hack that keeps the header but moves the tables
+  put_bank_table(rom, 0x1230, 9, 0x400)
+  rom[0x2000:0x2010] = encode_first_map_name()
+  with tempfile.TemporaryDirectory() as directory:
+    # a cache that can't be read is scanned again, and then rewritten
+    cache_path = os.path.join(directory, 'offsets.json')
+    with open(cache_path, 'w') as f:
+      f.write('{"truncated')
+    for _ in range(2):
+      assert detect_offsets(bytes(rom), cache_path) == \
+        {'banks': '0x1230', 'bank_count': 9, 'names': '0x2000'}
+
+  # the known offsets are used once they hold the tables, along with the known
+  # number of banks, however many more pointers follow them
+  put_bank_table(rom, banks, 45, 0x3000)
+  rom[names:(names + 16)] = encode_first_map_name()
+  assert detect_offsets(bytes(rom)) == \
+    {'banks': known['banks'], 'bank_count': known['bank_count'],
+     'names': known['names']}
+
+  # a table given by hand has its banks counted
+  class Args:
+    names_offset = None
+    banks_offset = '0x1230'
+    bank_count = None
+    offset_cache = None
+  assert find_offsets(bytes(rom), Args())['bank_count'] == 9
+
+def test_load_maps():
+  rom = bytearray(0x2000)
+  put_bank_table(rom, 0x1800, 1, 0x400)
+  # two banks of two maps, then the bank table, with a third pointer after the
+  # two banks that leads to a map header too
+  for offset in range(0xff0, 0x1000, 4):
+    put_pointer(rom, offset, 0x440)
+  put_pointer(rom, 0x1000, 0xff0)
+  put_pointer(rom, 0x1004, 0xff8)
+  put_pointer(rom, 0x1008, 0x460)
+  banks = load_maps(bytes(rom), '0x1000', 2)
+  assert [len(maps) for maps in banks] == [2, 2]
+  assert banks[1][1]['map_data'] == 0x440
+  assert [len(maps) for maps in load_maps(bytes(rom), '0x1000', 3)] == [2, 2, 1]
+
+def test_changed_ranges():
+  old = bytes(20)
+  new = bytearray(old)
+  for i in (3, 4, 5, 10, 19):
+    new[i] = 1
+  # runs that cross a chunk boundary come back as one range
+  assert changed_ranges(old, bytes(new), chunk_size=4) == \
+    [(3, 6), (10, 11), (19, 20)]
+  assert changed_ranges(old, bytes(new)) == [(3, 6), (10, 11), (19, 20)]
+  assert changed_ranges(old, old) == []
+  # anything past the end of the shorter rom has changed
+  assert changed_ranges(old, bytes(new) + b'abc', chunk_size=4) == \
+    [(3, 6), (10, 11), (19, 23)]
+  assert changed_ranges(old + b'abc', old, chunk_size=4) == [(20, 23)]
+
+# A rom with three maps in bank 1 that all use the same header, with every
+# part of that map at a known place.
+def map_rom():
+  rom = bytearray(0x2000)
+  put_pointer(rom, 0x100, 0x200)
+  put_pointer(rom, 0x104, 0x210)
+  for i in range(3):
+    put_pointer(rom, 0x210 + i * 4, 0x300)
+  put_pointer(rom, 0x300, 0x400)
+  put_pointer(rom, 0x30c, 0x380)
+  rom[0x380:0x384] = struct.pack('<I', 2)
+  put_pointer(rom, 0x384, 0x390)
+  rom[0x400:0x408] = struct.pack('<II', 4, 3)
+  put_pointer(rom, 0x408, 0x440)
+  put_pointer(rom, 0x40c, 0x480)
+  put_pointer(rom, 0x410, 0x500)
+  put_pointer(rom, 0x414, 0x540)
+  for (tileset, primary, image, size, palettes, blocks, behaviours) in (
+      (0x500, 0, 0x600, 0x40, 0x700, 0x900, 0xa00),
+      (0x540, 1, 0x680, 0x20, 0x800, 0xb00, 0xb80)):
+    rom[tileset:(tileset + 2)] = bytes([1, primary])
+    put_pointer(rom, tileset + 4, image)
+    put_pointer(rom, tileset + 8, palettes)
+    put_pointer(rom, tileset + 12, blocks)
+    put_pointer(rom, tileset + 20, behaviours)
+    rom[image:(image + 4)] = struct.pack('<I', (size << 8) | 0x10)
+  maps = [[], [{'map_data': 0x300} for _ in range(3)]]
+  return (rom, maps)
+
+def test_map_ranges():
+  (rom, maps) = map_rom()
+  assert map_ranges(bytes(rom), maps, 0x100, 1, 2) == [
+    (0x104, 0x108), (0x218, 0x21c), (0x300, 0x31c),
+    (0x380, 0x388), (0x390, 0x3a8),
+    (0x400, 0x418), (0x480, 0x498),
+    # the primary tileset: its image can't be longer than 0x40 bytes
+    # uncompressed plus a flag byte for every 8 of them, and it has the first
+    # 7 palettes
+    (0x500, 0x518), (0x600, 0x64c), (0x700, 0x7e0), (0x900, 0xa00),
+    # the secondary one has the rest of the palettes
+    (0x540, 0x558), (0x680, 0x6a8), (0x8e0, 0xa00), (0xb00, 0xb80),
+  ]
+
+def test_changed_maps():
+  (old, maps) = map_rom()
+  new = bytearray(old)
+  new[0x1f00] = 1
+  changes = changed_ranges(bytes(old), bytes(new))
+  assert changed_maps(bytes(old), maps, 0x100, bytes(new), maps, 0x100,
+                      changes) == []
+
+  # every map reads the shared block grid
+  new[0x484] = 1
+  changes = changed_ranges(bytes(old), bytes(new))
+  assert changed_maps(bytes(old), maps, 0x100, bytes(new), maps, 0x100,
+                      changes) == [(1, 0), (1, 1), (1, 2)]
+
+  # only map 1 reads its own entry in the bank, which now points to a copy of
+  # the header
+  old[0x320:0x33c] = old[0x300:0x31c]
+  new = bytearray(old)
+  put_pointer(new, 0x214, 0x320)
+  new_maps = [[], [{'map_data': 0x300}, {'map_data': 0x320}, {'map_data': 0x300}]]
+  changes = changed_ranges(bytes(old), bytes(new))
+  assert changes == [(0x214, 0x215)]
+  assert changed_maps(bytes(old), maps, 0x100, bytes(new), new_maps, 0x100,
+                      changes) == [(1, 1)]
+
+  # maps that are only in one of the roms
+  new_maps = [[], maps[1] + [{'map_data': 0x300}]]
+  assert changed_maps(bytes(old), maps, 0x100, bytes(old), new_maps, 0x100,
+                      []) == [(1, 3)]
+
+# LZ10 data made only of literals.
+def lz10_literals(data):
+  out = bytearray(struct.pack('<I', (len(data) << 8) | 0x10))
+  for i in range(0, len(data), 8):
+    out.append(0)
+    out += data[i:(i + 8)]
+  return bytes(out)
+
+# A rom with a small world to draw. Bank 3 holds four maps connected to the
+# first: map 1 is a copy of map 0 with its own copy of the block grid, map 2
+# reads the same grid with a different secondary tileset, and map 3 is a route.
+# Banks 0-2 hold a house each. Tiles are about half colour 0, so the top halves
+# of blocks have holes in them. Returns the rom and the offsets of its map bank
+# table and map names.
+def world_rom(seed=0):
+  rand = random.Random(seed)
+  rom = bytearray(0x8000)
+  free = [0x200]
+  def alloc(data):
+    offset = free[0]
+    rom[offset:(offset + len(data))] = data
+    free[0] = (offset + len(data) + 3) & ~3
+    return offset
+  def pointer(offset):
+    return struct.pack('<I', 0x08000000 + offset)
+
+  def tileset(primary, tile_count, block_count):
+    image = alloc(lz10_literals(bytes(rand.choice((0x00, 0x00, 0x10, 0x01, 0x23,
+      0x45, 0x6e, 0x9a)) for _ in range(tile_count * 32))))
+    palettes = alloc(b''.join(struct.pack('<H', rand.randrange(0x8000))
+      for _ in range(16 * 16)))
+    # 12 tiles and 16 palettes between the primary and secondary tilesets
+    blocks = alloc(b''.join(struct.pack('<H', (rand.randrange(16) << 12) |
+      (rand.randrange(4) << 10) | rand.randrange(12))
+      for _ in range(block_count * 8)))
+    behaviours = alloc(bytes(block_count * 4))
+    assert behaviours == blocks + block_count * 16
+    return alloc(bytes([1, 0 if primary else 1, 0, 0]) + pointer(image) +
+      pointer(palettes) + pointer(blocks) + pointer(0) + pointer(behaviours))
+
+  primary = tileset(True, 8, 6)
+  (secondary, other_secondary) = (tileset(False, 4, 4), tileset(False, 4, 4))
+
+  def grid(width, height):
+    # 10 blocks between the primary and secondary tilesets
+    return b''.join(struct.pack('<H', (rand.randrange(64) << 10) |
+      rand.randrange(10)) for _ in range(width * height))
+
+  def layout(width, height, data, secondary):
+    return alloc(struct.pack('<II', width, height) + pointer(0) +
+      pointer(alloc(data)) + pointer(primary) + pointer(secondary))
+
+  def header(layout, label, connections=()):
+    connections_pointer = bytes(4)
+    if connections:
+      table = alloc(b''.join(struct.pack('<IiBBxx', *c) for c in connections))
+      connections_pointer = pointer(alloc(struct.pack('<I', len(connections)) +
+        pointer(table)))
+    return alloc(pointer(layout) + bytes(8) + connections_pointer + bytes(4) +
+      bytes([label]) + bytes(7))
+
+  town = grid(6, 5)
+  house = layout(4, 3, grid(4, 3), secondary)
+  banks = [[header(house, 91)] for _ in range(3)]
+  banks.append([
+    header(layout(6, 5, town, secondary), 88,
+           [(4, 0, 3, 1), (1, 1, 3, 2), (2, -1, 3, 3)]),
+    header(layout(6, 5, town, secondary), 88),
+    header(layout(6, 5, town, other_secondary), 89),
+    header(layout(3, 8, grid(3, 8), secondary), 90),
+  ])
+  bank_table = alloc(b''.join(pointer(alloc(b''.join(pointer(h) for h in maps)))
+    for maps in banks))
+  reverse_table = {v: k for (k, v) in TEXT_TABLE.items()}
+  names = alloc(b''.join(bytes(reverse_table[c] for c in name) + b'\xff'
+    for name in ('PALLET TOWN', 'ROUTE 1', 'VIRIDIAN CITY', 'HOUSE')) + b'\x0a')
+  return (bytes(rom), bank_table, names)
+
+def world_maps_of(rom, bank_table):
+  return load_maps(rom, hex(bank_table), 4)
+
+def test_renderers_match():
+  (rom, bank_table, names) = world_rom()
+  maps = world_maps_of(rom, bank_table)
+  offsets = calculate_map_offsets(maps, 3, 0)
+  (min_x, min_y, max_x, max_y) = calculate_bounds(maps, offsets)
+  (width, height) = ((max_x - min_x) * 16, (max_y - min_y) * 16)
+  # the maps as placed, then a house over the corner of the world and one
+  # hanging off its top left
+  placements = [(maps[m][b]['map_data'], (x - min_x) * 16, (y - min_y) * 16)
+                for ((m, b), (x, y)) in offsets]
+  placements += [(maps[0][0]['map_data'], 8, 8), (maps[1][0]['map_data'], -24, -8)]
+
+  images = {}
+  for (name, renderer_class) in sorted(RENDERERS.items()):
+    renderer = renderer_class()
+    cache = {}
+    canvas = renderer.new_canvas(width, height)
+    layers = {layer: renderer.new_canvas(width, height) for layer in LAYERS}
+    for (map_data, xx, yy) in placements:
+      draw_map(canvas, rom, map_data, xx, yy, None, cache, renderer)
+      draw_map(None, rom, map_data, xx, yy, layers, cache, renderer)
+    images[name] = [renderer.to_rgb(canvas)] + \
+      [renderer.to_rgb(layers[layer]) for layer in LAYERS]
+
+  reference = images['pygame']
+  for (name, image) in images.items():
+    assert image == reference, name
+  # the top layer has holes where the bottom one shows through
+  (whole, bottom, top, collision) = reference
+  background = bytes(BACKGROUND)
+  holes = [i for i in range(0, len(top), 3) if top[i:(i + 3)] == background and
+           bottom[i:(i + 3)] != background]
+  assert holes
+  assert all(whole[i:(i + 3)] == bottom[i:(i + 3)] for i in holes)
+
+def test_dedup():
+  (rom, bank_table, names) = world_rom()
+  maps = world_maps_of(rom, bank_table)
+  (town, copy, other) = [maps[3][i]['map_data'] for i in range(3)]
+  # copies of a grid are the same map, unless their tilesets differ
+  assert map_key(rom, town) == map_key(rom, copy)
+  assert map_key(rom, town) != map_key(rom, other)
+
+  # the copy is placed clear of everything, then over the town, which it can't
+  # be copied to since the town is already there
+  offsets = [((3, 0), (0, 0)), ((3, 2), (0, 5)), ((3, 1), (7, 0)),
+             ((3, 1), (3, 2))]
+  (width, height) = (13 * 16, 10 * 16)
+  for (name, renderer_class) in sorted(RENDERERS.items()):
+    renderer = renderer_class()
+    canvas = renderer.new_canvas(width, height)
+    dedup = new_dedup()
+    list(draw_maps(canvas, rom, maps, offsets, (0, 0), None, {}, renderer,
+                   dedup))
+    assert (dedup['drawn'], dedup['copied']) == (3, 1)
+
+    expected = renderer.new_canvas(width, height)
+    for ((m, b), (x, y)) in offsets:
+      map_data = maps[m][b]['map_data']
+      draw_read_map(expected, rom, read_map(rom, map_data), x * 16, y * 16,
+                    None, {}, renderer)
+    assert renderer.to_rgb(canvas) == renderer.to_rgb(expected), name
+
+def test_layers_single_pass():
+  (rom, bank_table, names) = world_rom()
+  maps = world_maps_of(rom, bank_table)
+  # the copy of the town is drawn over the town, and the route over both
+  offsets = [((3, 0), (0, 0)), ((3, 1), (3, 2)), ((3, 3), (1, 1))]
+  (width, height) = (9 * 16, 9 * 16)
+  for (name, renderer_class) in sorted(RENDERERS.items()):
+    renderer = renderer_class()
+    def draw(layers):
+      canvas = renderer.new_canvas(width, height)
+      if layers is not None:
+        layers = {layer: (canvas if layer is None else
+                          renderer.new_canvas(width, height))
+                  for layer in layers}
+      list(draw_maps(canvas, rom, maps, offsets, (0, 0), layers, {}, renderer,
+                     new_dedup()))
+      return {layer: renderer.to_rgb(c)
+              for (layer, c) in (layers or {None: canvas}).items()}
+
+    # the merged image of --layers is the image drawn without it, and each
+    # layer is the same as when it's drawn on its own
+    images = draw((None,) + LAYERS)
+    assert images[None] == draw(None)[None], name
+    for layer in LAYERS:
+      assert images[layer] == draw((layer,))[layer], (name, layer)
+
+    # laying the top layer over the bottom one isn't the same, as the top of a
+    # map ends up over the bottom of any map drawn over it
+    stacked = bytearray(images['bottom'])
+    for i in range(0, len(stacked), 3):
+      if images['top'][i:(i + 3)] != bytes(BACKGROUND):
+        stacked[i:(i + 3)] = images['top'][i:(i + 3)]
+    assert bytes(stacked) != images[None]
+
+    attributes = read_map(rom, maps[3][0]['map_data'])[6]
+    assert images['collision'][:3] == bytes(collision_colour(attributes[(0, 0)]))
+
+def test_read_map_tilesets():
+  (rom, bank_table, names) = world_rom()
+  maps = world_maps_of(rom, bank_table)
+  (primary, secondary) = maps[3][0]['tilesets']
+  # the primary tileset has 6 blocks and 8 tiles, the secondary 4 of each
+  (all_palettes, all_tiles, all_blocks) = [a + b for (a, b) in
+    zip(read_tileset(rom, primary), read_tileset(rom, secondary))]
+
+  cache = {}
+  (palettes, tiles, blocks) = read_map_tilesets(rom, primary, secondary,
+                                                {1, 7}, cache)
+  assert palettes == all_palettes
+  assert sorted(blocks) == [1, 7]
+  assert all(blocks[i] == all_blocks[i] for i in blocks)
+  # only the tiles those two blocks use are unpacked
+  used = set(tile for i in (1, 7) for (palette, tile, attributes) in all_blocks[i])
+  assert sorted(tiles) == sorted(used)
+  assert all(tiles[i] == all_tiles[i] for i in tiles)
+  assert sorted(cache[primary]['blocks']) == [1]
+  assert sorted(cache[secondary]['blocks']) == [1]
+  assert sorted(cache[primary]['tiles']) == sorted(i for i in used if i < 8)
+  assert sorted(cache[secondary]['tiles']) == sorted(i - 8 for i in used if i >= 8)
+
+  # another map with the same tilesets adds to the same objects
+  more = read_map_tilesets(rom, primary, secondary, {0, 9}, cache)
+  assert more[1] is tiles and more[2] is blocks
+  assert sorted(blocks) == [0, 1, 7, 9]
+
+  try:
+    read_map_tilesets(rom, primary, secondary, {10}, cache)
+  except IndexError:
+    pass
+  else:
+    assert False
+
+def test_draw_maps_pipelined():
+  (rom, bank_table, names) = world_rom()
+  maps = world_maps_of(rom, bank_table)
+  offsets = calculate_map_offsets(maps, 3, 0) + [((0, 0), (0, 0))]
+  (min_x, min_y, max_x, max_y) = calculate_bounds(maps, offsets)
+  (width, height) = ((max_x - min_x) * 16, (max_y - min_y) * 16)
+  renderer = RENDERERS['buffer']()
+  with tempfile.TemporaryDirectory() as directory:
+    # the workers read the rom from a file
+    rom_path = os.path.join(directory, 'rom.gba')
+    with open(rom_path, 'wb') as f:
+      f.write(rom)
+
+    expected = renderer.new_canvas(width, height)
+    expected_dedup = new_dedup()
+    order = list(draw_maps(expected, rom, maps, offsets, (min_x, min_y), None,
+                           {}, renderer, expected_dedup))
+    assert order == [map_id for (map_id, coord) in offsets]
+    for jobs in (1, 2):
+      canvas = renderer.new_canvas(width, height)
+      dedup = new_dedup()
+      cache = {}
+      assert list(draw_maps_pipelined(canvas, rom, rom_path, maps, offsets,
+        (min_x, min_y), None, cache, renderer, dedup, jobs)) == order
+      assert renderer.to_rgb(canvas) == renderer.to_rgb(expected)
+      assert (dedup['drawn'], dedup['copied']) == \
+        (expected_dedup['drawn'], expected_dedup['copied'])
+      # the tilesets the workers unpacked end up in the shared cache
+      assert set(p for p in cache if isinstance(p, int)) == \
+        set(p for ((m, b), coord) in offsets for p in maps[m][b]['tilesets'])
+
+# Runs a command on world_rom and returns what it printed.
+def run_command(command, *argv):
+  (rom, bank_table, names) = world_rom()
+  with tempfile.TemporaryDirectory() as directory:
+    rom_path = os.path.join(directory, 'rom.gba')
+    with open(rom_path, 'wb') as f:
+      f.write(rom)
+    out = io.StringIO()
+    with redirect_stdout(out):
+      assert command([rom_path, '--banks-offset', hex(bank_table),
+                      '--names-offset', hex(names), '--bank-count', '4'] +
+                     list(argv)) == 0
+  return out.getvalue()
+
+def test_commands():
+  (rom, bank_table, names) = world_rom()
+  maps = world_maps_of(rom, bank_table)
+
+  entries = json.loads(run_command(list_maps_command, '--json'))
+  assert [(e['bank'], e['map']) for e in entries] == \
+    [(0, 0), (1, 0), (2, 0), (3, 0), (3, 1), (3, 2), (3, 3)]
+  assert [e['name'] for e in entries] == ['HOUSE'] * 3 + \
+    ['PALLET TOWN', 'PALLET TOWN', 'ROUTE 1', 'VIRIDIAN CITY']
+  assert [(e['width'], e['height']) for e in entries[3:]] == \
+    [(6, 5), (6, 5), (6, 5), (3, 8)]
+  assert entries[5]['secondary_tileset'] == hex(maps[3][2]['tilesets'][1])
+  lines = run_command(list_maps_command).splitlines()
+  assert len(lines) == 7
+  assert lines[3].split() == ['3.0', '6x5', hex(maps[3][0]['tilesets'][0]),
+                              hex(maps[3][0]['tilesets'][1]), 'PALLET', 'TOWN']
+
+  stats = json.loads(run_command(stats_command, '--json'))
+  assert (stats['banks'], stats['maps'], stats['layouts']) == (4, 7, 5)
+  assert (stats['primary_tilesets'], stats['secondary_tilesets']) == (1, 2)
+  assert sorted(stats['tileset_usage'].values()) == [1, 6, 7]
+  assert stats['largest_map'] == '6x5 PALLET TOWN'
+  assert stats['world_maps'] == 4
+  assert stats['world_bounds'] == [-1, -8, 12, 10]
+  assert stats['world_size'] == [13 * 16, 18 * 16]
+  text = run_command(stats_command)
+  assert 'Banks: 4, maps: 7, distinct layouts: 5' in text
+  assert 'World: 4 maps, blocks (-1, -8) to (12, 10), 208x288 pixels' in text
+
+  index = json.loads(run_command(layout_command, '--json'))
+  assert (index['width'], index['height']) == (13, 18)
+  assert [(e['bank'], e['map'], e['x'], e['y']) for e in index['maps']] == \
+    [(3, 0, 1, 8), (3, 1, 7, 8), (3, 2, 2, 13), (3, 3, 0, 0)]
+  lines = run_command(layout_command).splitlines()
+  assert lines[0] == 'World: 13x18 blocks, 208x288 pixels'
+  assert lines[1].split() == ['3.0', 'at', '1,8', '6x5', 'PALLET', 'TOWN']
+
+def test_find_free_space():
+  rom = bytearray(0x100)
+  rom[0x11:0x51] = b'\xff' * 0x40
+  rom[0x60:0x70] = b'\xff' * 0x10
+  rom[0x80:0xc0] = b'\xff' * 0x40
+  # starts are aligned, and what's left of a run after aligning it has to be
+  # long enough
+  assert find_free_space(rom, 0, min_length=0x20) == [[0x14, 0x51], [0x80, 0xc0]]
+  assert find_free_space(rom, 0, min_length=0x3e) == [[0x80, 0xc0]]
+  assert find_free_space(rom, 0x90, min_length=0x20) == [[0x90, 0xc0]]
+  # a run shorter than min_length isn't free space
+  assert find_free_space(rom, 0, min_length=0x41) == []
+  assert find_free_space(rom, 0) == []
+
+  # anything the maps read is cut out of the runs
+  assert find_free_space(rom, 0, min_length=0x10,
+                         used=[(0x20, 0x30), (0x90, 0xa1)]) == \
+    [[0x30, 0x51], [0x60, 0x70], [0x80, 0x90], [0xa4, 0xc0]]
+  assert find_free_space(rom, 0, min_length=0x20,
+                         used=[(0x00, 0x40), (0x81, 0x82)]) == [[0x84, 0xc0]]
+
+def test_allocate():
+  rom = bytearray(0x100)
+  rom[0x20:0x80] = b'\xff' * 0x60
+  free = find_free_space(rom, 0, min_length=0x20)
+  # each allocation takes the start of the run, after the guard, and leaves
+  # the rest of it free
+  assert allocate(rom, free, 0x10, guard=0x8) == 0x28
+  assert free == [[0x38, 0x80]]
+  assert allocate(rom, free, 0x3, guard=0x8) == 0x40
+  assert allocate(rom, free, 0x10, guard=0x8) == 0x4c
+  assert free == [[0x5c, 0x80]]
+  assert allocate(rom, free, 0x1c, guard=0) == 0x5c
+  assert len(rom) == 0x100
+
+  # the rom grows when no run fits
+  assert allocate(rom, free, 0x10, guard=0x8) == 0x100
+  assert len(rom) == 0x110
+  rom.append(0)
+  assert allocate(rom, [], 0x4) == 0x114
+  assert rom[0x111:] == b'\xff' * 7
+  try:
+    allocate(rom, [], MAX_ROM_SIZE)
+  except ValueError:
+    pass
+  else:
+    assert False
+
+def test_read_tileset_file():
+  import pygame
+  (rom, maps) = map_rom()
+  # the primary tileset at 0x500 has 7 palettes of black
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'tiles.bin')
+    for (length, valid) in ((64, True), (0, True), (33, False), (100, False)):
+      with open(path, 'wb') as f:
+        f.write(b'\x12' * length)
+      try:
+        assert read_tileset_file(rom, 0x500, path) == b'\x12' * length
+      except ValueError:
+        assert not valid
+      else:
+        assert valid
+
+    path = os.path.join(directory, 'tiles.png')
+    image = pygame.Surface((16, 8))
+    pygame.image.save(image, path)
+    assert read_tileset_file(rom, 0x500, path) == bytes(64)
+    assert read_tileset_file(rom, 0x500, path, 6) == bytes(64)
+    for palette in (-1, 7, 15):
+      try:
+        read_tileset_file(rom, 0x500, path, palette)
+      except ValueError:
+        pass
+      else:
+        assert False
+
+    # colours that aren't in the palette, and images that aren't whole tiles
+    image.set_at((9, 3), (255, 0, 0))
+    pygame.image.save(image, path)
+    pygame.image.save(pygame.Surface((12, 8)), os.path.join(directory, 'odd.png'))
+    for bad in (path, os.path.join(directory, 'odd.png')):
+      try:
+        read_tileset_file(rom, 0x500, bad)
+      except ValueError:
+        pass
+      else:
+        assert False
+
+def test_end_of_data():
+  assert end_of_data(bytearray(b'\x01\xff\x02' + b'\xff' * 8)) == 3
+  assert end_of_data(bytearray(b'\xff' * 8)) == 0
+
+# Writes `rgb`, the rows of a width x height image, to `path`, `band` rows at a
+# time, and returns the file's contents.
+def write_image(path, width, height, rgb, band):
+  writer = ImageWriter(path, width, height)
+  for top in range(0, height, band):
+    writer.write(rgb[(top * width * 3):((top + band) * width * 3)])
+  writer.close()
+  with open(path, 'rb') as f:
+    return f.read()
+
+# The chunks of a PNG, with the IDAT chunks joined together.
+def png_chunks(data):
+  assert data[:8] == b'\x89PNG\r\n\x1a\n'
+  chunks = []
+  offset = 8
+  while offset < len(data):
+    (length, kind) = struct.unpack('>I4s', data[offset:(offset + 8)])
+    body = data[(offset + 8):(offset + 8 + length)]
+    assert struct.unpack('>I', data[(offset + 8 + length):(offset + 12 + length)])[0] == \
+      zlib.crc32(kind + body) & 0xffffffff
+    if chunks and kind == chunks[-1][0] == b'IDAT':
+      chunks[-1] = (kind, chunks[-1][1] + body)
+    else:
+      chunks.append((kind, body))
+    offset += 12 + length
+  return chunks
+
+def test_image_writer():
+  # 5 pixels is an odd width, so BMP rows need padding
+  (width, height) = (5, 7)
+  rgb = bytes((i * 37) & 0xff for i in range(width * height * 3))
+  with tempfile.TemporaryDirectory() as directory:
+    for fmt in IMAGE_WRITER_FORMATS:
+      path = os.path.join(directory, 'image.' + fmt)
+      whole = write_image(path, width, height, rgb, height)
+      for band in (1, 2, 3):
+        banded = write_image(path, width, height, rgb, band)
+        if fmt == 'png':
+          # the compressed data can be split into IDAT chunks differently
+          assert png_chunks(banded) == png_chunks(whole)
+        else:
+          assert banded == whole
+
+    (ihdr, trns, idat, iend) = png_chunks(write_image(
+      os.path.join(directory, 'image.png'), width, height, rgb, 2))
+    assert ihdr == (b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+    assert zlib.decompress(idat[1]) == b''.join(
+      b'\x00' + rgb[(y * width * 3):((y + 1) * width * 3)] for y in range(height))
+
+    bmp = write_image(os.path.join(directory, 'image.bmp'), width, height, rgb, 3)
+    assert len(bmp) == 54 + 16 * height
+    assert bmp[54:70] == bytes(rgb[2::-1] + rgb[5:2:-1] + rgb[8:5:-1] +
+                               rgb[11:8:-1] + rgb[14:11:-1]) + b'\x00'
+
+    tga = write_image(os.path.join(directory, 'image.tga'), width, height, rgb, 3)
+    assert len(tga) == 18 + width * height * 3
+
+    writer = ImageWriter(os.path.join(directory, 'short.bmp'), width, height)
+    writer.write(rgb[:(width * 3)])
+    try:
+      writer.close()
+    except ValueError:
+      pass
+    else:
+      assert False
+    writer.file.close()
+
+    try:
+      ImageWriter(os.path.join(directory, 'image.jpeg'), width, height)
+    except ValueError:
+      pass
+    else:
+      assert False
+
+def test_parse_size():
+  assert parse_size('1048576') == 1048576
+  assert parse_size('512M') == 512 * 1024 * 1024
+  assert parse_size('2G') == 2 * 1024 ** 3
+  assert parse_size('1.5K') == 1536
+  assert parse_size(' 64 kib ') == 64 * 1024
+  assert parse_size('3MB') == 3 * 1024 * 1024
+  for text in ('', 'M', 'lots', '-1K', '2T'):
+    try:
+      parse_size(text)
+    except argparse.ArgumentTypeError:
+      pass
+    else:
+      assert False, text
+
+def test_estimate_memory():
+  (rom, width, height) = (0x1000000, 1000, 800)
+  pixels = width * height
+  assert estimate_memory(rom, width, height, 'memory') == \
+    BASE_MEMORY + rom + pixels * 8
+  assert estimate_memory(rom, width, height, 'memory', 'buffer') == \
+    BASE_MEMORY + rom + pixels * (8 + 3 + 6)
+  assert estimate_memory(rom, width, height, 'memory', 'buffer', True) == \
+    BASE_MEMORY + rom + pixels * (8 + 3 + 6) + len(LAYERS) * pixels * (3 + 10)
+  # only the band is kept, whatever the backend
+  for strategy in ('banded', 'disk'):
+    assert estimate_memory(rom, width, height, strategy, band_height=64) == \
+      BASE_MEMORY + rom + width * 64 * 6
+
+def test_choose_strategy():
+  (rom, width, height) = (0x1000000, 4000, 3000)
+  memory = estimate_memory(rom, width, height, 'memory', 'pygame')
+  assert choose_strategy(None, rom, width, height, 'pygame', False) == \
+    ('memory', height)
+  assert choose_strategy(memory, rom, width, height, 'pygame', False) == \
+    ('memory', height)
+
+  # just under what drawing in memory takes, the bands are as tall as fit
+  (strategy, band) = choose_strategy(memory - 1, rom, width, height, 'pygame',
+                                     False)
+  assert (strategy, band) == ('banded', height)
+  budget = BASE_MEMORY + rom + width * 600 * 6 + 100
+  (strategy, band) = choose_strategy(budget, rom, width, height, 'pygame', False)
+  assert (strategy, band) == ('banded', 592)
+  assert estimate_memory(rom, width, height, 'banded', band_height=band) <= budget
+
+  # bands too short to be worth redrawing maps for go on disk instead
+  budget = BASE_MEMORY + rom + width * 100 * 6
+  assert choose_strategy(budget, rom, width, height, 'pygame', False) == \
+    ('disk', 96)
+  assert choose_strategy(0, rom, width, height, 'pygame', False) == ('disk', 16)
+  # a world shorter than that can still be drawn in bands
+  assert choose_strategy(budget, rom, width, 96, 'pygame', False) == \
+    ('banded', 96)
+
+  assert choose_strategy(None, rom, width, height, 'pygame', False, 'disk') == \
+    ('disk', DISK_BAND_HEIGHT)
+  assert choose_strategy(None, rom, width, 100, 'pygame', False, 'banded') == \
+    ('banded', 100)
+  assert choose_strategy(0, rom, width, height, 'pygame', False, 'memory') == \
+    ('memory', height)
+
+if __name__ == '__main__':
+  test_world_index()
+  test_world_index_edge_cases()
+  test_save_world_index()
+  test_find_pointer_runs()
+  test_find_bank_table()
+  test_detect_offsets()
+  test_load_maps()
+  test_changed_ranges()
+  test_map_ranges()
+  test_changed_maps()
+  test_renderers_match()
+  test_dedup()
+  test_layers_single_pass()
+  test_read_map_tilesets()
+  test_draw_maps_pipelined()
+  test_commands()
+  test_find_free_space()
+  test_allocate()
+  test_read_tileset_file()
+  test_end_of_data()
+  test_image_writer()
+  test_parse_size()
+  test_estimate_memory()
+  test_choose_strategy()